@@ -0,0 +1,113 @@
+"""
+Asyncio transport for SooperLooper
+
+The plain channel sends every message on the thread that calls it, which
+is the thread handling input. This channel instead owns a non-blocking
+UDP datagram endpoint on an asyncio event loop running in its own
+thread. Sends are handed over to that loop and the caller returns
+straight away, so a slow network never holds up the next pedal press.
+"""
+import asyncio
+import threading
+
+from osc4py3 import oscbuildparse
+
+from looper import Channel
+from osctemplates import TemplateCache
+import latency
+import metrics
+import settings
+
+
+class ChannelProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol for the SooperLooper endpoint
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    def datagram_received(self, data, addr):
+        self.channel._dispatch_reply(data)
+
+    def error_received(self, exc):
+        if settings.DEBUG:
+            print("OSC transport error: {}".format(exc))
+
+
+class AsyncChannel(Channel):
+    """
+    Link to the SooperLooper instance with the same method surface as
+    `looper.Channel`, but which never blocks the caller on network I/O.
+    """
+    def start(self):
+        self.templates = TemplateCache()
+        self.reply_handlers = {}
+        self._init_ping()
+        self.loop = asyncio.new_event_loop()
+        self.transport = None
+
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       args=(ready,),
+                                       name="AsyncChannel",
+                                       daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        """
+        Open the datagram endpoint and run the event loop for ever
+        """
+        asyncio.set_event_loop(self.loop)
+        self.transport, self.protocol = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                lambda: ChannelProtocol(self),
+                remote_addr=(self.looper_addr, self.looper_port)))
+        self.reply_address = self.transport.get_extra_info("sockname")[:2]
+        ready.set()
+        self.loop.run_forever()
+
+    def listen(self):
+        """
+        Replies are always received on the event loop; nothing to start.
+        """
+
+    def stop(self):
+        """
+        Close the endpoint and stop the event loop
+        """
+        self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def _transmit(self, packet):
+        """
+        Encode and send a packet. Runs on the event loop thread.
+        """
+        self.transport.sendto(oscbuildparse.encode_packet(packet))
+        metrics.osc_sent.inc(
+            "bundle" if isinstance(packet, oscbuildparse.OSCBundle)
+            else "message")
+
+    def _send_datagram(self, data):
+        """
+        Hand encoded bytes over to the event loop and return immediately.
+        Templates re-use their buffers, so the event loop gets a copy.
+        """
+        if self.send_time is not None:
+            data = self._timetagged(data)
+        start = latency.now()
+        self.loop.call_soon_threadsafe(self.transport.sendto, bytes(data))
+        latency.record("send", start)
+        metrics.osc_sent.inc("bundle" if data[:8] == b"#bundle\x00"
+                             else "message")
+
+    def _send_packet(self, packet):
+        """
+        Hand the packet over to the event loop and return immediately
+        """
+        if self.send_time is not None:
+            # encode now, while we know when it is to be acted on
+            self._send_datagram(oscbuildparse.encode_packet(packet))
+            return
+        self.loop.call_soon_threadsafe(self._transmit, packet)
@@ -1,45 +1,163 @@
 """
 Base classes
 """
+import events
+import gestures
+import keymaps
+import latency
+import metrics
 import settings
 
 
 class BaseCommandSet(object):
     """
     Sub-class to create a command set by adding methods named
-    handle_<key> to it.
+    handle_<event name> to it.
+
+    Each sub-class gets a dispatch table, built once when the class is
+    defined, mapping both event codes and names to handler functions.
+
+    If the `keymap` given, the class's `keymap`, or else settings.KEYMAP,
+    names a keymap file (see keymaps.py) its mappings are compiled over
+    that table, and reloaded when the file changes if
+    settings.KEYMAP_RELOAD is set.
+
+    Command sets that don't act on the looper, such as a bridge client
+    forwarding everything elsewhere, set `needs_looper` False and are
+    given None for it, so that no connection to SooperLooper is made.
     """
-    def __init__(self, looper, input_handler=None):
+    commands = {}
+    dispatch_table = {}
+    keymap = None
+    needs_looper = True
+    # journal.Journal of the looper's state, synced after each command
+    journal = None
+    # held while running commands, if anything besides the input thread
+    # runs them too (such as a quantize.QuantizedScheduler thread)
+    lock = None
+    # actions taking another action as their first argument, e.g.
+    # ["at_cycle", "scene", "breakdown"], checked when keymaps compile
+    nested_actions = ()
+    # the input handler's module, labelling metrics
+    source = "none"
+    stamp = None
+    value = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.commands = {}
+        for klass in reversed(cls.__mro__):
+            for attr, fn in vars(klass).items():
+                if attr.startswith("handle_") and callable(fn):
+                    cls.commands[attr[len("handle_"):]] = fn
+        cls.dispatch_table = gestures.dispatch_table(cls, cls.commands)
+
+    def __init__(self, looper, input_handler=None, keymap=None):
         self.handler = input_handler
         self.looper = looper
 
-        fns = type(self).__dict__
-        self.commands = {k: v
-                         for (k, v) in fns.items() if k.startswith("handle_")}
+        self.keymap_watcher = None
+        keymap = keymap or self.keymap or getattr(settings, "KEYMAP", None)
+        if keymap is not None:
+            path = keymaps.path_for(keymap)
+            self.dispatch_table = keymaps.compile_keymap(keymaps.load(path),
+                                                         type(self))
+            if settings.KEYMAP_RELOAD:
+                self.keymap_watcher = keymaps.KeymapWatcher(self, path).start()
+
         if settings.DEBUG:
-            print("Commands: \n : {}".format("\n : ".join(self.commands.keys())))
+            names = [k for k in self.dispatch_table if isinstance(k, str)]
+            print("Commands: \n : {}".format("\n : ".join(names)))
 
-    def handle(self, command):
+    def handle(self, event, stamp=None, value=None):
         """
-        Execute function handler for given command if available
+        Execute the handler for an event, given by code or name, if there
+        is one. `stamp` is the latency.now() time at which the input was
+        received, and is kept as self.stamp for handlers that time what
+        they do by it. `value`, for events from continuous controls, is
+        kept as self.value.
         """
-        fn = "handle_{}".format(command)
-        try:
-            self.commands[fn](self)
-        except KeyError:
+        start = latency.now()
+        self.stamp = stamp
+        self.value = value
+        fn = self.dispatch_table.get(event)
+        if fn is None:
+            if metrics.enabled:
+                metrics.events.inc(self.source)
+                metrics.dispatch_misses.inc(self.source)
             if settings.DEBUG:
-                print("Could not find command: {}".format(command))
+                print("Could not find command: {}".format(events.name(event)))
+            return
+        if self.lock is None:
+            fn(self)
+            if self.journal is not None:
+                self.journal.sync()
+        else:
+            with self.lock:
+                fn(self)
+                if self.journal is not None:
+                    self.journal.sync()
+        latency.record("dispatch", start)
+        if metrics.enabled:
+            metrics.events.inc(self.source)
+            metrics.dispatch_seconds.observe((latency.now() - start) / 1e9)
+        if stamp is not None:
+            latency.record("total", stamp)
+
+    def perform(self, fn, *args):
+        """
+        Run an action held back to run later, such as to the loop's next
+        cycle, as handle() would run it: holding the lock, journaled and
+        counted
+        """
+        start = latency.now()
+        if self.lock is None:
+            fn(*args)
+            if self.journal is not None:
+                self.journal.sync()
+        else:
+            with self.lock:
+                fn(*args)
+                if self.journal is not None:
+                    self.journal.sync()
+        if metrics.enabled:
+            metrics.events.inc("scheduled")
+            metrics.dispatch_seconds.observe((latency.now() - start) / 1e9)
 
 
 class BaseInputHandler(object):
     """
     Base class for Input handlers, be the input a keyboard, stomp box,
     or something else.
+
+    A handler either runs alone, by start(), or as one of several sources
+    in a mux.Multiplexer, by attach().
     """
+    # the mux.Multiplexer running this handler, if any
+    mux = None
 
     def __init__(self, command_set):
         self.command_set = command_set
         self.command_set.handler = self
+        self.command_set.source = type(self).__module__
+
+    def handle(self, event, stamp=None, value=None):
+        """
+        Pass an event to the command set, or when multiplexed, have it
+        handled in turn with the other sources' events
+        """
+        if self.mux is None:
+            self.command_set.handle(event, stamp, value)
+        else:
+            self.mux.post(stamp, self.command_set.handle, event, stamp,
+                          value)
 
     def start(self):
         raise NotImplementedError
+
+    def attach(self, mux):
+        """
+        Set up to run in `mux`, registering what is to be read and polled
+        there instead of blocking
+        """
+        raise NotImplementedError
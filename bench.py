@@ -0,0 +1,1024 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the controller. Run without a real SooperLooper; each
+suite sets up whatever local endpoints it needs, generally the fake
+SooperLooper in fakesl.py.
+
+> ./bench.py [--suite=<name>] [--count=<n>] [--latency=<ms>] ...
+"""
+import socket
+import threading
+import time
+
+import optfn
+
+from utils import get_class_from_string
+from utils import percentile
+
+
+class UDPSink(object):
+    """
+    Local UDP endpoint that timestamps every datagram it receives
+    """
+    def __init__(self, host="127.0.0.1"):
+        self.socket = socket.socket(family=socket.AF_INET,
+                                    type=socket.SOCK_DGRAM)
+        self.socket.bind((host, 0))
+        self.host, self.port = self.socket.getsockname()
+        self.received = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.socket.recv(65536)
+            self.received.append(time.perf_counter())
+
+    def wait_for(self, count, timeout=5.0):
+        deadline = time.perf_counter() + timeout
+        while len(self.received) < count and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        return len(self.received)
+
+    def reset(self):
+        self.received = []
+
+
+def report(name, samples, unit=1e6, unit_name="us"):
+    """
+    Print p50/p95/p99/max of a list of durations given in seconds
+    """
+    samples = sorted(samples)
+    print("  {:<32} n={:<6} p50={:8.1f}{u} p95={:8.1f}{u} "
+          "p99={:8.1f}{u} max={:8.1f}{u}".format(
+              name, len(samples),
+              percentile(samples, 50) * unit,
+              percentile(samples, 95) * unit,
+              percentile(samples, 99) * unit,
+              (samples[-1] if samples else 0) * unit,
+              u=unit_name))
+
+
+def bench_channel(count, options):
+    """
+    Per-command latency for each Channel transport: time the caller is
+    blocked, and time until the datagram arrives at a local endpoint.
+    """
+    print("Channel per-command latency ({} commands)".format(count))
+    sink = UDPSink()
+
+    for classpath in ["looper.Channel", "aio.AsyncChannel"]:
+        channel = get_class_from_string(classpath)(sink.host, sink.port)
+        sink.reset()
+
+        sent = []
+        blocked = []
+        for i in range(count):
+            start = time.perf_counter()
+            channel.record(i % 8)
+            end = time.perf_counter()
+            sent.append(start)
+            blocked.append(end - start)
+            # pace the commands so we measure latency, not queueing
+            time.sleep(0.0005)
+
+        received = sink.wait_for(count)
+        delivered = [r - s for (s, r) in zip(sent, sink.received)]
+        print(" {} ({} of {} delivered)".format(classpath, received, count))
+        report("caller blocked", blocked)
+        report("send to delivery", delivered)
+
+        if hasattr(channel, "stop"):
+            channel.stop()
+
+
+def _time_per_op(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return (time.perf_counter() - start) / count
+
+
+def bench_templates(count, options):
+    """
+    Cost of sending a 'hit' and a 'set' through osc4py3 against the
+    pre-encoded template path.
+    """
+    from osc4py3 import oscbuildparse
+    from osc4py3.as_eventloop import osc_process
+    from osc4py3.as_eventloop import osc_send
+    from osc4py3.as_eventloop import osc_startup
+    from osc4py3.as_eventloop import osc_udp_client
+
+    from osctemplates import TemplateCache
+
+    print("OSC message cost ({} sends)".format(count))
+    sink = UDPSink()
+    sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    address = (sink.host, sink.port)
+    templates = TemplateCache()
+
+    osc_startup()
+    osc_udp_client(sink.host, sink.port, "bench")
+
+    def osc4py3_hit(i):
+        osc_send(oscbuildparse.OSCMessage("/sl/{}/hit".format(i % 8),
+                                          ",s", ["record"]), "bench")
+        osc_process()
+
+    def osc4py3_set(i):
+        osc_send(oscbuildparse.OSCMessage("/set", ",sf",
+                                          ["selected_loop_num", i % 8]),
+                 "bench")
+        osc_process()
+
+    def encode_hit(i):
+        sock.sendto(oscbuildparse.encode_packet(
+            oscbuildparse.OSCMessage("/sl/{}/hit".format(i % 8),
+                                     ",s", ["record"])), address)
+
+    def template_hit(i):
+        sock.sendto(templates.hit("record", i % 8), address)
+
+    def template_set(i):
+        sock.sendto(templates.global_set("selected_loop_num", i % 8), address)
+
+    for name, fn in [("osc4py3 hit", osc4py3_hit),
+                     ("osc4py3 set", osc4py3_set),
+                     ("encode + sendto hit", encode_hit),
+                     ("template hit", template_hit),
+                     ("template set", template_set)]:
+        per_op = _time_per_op(fn, count)
+        print("  {:<32} {:8.2f}us/op".format(name, per_op * 1e6))
+
+    print("  {:<32} {:8.2f}us/op".format(
+        "template lookup only",
+        _time_per_op(lambda i: templates.hit("record", i % 8), count) * 1e6))
+
+
+def _fixed_sleep_setup(channel, looper, nloops):
+    """
+    The setup sequence as it was, timed by fixed sleeps
+    """
+    from osc4py3 import oscbuildparse
+    from looper import Loop
+
+    for i in range(10):
+        channel._send_packet(
+            oscbuildparse.OSCMessage("/loop_del", ",i", [-1]))
+        time.sleep(0.1)
+    for i in range(nloops):
+        loop = Loop()
+        looper.loops.append(loop)
+        loop.looper = looper
+        loop.index = i
+        channel.add_loop()
+        time.sleep(0.05)
+        channel.set_properties(dict(sync=1, playback_sync=1, quantize=3), i)
+        time.sleep(0.1)
+
+
+def _ack_setup(channel, looper, nloops):
+    from looper import Loop
+
+    channel.clear_loops()
+    loops = [Loop() for i in range(nloops)]
+    looper.add_loops(loops, master=loops[0])
+
+
+def bench_startup(count, options):
+    """
+    Time from an empty controller to configured loops against a local
+    fake SooperLooper, with fixed sleeps and with acknowledged setup,
+    and to bind to loops already running.
+    """
+    from fakesl import FakeSooperLooper
+    from looper import Channel
+    from looper import Looper
+
+    print("Loop setup time")
+    for nloops in [2, 4, 8]:
+        for name, setup in [("fixed sleeps", _fixed_sleep_setup),
+                            ("acknowledged", _ack_setup)]:
+            # start with some loops to be cleared away
+            server = FakeSooperLooper(loops=3, loop_add_delay=0.002,
+                                      **options).start()
+            channel = Channel(server.host, server.port)
+            looper = Looper(channel)
+
+            start = time.perf_counter()
+            setup(channel, looper, nloops)
+            elapsed = time.perf_counter() - start
+
+            time.sleep(0.05)
+            configured = sum(1 for l in server.loops
+                             if l.controls.get("quantize") == 3)
+            print("  {} loops, {:<14} {:8.1f}ms ({} of {} configured)".format(
+                nloops, name, elapsed * 1e3, configured, nloops))
+
+    print("Binding to a running session of 4 loops (--nosetup)")
+    for nloops in [4, 8]:
+        server = FakeSooperLooper(loops=4, loop_add_delay=0.002,
+                                  **options).start()
+        now = time.monotonic()
+        for i, hits in enumerate([["record"], ["record", "record"],
+                                  ["record", "record", "overdub"], []]):
+            for command in hits:
+                server.loops[i].hit(command, now)
+        before = [(l.state, list(l.hits)) for l in server.loops]
+
+        looper = Looper(Channel(server.host, server.port))
+        start = time.perf_counter()
+        looper.bind(nloops)
+        elapsed = time.perf_counter() - start
+
+        time.sleep(0.05)
+        undisturbed = sum(1 for l, (state, hits) in zip(server.loops, before)
+                          if (l.state, l.hits) == (state, hits))
+        print("  to {} loops {:8.1f}ms (states {}, {} of {} left alone, "
+              "{} loops now)".format(
+                  nloops, elapsed * 1e3,
+                  [loop.state for loop in looper.loops[:4]],
+                  undisturbed, len(before), len(server.loops)))
+
+
+# run in a fresh interpreter for each config set: build the controller
+# as lc.py would, short of starting the input handler, and report on it
+_ROLE_STARTUP = """
+import json, resource, sys, time
+start = time.perf_counter()
+
+def peak_rss():
+    # kB. ru_maxrss would include the parent's, from before the exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+import lc, settings
+from utils import get_class_from_string
+lc.set_config(sys.argv[1])
+settings.KEYMAP_RELOAD = False
+try:
+    if sys.argv[4] == "always":
+        sources = settings.INPUT_SOURCES or [
+            {"COMMAND_SET": settings.COMMAND_SET}]
+        for source in sources:
+            get_class_from_string(source["COMMAND_SET"]).needs_looper = True
+    lc.build_controller(sys.argv[2], int(sys.argv[3]), True, 2, 1)
+    error = None
+except BaseException as e:
+    error = "{}: {}".format(type(e).__name__, e)
+print(json.dumps(dict(
+    elapsed=time.perf_counter() - start,
+    rss=peak_rss(),
+    loaded=[m for m in ["osc4py3", "jack", "pynput", "RPi"]
+            if m in sys.modules],
+    error=error)))
+"""
+
+
+def bench_roles(count, options):
+    """
+    Startup time and peak RSS of each config set, in a fresh interpreter,
+    as its role needs and with the looper set up whatever the role as
+    before, against a local fake SooperLooper.
+    """
+    import json
+    import os
+    import subprocess
+    import sys
+
+    from fakesl import FakeSooperLooper
+    import settings
+
+    server = FakeSooperLooper(loop_add_delay=0.002, **options).start()
+    here = os.path.dirname(os.path.abspath(__file__))
+    print("Startup by config set")
+    for name in settings.CONFIG_SETS:
+        for mode in ["role", "always"]:
+            result = subprocess.run(
+                [sys.executable, "-c", _ROLE_STARTUP, name, server.host,
+                 str(server.port), mode],
+                cwd=here, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True)
+            # skipping whatever else was printed, e.g. reports at exit
+            lines = [line for line in result.stdout.splitlines()
+                     if line.startswith("{")]
+            if not lines:
+                print("  {:<20} {:<7} failed".format(name, mode))
+                continue
+            stats = json.loads(lines[-1])
+            if stats["error"] is not None:
+                print("  {:<20} {:<7} unavailable ({})".format(
+                    name, mode, stats["error"].splitlines()[0]))
+                continue
+            print("  {:<20} {:<7} {:8.1f}ms {:8.1f}MB  loaded: {}".format(
+                name, mode, stats["elapsed"] * 1e3, stats["rss"] / 1024,
+                ", ".join(stats["loaded"]) or "-"))
+
+
+def bench_group(count, options):
+    """
+    Setup time for several SooperLooper instances, one after another and
+    in parallel, then the spread in when the instances act on a pause
+    of everything, each instance a fake SooperLooper.
+    """
+    from fakesl import FakeSooperLooper
+    import lc
+    from looper import LooperGroup
+    import settings
+
+    print("Setup time by number of instances")
+    for n in [1, 2, 4, 8]:
+        servers = [FakeSooperLooper(loops=3, loop_add_delay=0.002,
+                                    log=True, **options).start()
+                   for i in range(n)]
+        instances = [dict(host=server.host, port=server.port)
+                     for server in servers]
+
+        start = time.perf_counter()
+        LooperGroup([lc.build_looper(instance["host"], instance["port"],
+                                     True, 2, 1)
+                     for instance in instances])
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        group = lc.build_group(instances, True)
+        parallel = time.perf_counter() - start
+        print("  {} instances  serial {:8.1f}ms  parallel {:8.1f}ms".format(
+            n, serial * 1e3, parallel * 1e3))
+
+    trials = min(count, 50)
+    print("Pause all across {} instances ({} times)".format(n, trials))
+    for latency in [0, 0.01]:
+        settings.SCENE_LATENCY = latency
+        spreads = []
+        for i in range(trials):
+            for server in servers:
+                server.reset_log()
+            group.toggle_pause_all()
+            time.sleep(0.05)
+            processed = [server.log[-1][1] for server in servers
+                         if server.log and server.log[-1][1] is not None]
+            if len(processed) == n:
+                spreads.append(max(processed) - min(processed))
+        report("spread, scene latency {:.0f}ms".format(latency * 1e3),
+               spreads)
+
+
+def bench_journal(count, options):
+    """
+    Cost of journaling after each command, with and without a change to
+    journal, and time to replay a full segment into a fresh looper.
+    """
+    import shutil
+    import tempfile
+
+    from fakesl import FakeSooperLooper
+    from journal import Journal
+    from journal import RECORD_SIZE
+    from looper import Loop
+
+    server = FakeSooperLooper(loops=8).start()
+    directory = tempfile.mkdtemp()
+    try:
+        looper = _looper_for(server)
+        looper.add_loops([Loop() for i in range(6)], create=False)
+        journal = Journal(directory + "/lc", flush_interval=0.01)
+        journal.start(looper)
+
+        print("Journal sync, 8 loops ({} commands)".format(count))
+        print("  {:<32} {:8.2f}us/op".format(
+            "nothing changed", _time_per_op(lambda i: journal.sync(),
+                                            count) * 1e6))
+
+        def change(i):
+            loop = looper.loops[i % 8]
+            loop.current_layer = loop.layers = i
+            journal.sync()
+        print("  {:<32} {:8.2f}us/op".format(
+            "one loop changed", _time_per_op(change, count) * 1e6))
+
+        def select(i):
+            looper.selected_loop = i % 8
+            journal.sync()
+        print("  {:<32} {:8.2f}us/op".format(
+            "selection changed", _time_per_op(select, count) * 1e6))
+
+        # fill the segment, short of rotating
+        while journal.position < len(journal.map) - 2 * RECORD_SIZE:
+            change(journal.position)
+        journal.flush()
+        fresh = _looper_for(server)
+        fresh.add_loops([Loop() for i in range(6)], create=False)
+        start = time.perf_counter()
+        replayed = journal.replay(fresh)
+        elapsed = time.perf_counter() - start
+        restored = all(
+            (a.state, a.current_layer, a.layers) ==
+            (b.state, b.current_layer, b.layers)
+            for a, b in zip(looper.loops, fresh.loops))
+        print("  replay {} records {:8.2f}ms ({})".format(
+            replayed, elapsed * 1e3,
+            "restored" if restored else "NOT restored"))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_metrics(count, options):
+    """
+    Cost of counting and of a histogram observation, then the cost of
+    dispatching an event while the metrics are scraped as fast as
+    possible over HTTP, against not scraped at all. Each dispatch run
+    lasts long enough for many scrapes to overlap it.
+    """
+    import urllib.request
+
+    from base import BaseCommandSet
+    import events
+    import metrics
+
+    # serving turns counting on
+    server = metrics.serve("127.0.0.1", 0)
+    url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+
+    print("Metrics cost per update ({} updates)".format(count))
+    for name, fn in [
+            ("counter", lambda i: metrics.events.inc("bench")),
+            ("labelled counter", lambda i: metrics.transitions.inc(
+                "127.0.0.1:9951", i % 8, "PLAYBACK")),
+            ("histogram", lambda i: metrics.dispatch_seconds.observe(
+                i * 1e-6))]:
+        print("  {:<32} {:8.2f}us/op".format(
+            name, _time_per_op(fn, count) * 1e6))
+
+    class Commands(BaseCommandSet):
+        def handle_SPACE(self):
+            pass
+
+    commands = Commands(None)
+    space = events.KEY_CODES["SPACE"]
+    scrapes = []
+    scraping = threading.Event()
+
+    def scrape():
+        while True:
+            scraping.wait()
+            start = time.perf_counter()
+            urllib.request.urlopen(url).read()
+            scrapes.append(time.perf_counter() - start)
+    threading.Thread(target=scrape, daemon=True).start()
+
+    duration = 2.0
+    print("Dispatch while scraped ({:.0f}s each)".format(duration))
+    for name in ["not scraped", "scraped"]:
+        if name == "scraped":
+            scraping.set()
+            # be sure scrapes are under way before timing
+            while len(scrapes) < 3:
+                time.sleep(0.01)
+            scraped = len(scrapes)
+        durations = []
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            commands.handle(space)
+            durations.append(time.perf_counter() - start)
+        report(name, durations)
+    scraping.clear()
+    print("  {} scrapes overlapped the scraped run".format(
+        len(scrapes) - scraped))
+    report("scrape", scrapes, 1e3, "ms")
+
+
+RATES = [200, 1000, 5000, 20000] # commands per second
+
+
+def _drive(command, count, rate):
+    """
+    Call `command` `count` times at `rate` per second. Returns the
+    monotonic send times and the achieved rate.
+    """
+    sent = []
+    interval = 1.0 / rate
+    start = time.monotonic()
+    for i in range(count):
+        target = start + i * interval
+        # sleep rather than spin where we can, so as not to starve the
+        # other threads in the process of the GIL
+        remaining = target - time.monotonic()
+        if remaining > 0.001:
+            time.sleep(remaining - 0.001)
+        while time.monotonic() < target:
+            pass
+        sent.append(time.monotonic())
+        command()
+    return sent, count / (time.monotonic() - start)
+
+
+def _report_rate(rate, achieved, sent, server):
+    """
+    Wait for the fake server to act on what was sent and report
+    """
+    deadline = time.monotonic() + 2.0
+    while time.monotonic() < deadline:
+        if len(server.log) >= len(sent) and not server.delayed:
+            break
+        time.sleep(0.01)
+
+    # the server logs in arrival order, which on loopback is send order
+    latencies = [entry[1] - s for (s, entry) in zip(sent, server.log)
+                 if entry[1] is not None]
+    print("  {:>6}/s target {:>8.0f}/s sent {:>6} of {} delivered".format(
+        rate, achieved, len(latencies), len(sent)))
+    report("send to processed", latencies)
+
+
+def _looper_for(server, classpath="looper.Channel"):
+    from looper import Loop
+    from looper import Looper
+
+    channel = get_class_from_string(classpath)(server.host, server.port)
+    looper = Looper(channel)
+    looper.add_loops([Loop(), Loop()], create=False)
+    return looper
+
+
+def bench_throughput(count, options):
+    """
+    Drive a Looper through each Channel transport at increasing command
+    rates against the fake SooperLooper.
+    """
+    from fakesl import FakeSooperLooper
+
+    print("Looper command throughput ({} commands per rate)".format(count))
+    for classpath in ["looper.Channel", "aio.AsyncChannel"]:
+        print(" {}".format(classpath))
+        server = FakeSooperLooper(loops=2, log=True, **options).start()
+        looper = _looper_for(server, classpath)
+        for rate in RATES:
+            time.sleep(0.1)
+            server.reset_log()
+            sent, achieved = _drive(
+                looper.selected.play_record_or_overdub, count, rate)
+            _report_rate(rate, achieved, sent, server)
+        if hasattr(looper.channel, "stop"):
+            looper.channel.stop()
+
+
+def bench_bridge(count, options):
+    """
+    Drive commands through the UDP bridge into a stomp command set at
+    increasing rates against the fake SooperLooper.
+    """
+    import bridge
+    from commands import StompCommandSet
+    from fakesl import FakeSooperLooper
+    import settings
+
+    print("Bridge command throughput ({} commands per rate)".format(count))
+    server = FakeSooperLooper(loops=2, log=True, **options).start()
+    looper = _looper_for(server)
+
+    # find a free port for the bridge
+    probe = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    settings.UDP_HOST, settings.UDP_PORT = probe.getsockname()
+    probe.close()
+
+    handler = bridge.BridgeInputHandler(StompCommandSet(looper))
+    threading.Thread(target=handler.start, daemon=True).start()
+    client = bridge.BridgeCommandSet(None)
+
+    for rate in RATES:
+        time.sleep(0.1)
+        server.reset_log()
+        sent, achieved = _drive(lambda: client.handle("0"), count, rate)
+        _report_rate(rate, achieved, sent, server)
+
+
+def bench_mux(count, options):
+    """
+    The bridge and a source on a thread of its own, like the keyboard
+    listener, driving a stomp command set each through one multiplexer
+    at once: time from input stamp to being handled, the threads the
+    command sets were called on, and events handled out of stamp order,
+    with no reorder window and with one.
+    """
+    from base import BaseInputHandler
+    import bridge
+    from commands import StompCommandSet
+    import events
+    from fakesl import FakeSooperLooper
+    import latency
+    import mux
+    import settings
+
+    rate = 500
+    server = FakeSooperLooper(loops=2, **options).start()
+    looper = _looper_for(server)
+    redo = events.code(events.TAP, events.KEY_CODES["2"])
+
+    class Recording(StompCommandSet):
+        def handle(self, event, stamp=None, value=None):
+            handled.append((threading.get_ident(), latency.now() - stamp))
+            super().handle(event, stamp, value)
+
+    class ThreadSource(BaseInputHandler):
+        def attach(self, mux):
+            self.mux = mux
+
+        def press(self):
+            self.mux.call_threadsafe(self.handle, redo, latency.now())
+
+    print("Two sources multiplexed, {} events each at {}/s".format(
+        count, rate))
+    for window in [0, 0.002]:
+        probe = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        settings.UDP_HOST, settings.UDP_PORT = probe.getsockname()
+        probe.close()
+
+        handled = []
+        source = ThreadSource(Recording(looper))
+        multiplexer = mux.Multiplexer(
+            [bridge.BridgeInputHandler(Recording(looper)), source], window)
+        thread = threading.Thread(target=multiplexer.start, daemon=True)
+        thread.start()
+        client = bridge.BridgeCommandSet(None)
+        time.sleep(0.1)
+
+        def both():
+            # one driving thread, so as not to have two spinning for the GIL
+            client.handle("1")
+            source.press()
+        _drive(both, count, rate)
+
+        deadline = time.monotonic() + 2.0
+        while len(handled) < 2 * count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        threads = set(ident for ident, delay in handled)
+        print("  window {:.0f}ms: handled {} of {}, on {} thread(s){}, "
+              "{} out of order".format(
+                  window * 1e3, len(handled), 2 * count, len(threads),
+                  " (the multiplexer's)" if threads == {thread.ident}
+                  else "", multiplexer.out_of_order))
+        report("stamp to handled", [delay / 1e9 for ident, delay in handled])
+
+
+def bench_dispatch(count, options):
+    """
+    Cost per input event of building its name and dispatching by string,
+    as command sets used to, against emitting an event code and using the
+    compiled dispatch table. Misses are events with no handler, such as
+    long presses on most keys.
+    """
+    from base import BaseCommandSet
+    import events
+    import metrics
+
+    class Commands(BaseCommandSet):
+        def handle_SPACE(self):
+            pass
+
+        def handle_double_SPACE(self):
+            pass
+
+    class StringCommands(Commands):
+        def __init__(self):
+            super().__init__(None)
+            self.commands = {"handle_" + name: fn
+                             for name, fn in self.commands.items()}
+
+        def handle(self, command, stamp=None):
+            fn = "handle_{}".format(command)
+            try:
+                self.commands[fn](self)
+            except KeyError:
+                return
+
+    by_code = Commands(None)
+    by_string = StringCommands()
+    space = events.KEY_CODES["SPACE"]
+
+    print("Dispatch cost per event ({} events)".format(count))
+    for name, fn in [
+            ("string hit", lambda i: by_string.handle(
+                "{}{}".format("double_", "SPACE"))),
+            ("string miss", lambda i: by_string.handle(
+                "{}{}".format("long_", "SPACE"))),
+            ("code hit", lambda i: by_code.handle(
+                events.code(events.DOUBLE, space))),
+            ("code miss", lambda i: by_code.handle(
+                events.code(events.LONG, space))),
+            ("name hit", lambda i: by_code.handle("double_SPACE"))]:
+        per_op = _time_per_op(fn, count)
+        print("  {:<32} {:8.3f}us/op".format(name, per_op * 1e6))
+
+    # as when settings.METRICS_PORT is set
+    metrics.enabled = True
+    try:
+        per_op = _time_per_op(
+            lambda i: by_code.handle(events.code(events.DOUBLE, space)),
+            count)
+    finally:
+        metrics.enabled = False
+    print("  {:<32} {:8.3f}us/op".format("code hit, metrics served",
+                                         per_op * 1e6))
+
+
+def _switch_trace(rand, count, bounce, glitch_rate):
+    """
+    Edges for `count` presses of one switch: single taps, quick double
+    taps and long holds. Each edge is followed by up to `bounce` seconds
+    of contact bounce, and while open the switch picks up sub-millisecond
+    glitches at `glitch_rate` per second. Returns (presses, edges) where
+    presses are the true press times.
+    """
+    ms = 1000000
+    presses = []
+    edges = []
+    t = 100 * ms
+    while len(presses) < count:
+        kind = rand.random()
+        if kind < 0.2:
+            # quick double tap
+            taps = [(t, t + rand.randint(30, 50) * ms),
+                    (t + rand.randint(80, 120) * ms, None)]
+            taps[1] = (taps[1][0], taps[1][0] + rand.randint(30, 50) * ms)
+        elif kind < 0.3:
+            taps = [(t, t + rand.randint(700, 1000) * ms)]
+        else:
+            taps = [(t, t + rand.randint(40, 150) * ms)]
+
+        for press, release in taps:
+            presses.append(press)
+            for edge, level in [(press, True), (release, False)]:
+                edges.append((edge, level))
+                bounces = sorted(rand.randint(edge + 1,
+                                              edge + int(bounce * 1e9))
+                                 for i in range(2 * rand.randint(0, 4)))
+                for j, b in enumerate(bounces):
+                    edges.append((b, level if j % 2 else not level))
+
+        # glitches while open until the next press
+        end = taps[-1][1] + 20 * ms
+        t = end + rand.randint(200, 500) * ms
+        for i in range(int((t - end) / 1e9 * glitch_rate)):
+            spike = rand.randint(end, t - 20 * ms)
+            edges.append((spike, True))
+            edges.append((spike + rand.randint(50, 500) * 1000, False))
+    edges.sort()
+    return presses, edges
+
+
+def _match_presses(presses, detected, window=0.05):
+    """
+    Pair true press times with detected (stamp, detected at) presses.
+    Returns latencies from press to detection, misses and false triggers.
+    """
+    window = int(window * 1e9)
+    latencies = []
+    i = 0
+    for press in presses:
+        while i < len(detected) and detected[i][0] < press - window:
+            i += 1
+        if i < len(detected) and detected[i][0] <= press + window:
+            latencies.append((detected[i][1] - press) / 1e9)
+            i += 1
+    matched = len(latencies)
+    return latencies, len(presses) - matched, len(detected) - matched
+
+
+def bench_debounce(count, options):
+    """
+    Replay synthetic bouncing, glitching switch traces through the
+    integrating debouncer and through a model of edge detection with a
+    200ms lockout (RPi.GPIO's bouncetime), reporting detection latency,
+    missed presses and false triggers. Then the cost of sampling.
+    """
+    import random
+
+    from debounce import Debouncer
+    from debounce import TraceBackend
+    import gestures
+
+    rand = random.Random(1)
+    presses, edges = _switch_trace(rand, max(1, count // 4),
+                                   bounce=0.003, glitch_rate=2)
+    print("Switch debounce ({} presses, {} edges)".format(
+        len(presses), len(edges)))
+
+    lockout = int(0.2 * 1e9)
+    detected = []
+    last = None
+    for t, closed in edges:
+        if closed and (last is None or t - last >= lockout):
+            detected.append((t, t))
+            last = t
+    latencies, missed, false = _match_presses(presses, detected)
+    print(" edge detect, 200ms lockout: {} missed, {} false triggers, "
+          "no releases".format(missed, false))
+    report("press latency", latencies, 1e3, "ms")
+
+    for settle in [0.002, 0.005, 0.01]:
+        backend = TraceBackend({36: edges})
+        detected = []
+        releases = []
+
+        def emit(action, channel, stamp):
+            if action == gestures.PRESS:
+                detected.append((stamp, backend.now()))
+            else:
+                releases.append(stamp)
+
+        Debouncer([36], emit, backend, sample_interval=0.001,
+                  settle_time=settle).run()
+        latencies, missed, false = _match_presses(presses, detected)
+        print(" integrator, 1ms samples, {:.0f}ms settle: {} missed, "
+              "{} false triggers, {} releases".format(
+                  settle * 1e3, missed, false, len(releases)))
+        report("press latency", latencies, 1e3, "ms")
+
+    backend = TraceBackend({channel: [] for channel in range(16)})
+    debouncer = Debouncer(range(16), lambda *args: None, backend,
+                          sample_interval=0.001, settle_time=0.005)
+    print("  {:<32} {:8.2f}us/sample".format(
+        "sampling 16 switches",
+        _time_per_op(debouncer.sample, count) * 1e6))
+
+
+def bench_midi(count, options):
+    """
+    Cost of the MIDI schedule heap as it fills. Then send notes, each
+    with its note off, through the JACK output engine at increasing
+    rates, stamped as if captured a random fraction of a period earlier,
+    counting xruns and measuring how late messages are written relative
+    to their target frames. That needs a running JACK server;
+    `jackd -d dummy` will do.
+    """
+    import random
+
+    import latency
+    from midi import FrameHeap
+    from midi import MidiEngine
+
+    rand = random.Random(1)
+    print("MIDI schedule push + pop ({} operations)".format(count))
+    for pending in [10, 100, 1000]:
+        heap = FrameHeap(pending + 1)
+        for i in range(pending):
+            heap.push(rand.randint(0, 1 << 40), i)
+
+        def push_pop(i):
+            heap.push(rand.randint(0, 1 << 40), i)
+            heap.pop()
+        print("  {:<32} {:8.2f}us/op".format(
+            "{} pending".format(pending), _time_per_op(push_pop, count) * 1e6))
+
+    try:
+        engine = MidiEngine("bench").start()
+    except Exception as e:
+        print("MIDI: JACK not available ({})".format(e))
+        return
+    period = engine.client.blocksize / engine.rate
+    print("JACK MIDI output ({} messages per rate, {} frames at {}Hz)".format(
+        count, engine.client.blocksize, engine.rate))
+
+    for rate in RATES:
+        engine.errors.clear()
+        xruns, late, dropped = engine.xruns, engine.late, engine.dropped
+
+        def send():
+            stamp = latency.now() - int(rand.random() * period * 1e9)
+            engine.note(0, 60, stamp=stamp, length=0.01)
+        sent, achieved = _drive(send, count, rate)
+        # let the last messages go out and be logged
+        time.sleep(0.2 + 2 * period)
+
+        errors = sorted(engine.errors)
+        print("  {:>6}/s target {:>8.0f}/s sent  xruns {}, late {}, "
+              "dropped {}".format(rate, achieved, engine.xruns - xruns,
+                                  engine.late - late,
+                                  engine.dropped - dropped))
+        report("frames late", errors, 1, "")
+    engine.client.deactivate()
+    engine.client.close()
+
+
+def bench_quantize(count, options):
+    """
+    Cost of adding and running timers as more are pending. Then quantize
+    commands to the cycle of a loop playing on the fake SooperLooper,
+    tracked through live state, and measure when they are acted on
+    against the true cycle boundary.
+    """
+    import random
+
+    from fakesl import FakeSooperLooper
+    from livestate import LoopStateStore
+    from looper import Channel
+    from looper import Loop
+    from looper import Looper
+    from quantize import QuantizedScheduler
+    from quantize import Timers
+    from scenes import Scene
+
+    rand = random.Random(1)
+    print("Timer add + run ({} operations)".format(count))
+    for pending in [10, 1000, 100000]:
+        timers = Timers()
+        for i in range(pending):
+            timers.add(1 + rand.random(), None)
+
+        def add_run(i):
+            timers.add(rand.random(), len)
+            for fn, args in timers.pop_due(0.5):
+                pass
+        print("  {:<32} {:8.2f}us/op".format(
+            "{} pending".format(pending), _time_per_op(add_run, count) * 1e6))
+
+    cycle = 0.2
+    trials = min(count, 25)
+    print("Quantized to cycle ({} commands, {:.0f}ms cycle)".format(
+        trials, cycle * 1e3))
+    server = FakeSooperLooper(loops=1, log=True, **options).start()
+    looper = Looper(Channel(server.host, server.port))
+    loop = Loop()
+    looper.add_loops([loop], master=loop, create=False)
+    LoopStateStore(looper).start()
+    looper.scheduler = QuantizedScheduler(looper).start()
+    # muting toggles without moving the loop's position
+    mute = Scene("mute", [("mute", [0])], looper.channel.templates)
+
+    fake = server.loops[0]
+    fake.hit("record", time.monotonic())
+    time.sleep(cycle)
+    fake.hit("record", time.monotonic())
+    loop.state = Loop.PLAYBACK
+    # let the position be reported
+    time.sleep(0.1)
+
+    errors = []
+    for i in range(trials):
+        server.reset_log()
+        looper.scheduler.at_cycle(looper.channel.fire, mute)
+        time.sleep(cycle * 1.5)
+        processed = server.log[-1][1] if server.log else None
+        if processed is None:
+            continue
+        cycles = (processed - fake.started) / cycle
+        errors.append((cycles - round(cycles)) * cycle)
+    print("  {} of {} acted on".format(len(errors), trials))
+    report("after boundary", [e for e in errors if e >= 0], 1e3, "ms")
+    report("before boundary", [-e for e in errors if e < 0], 1e3, "ms")
+
+
+SUITES = {
+    "channel": bench_channel,
+    "templates": bench_templates,
+    "startup": bench_startup,
+    "roles": bench_roles,
+    "group": bench_group,
+    "journal": bench_journal,
+    "metrics": bench_metrics,
+    "throughput": bench_throughput,
+    "bridge": bench_bridge,
+    "mux": bench_mux,
+    "dispatch": bench_dispatch,
+    "debounce": bench_debounce,
+    "midi": bench_midi,
+    "quantize": bench_quantize,
+}
+
+
+def cli_handler(suite="all", count=2000, latency=0, jitter=0, loss=0):
+    """
+    Use:
+
+    > ./bench.py [options]
+
+    --suite=<name>           - Suite to run, or 'all' (default: all)
+    --count=<n>              - Commands per measurement (default: 2000)
+    --latency=<ms>           - Fake SooperLooper added delay (default: 0)
+    --jitter=<ms>            - Fake SooperLooper random delay (default: 0)
+    --loss=<fraction>        - Fake SooperLooper packet loss (default: 0)
+    --help -h                - Show this help
+    """
+    count = int(count)
+    options = dict(latency=float(latency) / 1000,
+                   jitter=float(jitter) / 1000,
+                   loss=float(loss))
+    names = SUITES.keys() if suite == "all" else [suite]
+    for name in names:
+        SUITES[name](count, options)
+        print()
+
+
+if __name__ == '__main__':
+    optfn.run(cli_handler)
@@ -1,12 +1,33 @@
+"""
+Bridge between an input device on one host and the controller on
+another, over UDP. See bridgeproto for the wire format.
+"""
+import atexit
+import collections
+import selectors
 import socket
+import struct
 import sys
+import threading
+import time
 
 from base import BaseInputHandler
 from base import BaseCommandSet
+import bridgeproto
+from clocksync import ClockEstimator
+import events
+import latency
+import metrics
 import settings
 
 
 BUFFER_SIZE = 256
+LOCAL_ADDRESSES = ["127.0.0.1", "::1"]
+# transit times remembered per client to estimate how late a command is
+DELAY_WINDOW = 64
+# Linux can stamp datagrams with their arrival in the socket buffer
+KERNEL_TIMESTAMPS = hasattr(socket, "SO_TIMESTAMPNS")
+_timespec = struct.Struct("@qq")
 
 
 def _create_socket():
@@ -25,40 +46,522 @@ def _create_socket():
     return _socket, host, port
 
 
+class ClientSession(object):
+    """
+    What the server knows about one bridge client
+    """
+    def __init__(self, address):
+        self.address = address
+        self.local = address[0] in LOCAL_ADDRESSES
+        self.sequence = bridgeproto.SequenceTracker()
+        self.delays = collections.deque(maxlen=DELAY_WINDOW)
+        self.clock = ClockEstimator(max_rtt=settings.BRIDGE_MAX_RTT)
+        self.pings = 0
+        self.next_ping = 0
+        # latency.now() time of the last datagram from the client
+        self.last_seen = 0
+
+        self.expired = 0
+        self.rewritten = 0
+        self.coalesced = 0
+        # dropped for exceeding the per wake-up budget
+        self.dropped = 0
+        # acks and pings that couldn't be sent, e.g. with the socket's
+        # send buffer full
+        self.send_failures = 0
+        # datagrams taken in the current wake-up
+        self.batch = 0
+
+        self.messages = 0
+        # messages per second over the last complete second
+        self.rate = 0
+        self._window_start = 0
+        self._window_count = 0
+
+        # time from arrival in the socket buffer to dispatch, nanoseconds
+        self.queued = 0
+        self.queue_delay_total = 0
+        self.queue_delay_max = 0
+
+    def count_message(self, now):
+        self.messages += 1
+        self.batch += 1
+        if now - self._window_start >= 1000000000:
+            self.rate = self._window_count
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+
+    def count_queue_delay(self, delay):
+        self.queued += 1
+        self.queue_delay_total += delay
+        if delay > self.queue_delay_max:
+            self.queue_delay_max = delay
+
+    def stats(self):
+        """
+        Counters and rates for this client
+        """
+        return dict(
+            messages=self.messages,
+            rate=self.rate,
+            received=self.sequence.received,
+            duplicates=self.sequence.duplicates,
+            lost=self.sequence.lost,
+            dropped=self.dropped,
+            expired=self.expired,
+            rewritten=self.rewritten,
+            coalesced=self.coalesced,
+            send_failures=self.send_failures,
+            queue_delay_mean=(self.queue_delay_total / self.queued / 1e9
+                              if self.queued else 0),
+            queue_delay_max=self.queue_delay_max / 1e9)
+
+    def origin(self, stamp):
+        """
+        Convert a client stamp to our clock, or None if we can't
+        """
+        if self.local:
+            return stamp
+        if self.clock.good():
+            return self.clock.to_local(stamp)
+        return None
+
+    def age(self, stamp, received):
+        """
+        How late a command stamped `stamp` at the client has arrived, in
+        seconds. Without a good clock estimate for another host, this is
+        the delay over the quickest transit seen recently.
+        """
+        origin = self.origin(stamp)
+        if origin is not None:
+            return (received - origin) / 1e9
+        delay = received - stamp
+        self.delays.append(delay)
+        return (delay - min(self.delays)) / 1e9
+
+    def __str__(self):
+        return ("{}, dropped {}, expired {}, rewritten {}, coalesced {}, "
+                "send failures {}, {}/s, queue delay mean {:.3f}ms "
+                "max {:.3f}ms{}").format(
+                    self.sequence, self.dropped, self.expired,
+                    self.rewritten, self.coalesced, self.send_failures,
+                    self.rate,
+                    self.queue_delay_total / self.queued / 1e6
+                    if self.queued else 0,
+                    self.queue_delay_max / 1e6,
+                    "" if self.local else ", {}".format(self.clock))
+
+
 class BridgeInputHandler(BaseInputHandler):
     """
     An input handler that listens for commands sent over as UDP
     datagrams. Reflected into the supplied commandset.
+
+    Commands that arrive later than their deadline in
+    settings.BRIDGE_DEADLINES are dropped, or replaced as per
+    settings.BRIDGE_STALE_REWRITES. A backlog of navigation commands is
+    collapsed to its net effect.
+
+    If settings.BRIDGE_TARGET_LATENCY is set, OSC sent for a command is
+    timetagged to take effect that long after the command's origin on the
+    client, so that network jitter becomes a constant delay. That needs
+    each remote client's clock offset, which is estimated by pinging it.
+    Until the estimate is good, commands are sent to act immediately.
+
+    Any number of clients are served from one non-blocking socket. Each
+    wake-up takes up to settings.BRIDGE_MAX_BATCH waiting datagrams, and
+    when several clients are waiting, at most settings.BRIDGE_CLIENT_BUDGET
+    of those from any one of them; the rest of a flooding client's
+    datagrams are dropped unacked, so they are retransmitted later if
+    they matter.
     """
     def start(self):
+        self.open()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        while(True):
+            if self.selector.select(self._until_next_ping()):
+                self.process(self.receive_all())
+            self.send_pings()
+
+    def attach(self, mux):
+        """
+        Run in a multiplexer, which reads the socket and sends the pings
+        """
+        self.mux = mux
+        self.open()
+        mux.add_reader(self.socket,
+                       lambda: self.process(self.receive_all()))
+        mux.add_poller(lambda now: self._until_next_ping(),
+                       lambda now: self.send_pings())
+
+    def open(self):
         self.socket, host, port = _create_socket()
         self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        if KERNEL_TIMESTAMPS:
+            self.socket.setsockopt(socket.SOL_SOCKET,
+                                   socket.SO_TIMESTAMPNS, 1)
+        self.max_batch = settings.BRIDGE_MAX_BATCH
+        self.client_budget = settings.BRIDGE_CLIENT_BUDGET
+        self.budget = self.max_batch
+        # commands arrive as event codes where they have them
+        self.deadlines = events.by_code(settings.BRIDGE_DEADLINES)
+        self.rewrites = events.by_code(settings.BRIDGE_STALE_REWRITES,
+                                       values=True)
+        self.opposites = events.by_code(settings.BRIDGE_COALESCE,
+                                        values=True)
+        self.target_latency = settings.BRIDGE_TARGET_LATENCY
+        self.ping_interval = int(settings.BRIDGE_PING_INTERVAL * 1e9)
+        self.session_timeout = settings.BRIDGE_SESSION_TIMEOUT
+        if self.session_timeout is not None:
+            self.session_timeout = int(self.session_timeout * 1e9)
+        self.looper = getattr(self.command_set, "looper", None)
+        # client address -> ClientSession
+        self.sessions = {}
+        atexit.register(self.report)
 
-        while(True):
-            bytesAddressPair = self.socket.recvfrom(BUFFER_SIZE)
-            command = bytesAddressPair[0].decode()
+    def process(self, datagrams):
+        """
+        Vet a batch of datagrams and handle the commands in them
+        """
+        self.expire_sessions(latency.now())
+        for session in self.sessions.values():
+            session.batch = 0
+        # the budget only matters when clients are competing
+        addresses = set(address for datagram, address, received in datagrams)
+        self.budget = (self.client_budget if len(addresses) > 1
+                       else self.max_batch)
+
+        commands = []
+        for datagram, address, received in datagrams:
+            command = self.receive(datagram, address, received)
+            if command is not None:
+                commands.append(command)
+
+        for session, command, stamp, when, received in \
+                self.coalesce(commands):
+            if settings.DEBUG:
+                print("Message received over bridge: {}".format(
+                    events.name(command)))
+            session.count_queue_delay(latency.now() - received)
+            latency.record("queue", received)
+            if self.mux is None:
+                self.dispatch(command, stamp, when)
+            else:
+                self.mux.post(stamp, self.dispatch, command, stamp, when)
+
+    def dispatch(self, command, stamp, when):
+        """
+        Handle the command, timetagging any OSC sent for it to take effect
+        at `when` (our clock), if given and still in the future
+        """
+        if when is None or self.looper is None:
+            self.command_set.handle(command, stamp)
+            return
+
+        ahead = when - latency.now()
+        if ahead <= 0:
+            self.command_set.handle(command, stamp)
+            return
+        with self.looper.scheduled(time.time() + ahead / 1e9):
+            self.command_set.handle(command, stamp)
+
+    def send_pings(self):
+        """
+        Ping remote clients for clock estimates, often until the estimate
+        is good and then every settings.BRIDGE_PING_INTERVAL
+        """
+        now = latency.now()
+        self.expire_sessions(now)
+        for session in self.sessions.values():
+            if session.local or now < session.next_ping:
+                continue
+            session.pings = (session.pings + 1) & 0xFFFFFFFF
+            self.send(session, bridgeproto.encode_ping(session.pings, now))
+            interval = self.ping_interval
+            if not session.clock.good():
+                interval //= 10
+            session.next_ping = now + interval
+
+    def expire_sessions(self, now):
+        """
+        Forget clients not heard from, pongs included, for
+        settings.BRIDGE_SESSION_TIMEOUT, e.g. gone or reconnected from
+        another port, so that they are no longer pinged
+        """
+        if self.session_timeout is None:
+            return
+        idle = [address for address, session in self.sessions.items()
+                if now - session.last_seen > self.session_timeout]
+        for address in idle:
+            session = self.sessions.pop(address)
+            if settings.DEBUG:
+                print("Bridge client {}:{} idle, forgotten: {}".format(
+                    address[0], address[1], session))
 
+    def send(self, session, datagram):
+        """
+        Send to a client, counting rather than raising a failure: under a
+        flood the non-blocking socket's send buffer can fill, and a lost
+        ack or ping is made good by the client retransmitting or the
+        next ping
+        """
+        try:
+            self.socket.sendto(datagram, session.address)
+        except OSError:
+            session.send_failures += 1
+
+    def _until_next_ping(self):
+        """
+        Seconds until the next ping is due, or None if none are
+        """
+        pings = [session.next_ping for session in self.sessions.values()
+                 if not session.local]
+        if not pings:
+            return None
+        return max(0, min(pings) - latency.now()) / 1e9
+
+    def receive_all(self):
+        """
+        Take the datagrams waiting, up to settings.BRIDGE_MAX_BATCH, each
+        with the latency.now() time at which it arrived
+        """
+        datagrams = []
+        while len(datagrams) < self.max_batch:
+            try:
+                datagrams.append(self._recv())
+            except BlockingIOError:
+                break
+        return datagrams
+
+    def _recv(self):
+        if not KERNEL_TIMESTAMPS:
+            datagram, address = self.socket.recvfrom(BUFFER_SIZE)
+            return datagram, address, latency.now()
+
+        datagram, ancdata, flags, address = \
+            self.socket.recvmsg(BUFFER_SIZE, 64)
+        received = latency.now()
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SO_TIMESTAMPNS:
+                seconds, nanoseconds = _timespec.unpack_from(data)
+                # kernel stamps are wall clock: convert to monotonic
+                waited = time.time_ns() - (seconds * 1000000000 + nanoseconds)
+                received -= max(0, waited)
+        return datagram, address, received
+
+    def receive(self, datagram, address, received):
+        """
+        Decode, ack and vet a datagram. Returns (session, command, stamp,
+        when, received) for a command to be handled, else None.
+        """
+        frame = bridgeproto.decode(datagram)
+        if frame is None:
+            metrics.bridge_datagrams.inc("bad")
             if settings.DEBUG:
-                print("Message received over bridge: {}".format(command))
-            self.command_set.handle(command)
+                print("Bad datagram over bridge from {}".format(address))
+            return None
+
+        frame_type, sequence, stamp, command = frame
+        session = self.sessions.get(address)
+        if session is None:
+            session = self.sessions[address] = ClientSession(address)
+        session.last_seen = received
+
+        if session.batch >= self.budget:
+            session.dropped += 1
+            metrics.bridge_datagrams.inc("dropped")
+            return None
+        session.count_message(received)
+
+        if frame_type == bridgeproto.FRAME_PONG:
+            metrics.bridge_datagrams.inc("pong")
+            session.clock.add(stamp, command, received)
+            return None
+        if frame_type != bridgeproto.FRAME_COMMAND:
+            metrics.bridge_datagrams.inc("other")
+            return None
+
+        if sequence is not None:
+            # ack duplicates too: the first ack may have been lost
+            self.send(session, bridgeproto.encode_ack(sequence, stamp))
+            if not session.sequence.accept(sequence):
+                metrics.bridge_datagrams.inc("duplicate")
+                if settings.DEBUG:
+                    print("Duplicate over bridge: {} {}".format(
+                        sequence, events.name(command)))
+                return None
+
+        metrics.bridge_datagrams.inc("command")
+        if command is None:
+            return None
+        if stamp is None:
+            return session, command, received, None, received
+
+        command = self.expire(session, command,
+                              session.age(stamp, received))
+        if command is None:
+            return None
+
+        origin = session.origin(stamp)
+        if origin is None:
+            return session, command, received, None, received
+
+        latency.record("bridge", origin, received)
+        when = None
+        if self.target_latency is not None:
+            when = origin + int(self.target_latency * 1e9)
+        return session, command, origin, when, received
+
+    def expire(self, session, command, age):
+        """
+        Return the command to run given that it is `age` seconds late:
+        the command itself, its stale rewrite or None to drop it.
+        """
+        deadline = self.deadlines.get(command, self.deadlines.get("*"))
+        if deadline is None or age <= deadline:
+            return command
+
+        rewrite = self.rewrites.get(command)
+        if rewrite is None:
+            session.expired += 1
+        else:
+            session.rewritten += 1
+        if settings.DEBUG:
+            print("{} arrived {:.3f}s late, running {}".format(
+                events.name(command), age, events.name(rewrite)))
+        return rewrite
+
+    def coalesce(self, commands):
+        """
+        Collapse each run of navigation commands (e.g. UP, DOWN, DOWN) from
+        a client to its net effect (DOWN).
+        """
+        if len(commands) < 2:
+            return commands
+
+        result = []
+        for entry in commands:
+            session, command = entry[:2]
+            opposite = self.opposites.get(command)
+            if opposite is not None and result:
+                last_session, last_command = result[-1][:2]
+                if last_session is session and last_command == opposite:
+                    # cancel out
+                    result.pop()
+                    session.coalesced += 2
+                    continue
+            result.append(entry)
+        return result
+
+    def stats(self):
+        """
+        Per-client counters, keyed by "host:port"
+        """
+        return {"{}:{}".format(*address): session.stats()
+                for address, session in self.sessions.items()}
+
+    def report(self):
+        for address, session in self.sessions.items():
+            print("Bridge client {}:{}: {}".format(
+                address[0], address[1], session))
 
 
 class BridgeCommandSet(BaseCommandSet):
     """
     An input handler that receives from the stomp buttons and sends
-    commands over the UDP connection
+    commands over the UDP connection. Commands not acked by the server
+    within settings.BRIDGE_RETRANSMIT_TIMEOUT are sent again, up to
+    settings.BRIDGE_MAX_RETRIES times. Answers the server's clock pings.
     """
+    needs_looper = False
+
     def __init__(self, *args, **kwargs):
         # as we're a bridge we don't need to do the initialisation in
         # the base class
         self.socket, host, port = _create_socket()
+        # bound so that acks can be received before the first send
+        self.socket.bind(("", 0))
         self.address = (host, port)
 
-    def handle(self, command):
+        self.timeout = settings.BRIDGE_RETRANSMIT_TIMEOUT
+        self.max_retries = settings.BRIDGE_MAX_RETRIES
+        self.sequence = 0
+        # sequence -> [frame, last sent, retries]
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.sent = 0
+        self.retransmits = 0
+        self.failed = 0
+
+        threading.Thread(target=self._run,
+                         name="BridgeAcks",
+                         daemon=True).start()
+        atexit.register(self.report)
+
+    def handle(self, command, stamp=None, value=None):
         """
-        Get command from the input handler and pitch it over to the server
+        Get command from the input handler and pitch it over to the server.
+        Values of continuous controls aren't bridged.
         """
-        msg = str.encode(command)
+        if stamp is None:
+            stamp = latency.now()
+        metrics.events.inc(self.source)
+        with self.pending_lock:
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            frame = bridgeproto.encode_command(self.sequence, stamp, command)
+            self.pending[self.sequence] = [frame, time.monotonic(), 0]
+
         if settings.DEBUG:
-            print("Sending message over bridge: {}".format(command))
-        self.socket.sendto(msg, self.address)
+            print("Sending message over bridge: {}".format(
+                events.name(command)))
+        self.socket.sendto(frame, self.address)
+        self.sent += 1
+
+    def _run(self):
+        """
+        Receive acks and retransmit whatever has not been acked in time
+        """
+        self.socket.settimeout(self.timeout / 2)
+        while True:
+            try:
+                datagram, address = self.socket.recvfrom(BUFFER_SIZE)
+                frame = bridgeproto.decode(datagram)
+                if frame is None:
+                    pass
+                elif frame[0] == bridgeproto.FRAME_ACK:
+                    with self.pending_lock:
+                        self.pending.pop(frame[1], None)
+                elif frame[0] == bridgeproto.FRAME_PING:
+                    self.socket.sendto(
+                        bridgeproto.encode_pong(frame[1], frame[2],
+                                                latency.now()),
+                        address)
+            except socket.timeout:
+                pass
+            self._retransmit()
+
+    def _retransmit(self):
+        now = time.monotonic()
+        resend = []
+        with self.pending_lock:
+            for sequence, entry in list(self.pending.items()):
+                if now - entry[1] < self.timeout:
+                    continue
+                if entry[2] >= self.max_retries:
+                    del self.pending[sequence]
+                    self.failed += 1
+                    continue
+                entry[1] = now
+                entry[2] += 1
+                resend.append(entry[0])
+
+        for frame in resend:
+            self.socket.sendto(frame, self.address)
+            self.retransmits += 1
+
+    def report(self):
+        print("Bridge: sent {}, retransmits {}, failed {}".format(
+            self.sent, self.retransmits, self.failed))
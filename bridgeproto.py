@@ -0,0 +1,162 @@
+"""
+Bridge wire protocol
+
+Commands are sent as compact binary frames:
+
+    magic    B   0xB7, never the first byte of a plain text command
+    version  B
+    type     B   FRAME_COMMAND, FRAME_ACK, FRAME_PING or FRAME_PONG
+    flags    B
+    sequence I   per-client, wraps at 2**32
+    stamp    Q   client's latency.now() at input, in nanoseconds
+    code     H   event code (see events.py), or CODE_TEXT with the
+                 command following as UTF-8
+
+The server acks every command frame, duplicates included, echoing the
+sequence number, and the client retransmits any frame not acked in time.
+Older clients' plain text datagrams ("<command>" or
+"<command>@<stamp>") are still accepted.
+
+For clock synchronisation the server sends pings stamped with its own
+clock, which the client returns as pongs with its clock reading (Q)
+appended.
+"""
+import collections
+import struct
+
+import events
+
+
+MAGIC = 0xB7
+VERSION = 1
+
+FRAME_COMMAND = 1
+FRAME_ACK = 2
+FRAME_PING = 3
+FRAME_PONG = 4
+
+CODE_TEXT = 0xFFFF
+
+_header = struct.Struct(">BBBBIQH")
+HEADER_SIZE = _header.size
+_clock = struct.Struct(">Q")
+
+# duplicate suppression remembers this many recent sequence numbers
+SEQUENCE_WINDOW = 256
+
+
+def encode_command(sequence, stamp, command):
+    """
+    Command frame for an event code or a command name
+    """
+    if isinstance(command, int):
+        code = command
+    else:
+        code = events.encode(command)
+    if code is None:
+        return _header.pack(MAGIC, VERSION, FRAME_COMMAND, 0, sequence,
+                            stamp, CODE_TEXT) + command.encode()
+    return _header.pack(MAGIC, VERSION, FRAME_COMMAND, 0, sequence, stamp,
+                        code)
+
+
+def encode_ack(sequence, stamp):
+    return _header.pack(MAGIC, VERSION, FRAME_ACK, 0, sequence, stamp, 0)
+
+
+def encode_ping(sequence, stamp):
+    return _header.pack(MAGIC, VERSION, FRAME_PING, 0, sequence, stamp, 0)
+
+
+def encode_pong(sequence, stamp, clock):
+    return _header.pack(MAGIC, VERSION, FRAME_PONG, 0, sequence, stamp,
+                        0) + _clock.pack(clock)
+
+
+def decode(datagram):
+    """
+    Decode a datagram into (type, sequence, stamp, payload). The payload
+    is the command for command frames, as an event code where it has one,
+    and the client's clock reading for pongs. Plain text datagrams decode
+    as a command frame with no sequence number. Returns None if the
+    datagram can't be understood.
+    """
+    if datagram[:1] != b"\xb7":
+        try:
+            command, _, stamp = datagram.decode().partition("@")
+        except ValueError:
+            return None
+        code = events.encode(command)
+        try:
+            return (FRAME_COMMAND, None, int(stamp) if stamp else None,
+                    command if code is None else code)
+        except ValueError:
+            return None
+
+    if len(datagram) < HEADER_SIZE:
+        return None
+    magic, version, frame_type, flags, sequence, stamp, code = \
+        _header.unpack_from(datagram)
+    if version != VERSION:
+        return None
+
+    if frame_type == FRAME_PONG:
+        if len(datagram) < HEADER_SIZE + _clock.size:
+            return None
+        return (frame_type, sequence, stamp,
+                _clock.unpack_from(datagram, HEADER_SIZE)[0])
+    if frame_type != FRAME_COMMAND:
+        return frame_type, sequence, stamp, None
+    if code == CODE_TEXT:
+        return (frame_type, sequence, stamp,
+                datagram[HEADER_SIZE:].decode(errors="replace"))
+    return frame_type, sequence, stamp, code
+
+
+class SequenceTracker(object):
+    """
+    Server side view of one client's sequence numbers: spots duplicates
+    and counts gaps as lost until the missing frames turn up.
+    """
+    def __init__(self):
+        self.highest = None
+        self.recent = set()
+        self.order = collections.deque()
+
+        self.received = 0
+        self.duplicates = 0
+        self.lost = 0
+
+    def _remember(self, sequence):
+        self.recent.add(sequence)
+        self.order.append(sequence)
+        if len(self.order) > SEQUENCE_WINDOW:
+            self.recent.discard(self.order.popleft())
+
+    def accept(self, sequence):
+        """
+        Returns True if `sequence` has not been seen before
+        """
+        if sequence in self.recent:
+            self.duplicates += 1
+            return False
+
+        self.received += 1
+        self._remember(sequence)
+        if self.highest is None:
+            self.highest = sequence
+            return True
+
+        ahead = (sequence - self.highest) & 0xFFFFFFFF
+        if ahead < 0x80000000:
+            # newer: anything skipped over is lost for now
+            self.lost += ahead - 1
+            self.highest = sequence
+        elif self.lost > 0:
+            # a frame we had counted as lost
+            self.lost -= 1
+        return True
+
+    def __str__(self):
+        return "received {}, duplicates {}, lost {}".format(
+            self.received, self.duplicates, self.lost)
@@ -0,0 +1,78 @@
+"""
+Estimate of a bridge client's clock against ours
+
+The server pings each client with its own send time, the client answers
+with its clock reading, and the reply's arrival gives the round trip.
+Assuming the two legs take equally long, the client's clock offset is
+its reading less the mid-point of the round trip. As in NTP, the sample
+with the shortest round trip in a recent window is trusted most: it had
+the least queueing to skew it.
+"""
+import collections
+import statistics
+
+
+class ClockEstimator(object):
+    """
+    Offset of a remote monotonic clock from ours, both in nanoseconds
+    """
+    def __init__(self, window=16, min_samples=3, max_rtt=0.05):
+        # (rtt, offset)
+        self.samples = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+        self.max_rtt = int(max_rtt * 1e9)
+
+    def add(self, sent, remote, received):
+        """
+        Add a sample from a ping sent at `sent`, read by the remote end as
+        `remote` and answered at `received`
+        """
+        rtt = received - sent
+        if rtt < 0:
+            return
+        self.samples.append((rtt, remote - (sent + received) // 2))
+
+    @property
+    def best(self):
+        if not self.samples:
+            return None
+        return min(self.samples)
+
+    @property
+    def offset(self):
+        best = self.best
+        return None if best is None else best[1]
+
+    @property
+    def rtt(self):
+        best = self.best
+        return None if best is None else best[0]
+
+    @property
+    def jitter(self):
+        """
+        Standard deviation of the round trip times
+        """
+        if len(self.samples) < 2:
+            return 0
+        return statistics.pstdev(rtt for rtt, offset in self.samples)
+
+    def good(self):
+        """
+        True if the estimate is good enough to schedule by
+        """
+        return (len(self.samples) >= self.min_samples and
+                self.rtt <= self.max_rtt)
+
+    def to_local(self, remote):
+        """
+        Convert a remote clock reading to our clock
+        """
+        return remote - self.offset
+
+    def __str__(self):
+        if not self.samples:
+            return "no clock estimate"
+        return "offset {:.3f}ms, rtt {:.3f}ms, jitter {:.3f}ms{}".format(
+            self.offset / 1e6, self.rtt / 1e6, self.jitter / 1e6,
+            "" if self.good() else " (poor)")
@@ -1,83 +1,109 @@
 import sys
 
 from base import BaseCommandSet
+import settings
 
 
-class KeyCommandSet(BaseCommandSet):
-    def handle_double_SPACE(self):
-        """
-        Stop playback of selected loop. The first tap of the double tap would, if
-        playback was the prior state, have started recording/overdubbing. We
-        therefore stop that and discard the fraction of a second long layer first
-        before pausing everything.
-
-        If recording/overdubbing was happening prior to the double tap, the first
-        tap would have stopped that, and this will only pause everything, retaining
-        the layer that we had intentionally recorded.
-        """
-        self.looper.selected.stop_record_and_discard()
+class LooperCommandSet(BaseCommandSet):
+    """
+    Actions on the OSC looper, mapped to input events by a keymap
+    """
+    nested_actions = ("at_cycle", "at_bar")
+
+    def pause(self):
         self.looper.selected.pause()
 
-    def handle_SPACE(self):
+    def play_record_or_overdub(self):
         """
         Toggle though states
         """
         self.looper.selected.play_record_or_overdub()
 
-    def handle_DOWN(self):
+    def rollback_play_record_or_overdub(self):
+        """
+        Undo a tap that turned out to be the first of a double tap. If
+        playback was the prior state, the tap would have started
+        recording/overdubbing: stop that and discard the fraction of a
+        second long layer.
+
+        If recording/overdubbing was happening prior to the double tap, the
+        tap would have stopped that and there's nothing to undo: the layer
+        we had intentionally recorded is retained.
+        """
+        self.looper.selected.stop_record_and_discard()
+
+    def pause_all(self):
+        """
+        Pause every loop playing, or resume those this paused
+        """
+        self.looper.toggle_pause_all()
+
+    def select_next(self):
         self.looper.select_next()
 
-    def handle_UP(self):
+    def select_previous(self):
         self.looper.select_previous()
 
-    def handle_R(self):
+    def record(self):
         self.looper.selected.record()
 
-    def handle_U(self):
-        self.looper.selected.undo_all()
-
-    def handle_z(self):
-        """
-        As "U" but easier to hit when using keyboard with feet :D
-        """
+    def undo_all(self):
         self.looper.selected.undo_all()
 
-    def handle_u(self):
+    def undo(self):
         self.looper.selected.undo()
 
-    def handle_r(self):
+    def redo(self):
         self.looper.selected.redo()
 
-    def handle_q(self):
-        # osc_terminate()
-        self.handler.flush_keys()
-        self.handler.set_echo()
-        sys.exit(0)
-
+    def scene(self, name):
+        self.looper.fire_scene(name)
 
-class StompCommandSet(BaseCommandSet):
-    def handle_0(self):
-        self.looper.selected.play_record_or_overdub()
-
-    def handle_double_0_DISABLE(self):
+    def at_cycle(self, action, *args):
+        """
+        Run another action, with any arguments, to take effect at the
+        start of the next cycle of the sync loop, e.g.
+        ["at_cycle", "scene", "breakdown"]
         """
-        Stop playback of selected loop. The first tap of the double tap would,
-        if playback was the prior state, have started recording/overdubbing. We
-        therefore stop that and discard the fraction of a second long layer
-        first before pausing everything.
+        self._quantized("at_cycle", action, args)
 
-        If recording/overdubbing was happening prior to the double tap, the
-        first tap would have stopped that, and this will only pause everything,
-        retaining the layer that we had intentionally recorded.
+    def at_bar(self, action, *args):
         """
-        self.looper.selected.stop_record_and_discard()
-        self.looper.selected.pause()
+        As at_cycle, but at the start of the next bar
+        """
+        self._quantized("at_bar", action, args)
+
+    def _quantized(self, when, action, args):
+        fn = getattr(self, action, None)
+        if fn is None:
+            if settings.DEBUG:
+                print("Could not find action: {}".format(action))
+            return
+        scheduler = self.looper.scheduler
+        if scheduler is None:
+            # nothing knows where the loop is
+            fn(*args)
+        else:
+            getattr(scheduler, when)(self.perform, fn, *args)
+
+    def set_control(self, control):
+        """
+        Set a control of the selected loop from a continuous input such
+        as an expression pedal, 0-127 scaled to 0-1
+        """
+        if self.value is not None:
+            self.looper.channel.set_properties({control: self.value / 127.0})
 
-    def handle_1(self):
-        self.looper.selected.undo()
 
-    def handle_double_1(self):
-        self.looper.selected.undo_all()
+class KeyCommandSet(LooperCommandSet):
+    keymap = "keymaps/keys.json"
 
-    def handle_2(self):
-        self.looper.selected.redo()
+    def quit(self):
+        # osc_terminate()
+        self.handler.flush_keys()
+        self.handler.set_echo()
+        sys.exit(0)
+
+
+class StompCommandSet(LooperCommandSet):
+    keymap = "keymaps/stomp.json"
@@ -0,0 +1,170 @@
+"""
+Software debounce for momentary switches
+
+Rather than have the GPIO library call back on one edge and then ignore
+the switch for a long lockout, every switch is sampled at a fixed rate
+and fed through an integrator: a counter that steps towards the level
+read each sample, so that contact bounce and short glitches cancel out.
+A switch only changes state when the counter reaches its end stop,
+`settle_time` after the level settles. Both edges are reported, with
+the time the change began, as gestures.PRESS and gestures.RELEASE.
+
+Where the levels come from is up to a backend: the Pi's GPIO pins, or a
+recorded (or synthesised) trace of edges replayed against a simulated
+clock so that debouncing can be measured anywhere.
+"""
+import bisect
+import time
+
+import gestures
+import latency
+import settings
+
+
+class SwitchBackend(object):
+    """
+    Source of switch levels. Times are latency.now() nanoseconds.
+    """
+    def setup(self, channels):
+        pass
+
+    def read(self, channel):
+        """
+        True if the switch on `channel` is closed
+        """
+        raise NotImplementedError
+
+    def now(self):
+        return latency.now()
+
+    def wait_until(self, when):
+        delay = when - latency.now()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+
+    def finished(self):
+        return False
+
+
+class GPIOBackend(SwitchBackend):
+    """
+    Switches on Raspberry Pi GPIO pins, pulled up so that a closed switch
+    reads low
+    """
+    def setup(self, channels):
+        import RPi.GPIO as GPIO
+
+        GPIO.setmode(GPIO.BOARD)
+        for channel in channels:
+            GPIO.setup(channel, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self.input = GPIO.input
+        self.low = GPIO.LOW
+
+    def read(self, channel):
+        return self.input(channel) == self.low
+
+
+class TraceBackend(SwitchBackend):
+    """
+    Replays traces of edges, a dict of channel -> [(time, closed), ...]
+    in time order, against a simulated clock starting at 0. Switches are
+    open until their first edge, and the replay runs on `tail` seconds
+    past the last.
+    """
+    def __init__(self, traces, tail=1.0):
+        self.times = {}
+        self.levels = {}
+        for channel, edges in traces.items():
+            self.times[channel] = [t for t, closed in edges]
+            self.levels[channel] = [closed for t, closed in edges]
+        self.end = max([times[-1] for times in self.times.values()
+                        if times] or [0]) + int(tail * 1e9)
+        self.clock = 0
+
+    def read(self, channel):
+        i = bisect.bisect_right(self.times[channel], self.clock)
+        return i > 0 and self.levels[channel][i - 1]
+
+    def now(self):
+        return self.clock
+
+    def wait_until(self, when):
+        self.clock = max(self.clock, when)
+
+    def finished(self):
+        return self.clock > self.end
+
+
+class Debouncer(object):
+    """
+    Integrating debouncer for a list of switch channels, calling
+    `emit(gestures.PRESS or gestures.RELEASE, channel, stamp)` on each
+    debounced change, where `stamp` is when the change began
+    """
+    def __init__(self, channels, emit, backend, sample_interval=None,
+                 settle_time=None):
+        if sample_interval is None:
+            sample_interval = settings.SWITCH_SAMPLE_INTERVAL
+        if settle_time is None:
+            settle_time = settings.SWITCH_SETTLE_TIME
+        self.channels = list(channels)
+        self.emit = emit
+        self.backend = backend
+        self.interval = int(sample_interval * 1e9)
+        # samples of a steady level needed to change state
+        self.limit = max(1, int(round(settle_time / sample_interval)))
+
+        count = len(self.channels)
+        self.counts = [0] * count
+        self.closed = [False] * count
+        # when the counter last left its end stop
+        self.since = [None] * count
+
+    def sample(self, now):
+        limit = self.limit
+        for i, channel in enumerate(self.channels):
+            count = self.counts[i]
+            if self.backend.read(channel):
+                if count == limit:
+                    continue
+                count += 1
+            else:
+                if count == 0:
+                    continue
+                count -= 1
+            self.counts[i] = count
+            since = self.since[i]
+            if since is None:
+                since = now
+
+            if self.closed[i]:
+                if count == 0:
+                    self.closed[i] = False
+                    self.emit(gestures.RELEASE, channel, since)
+                    self.since[i] = None
+                elif count == limit:
+                    self.since[i] = None
+                elif self.since[i] is None:
+                    self.since[i] = now
+            else:
+                if count == limit:
+                    self.closed[i] = True
+                    self.emit(gestures.PRESS, channel, since)
+                    self.since[i] = None
+                elif count == 0:
+                    self.since[i] = None
+                elif self.since[i] is None:
+                    self.since[i] = now
+
+    def run(self):
+        """
+        Sample until the backend is finished, which for real switches is
+        never
+        """
+        self.backend.setup(self.channels)
+        due = self.backend.now()
+        while not self.backend.finished():
+            self.sample(self.backend.now())
+            # don't try to catch up on samples missed
+            due = max(due + self.interval, self.backend.now())
+            self.backend.wait_until(due)
@@ -0,0 +1,72 @@
+"""
+Input events
+
+Input handlers describe what happened as an event code: a gesture (tap,
+double or triple tap, long press, release, change of value) and a key
+packed into one small integer,
+
+    code = gesture << 8 | key
+
+Command sets resolve codes through a table built once per class, so no
+strings are built or parsed per event. The event's name, e.g.
+"double_SPACE", names its handler method (handle_double_SPACE) and is
+how events are written in settings.
+"""
+TAP, DOUBLE, LONG, TRIPLE, RELEASE, CHANGE = range(6)
+
+# name prefix for each gesture. RELEASE is the release ending a long
+# press, CHANGE a new value from a continuous control such as a pedal.
+GESTURES = ["", "double_", "long_", "triple_", "release_", "change_"]
+KEYS = ([str(i) for i in range(10)] +
+        ["SPACE", "UP", "DOWN", "LEFT", "RIGHT", "PLUS", "MINUS"] +
+        [chr(c) for c in range(ord("a"), ord("z") + 1)] +
+        [chr(c) for c in range(ord("A"), ord("Z") + 1)] +
+        ["PEDAL{}".format(i) for i in range(8)])
+
+# codes go over the bridge, so are stable so long as GESTURES and KEYS
+# are only ever appended to
+KEY_CODES = {key: k for k, key in enumerate(KEYS)}
+EVENT_CODES = {prefix + key: (g << 8) | k
+               for g, prefix in enumerate(GESTURES)
+               for k, key in enumerate(KEYS)}
+EVENT_NAMES = {code: name for name, code in EVENT_CODES.items()}
+
+
+def code(gesture, key):
+    """
+    Event code for a gesture on a key code
+    """
+    return (gesture << 8) | key
+
+
+def encode(name):
+    """
+    Event code for an event name, or None if it has none
+    """
+    return EVENT_CODES.get(name)
+
+
+def name(event):
+    """
+    Name of an event given by code or name
+    """
+    if isinstance(event, int):
+        return EVENT_NAMES.get(event, str(event))
+    return event
+
+
+def by_code(mapping, values=False):
+    """
+    Copy of a dict keyed by event names with event codes added as keys, so
+    it can be looked up with either. If `values`, event names among the
+    values are converted to codes too.
+    """
+    result = {}
+    for key, value in mapping.items():
+        if values:
+            value = EVENT_CODES.get(value, value)
+        result[key] = value
+        code = EVENT_CODES.get(key)
+        if code is not None:
+            result[code] = value
+    return result
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+A stand-in for SooperLooper, for measuring the controller without
+SooperLooper and JACK.
+
+Emulates the OSC endpoints the controller uses: /sl/N/hit, /sl/N/set,
+/sl/N/get, /sl/N/register_auto_update, /set, /loop_add, /loop_del and
+/ping. Loop state and layers are modelled closely enough for the
+controller's view of them to be checked, and artificial latency, jitter
+and packet loss can be added to what arrives.
+
+> ./fakesl.py [--port=9951] [--latency=<ms>] [--jitter=<ms>] [--loss=<0..1>]
+"""
+import heapq
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+from osc4py3 import oscbuildparse
+import optfn
+
+
+# how often auto-updates are checked for
+UPDATE_TICK = 0.01 # seconds
+
+
+class FakeLoop(object):
+    """
+    A loop with SooperLooper's state codes
+    """
+    OFF, WAIT_START, RECORDING, WAIT_STOP, PLAYING, OVERDUBBING = range(6)
+    MUTED = 10
+    PAUSED = 14
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.controls = {}
+        self.hits = []
+
+        self.state = self.OFF
+        self.layers = 0
+        self.current_layer = 0
+        self.loop_len = 0.0
+        # when the current cycle (or recording) started
+        self.started = 0.0
+        self.paused_pos = 0.0
+
+        # (control, url, path) -> [interval, last sent, last value]
+        self.subscriptions = {}
+
+    def loop_pos(self, now):
+        if self.state == self.PAUSED:
+            return self.paused_pos
+        if self.state == self.RECORDING:
+            return now - self.started
+        if self.loop_len <= 0 or self.state == self.OFF:
+            return 0.0
+        return (now - self.started) % self.loop_len
+
+    def get(self, control, now):
+        if control == "state":
+            return float(self.state)
+        if control == "loop_pos":
+            return self.loop_pos(now)
+        if control == "loop_len":
+            return self.loop_len
+        if control == "waiting":
+            return 0.0
+        return float(self.controls.get(control, 0.0))
+
+    def hit(self, command, now):
+        self.hits.append(command)
+
+        if command == "record":
+            if self.state == self.RECORDING:
+                self.loop_len = now - self.started
+                self.started = now
+                self.state = self.PLAYING
+            else:
+                self.started = now
+                self.layers = self.current_layer = 1
+                self.state = self.RECORDING
+
+        elif command == "overdub":
+            if self.state == self.OVERDUBBING:
+                self.state = self.PLAYING
+            elif self.state in [self.PLAYING, self.MUTED]:
+                self.current_layer += 1
+                self.layers = self.current_layer
+                self.state = self.OVERDUBBING
+
+        elif command == "undo":
+            # the base layer is only removed by undo_all
+            if self.current_layer > 1:
+                self.current_layer -= 1
+            if self.state == self.OVERDUBBING:
+                self.state = self.PLAYING
+
+        elif command == "redo":
+            if self.current_layer < self.layers:
+                self.current_layer += 1
+
+        elif command == "undo_all":
+            self.current_layer = 0
+            self.loop_len = 0.0
+            self.state = self.OFF
+
+        elif command == "pause":
+            if self.state == self.PAUSED:
+                self.started = now - self.paused_pos
+                self.state = self.PLAYING
+            elif self.state != self.OFF:
+                self.paused_pos = self.loop_pos(now)
+                self.state = self.PAUSED
+
+        elif command == "trigger":
+            if self.loop_len > 0:
+                self.started = now
+                self.state = self.PLAYING
+
+        elif command == "mute":
+            if self.state == self.MUTED:
+                self.state = self.PLAYING
+            elif self.state == self.PLAYING:
+                self.state = self.MUTED
+
+
+class FakeSooperLooper(object):
+    """
+    OSC UDP server emulating SooperLooper.
+
+    `loops` is the number of (mono) loops the server starts with.
+    `loop_add_delay` is how long a new loop takes to appear, as
+    SooperLooper creates loops asynchronously. Each datagram received is
+    delayed by `latency` plus up to `jitter` seconds, or dropped with
+    probability `loss`.
+
+    If `log` is set, every datagram received is logged, in arrival order,
+    as [received, processed] monotonic times; processed stays None if the
+    datagram was dropped.
+    """
+    VERSION = "1.7.8"
+
+    def __init__(self, host="127.0.0.1", port=0, loops=0,
+                 loop_add_delay=0.0, latency=0.0, jitter=0.0, loss=0.0,
+                 seed=None, log=False):
+        self.socket = socket.socket(family=socket.AF_INET,
+                                    type=socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.host, self.port = self.socket.getsockname()
+        self.loop_add_delay = loop_add_delay
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        self.loops = [FakeLoop(1) for i in range(loops)]
+        # (time at which the loop exists, channels)
+        self.pending_loops = []
+        self.globals = {}
+        # (due time, sequence, packet, log entry)
+        self.delayed = []
+        self.log = [] if log else None
+        self.received = 0
+        self.dropped = 0
+        self.ignored = 0
+        self._sequence = 0
+
+        self.handlers = {
+            "/ping": self.handle_ping,
+            "/loop_add": self.handle_loop_add,
+            "/loop_del": self.handle_loop_del,
+            "/set": self.handle_global_set,
+        }
+        self.loop_handlers = {
+            "hit": self.handle_hit,
+            "set": self.handle_set,
+            "get": self.handle_get,
+            "register_auto_update": self.handle_register_auto_update,
+            "unregister_auto_update": self.handle_unregister_auto_update,
+        }
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="FakeSooperLooper",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def reset_log(self):
+        if self.log is not None:
+            self.log = []
+
+    def _run(self):
+        while True:
+            timeout = UPDATE_TICK
+            if self.delayed:
+                timeout = min(timeout,
+                              max(0, self.delayed[0][0] - time.monotonic()))
+            self.socket.settimeout(timeout)
+            try:
+                data, addr = self.socket.recvfrom(65536)
+                self._receive(data)
+            except (socket.timeout, BlockingIOError):
+                pass
+
+            self._process_due()
+            self._send_updates()
+
+    def _receive(self, data):
+        now = time.monotonic()
+        entry = [now, None]
+        if self.log is not None:
+            self.log.append(entry)
+
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        packet = oscbuildparse.decode_packet(data)
+        due = now + self.latency + self.random.random() * self.jitter
+        due = max(due, self._timetag_due(packet, now))
+        if due <= now:
+            self.handle_packet(packet, entry)
+        else:
+            self._sequence += 1
+            heapq.heappush(self.delayed, (due, self._sequence, packet, entry))
+
+    def _timetag_due(self, packet, now):
+        """
+        Monotonic time at which a bundle's timetag says to act on it
+        """
+        if not isinstance(packet, oscbuildparse.OSCBundle):
+            return 0
+        if packet.timetag == oscbuildparse.OSC_IMMEDIATELY:
+            return 0
+        unixtime = oscbuildparse.timetag2unixtime(packet.timetag)
+        return now + (unixtime - time.time())
+
+    def _process_due(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            due, sequence, packet, entry = heapq.heappop(self.delayed)
+            self.handle_packet(packet, entry)
+
+    def handle_packet(self, packet, entry=None):
+        if isinstance(packet, oscbuildparse.OSCBundle):
+            messages = packet.elements
+        else:
+            messages = [packet]
+        for msg in messages:
+            self.received += 1
+            self.dispatch(msg)
+        if entry is not None:
+            entry[1] = time.monotonic()
+
+    def handle_datagram(self, data, addr=None):
+        self.handle_packet(oscbuildparse.decode_packet(data))
+
+    def dispatch(self, msg):
+        self._create_pending()
+        handler = self.handlers.get(msg.addrpattern)
+        if handler is not None:
+            handler(*msg.arguments)
+            return
+
+        parts = msg.addrpattern.split("/")
+        # /sl/<loop>/<command>
+        if len(parts) == 4 and parts[1] == "sl":
+            handler = self.loop_handlers.get(parts[3])
+            if handler is not None:
+                for index in self._loops(int(parts[2])):
+                    handler(index, self.loops[index], *msg.arguments)
+                return
+        self.ignored += 1
+
+    def _create_pending(self):
+        now = time.monotonic()
+        while self.pending_loops and self.pending_loops[0][0] <= now:
+            ready, channels = self.pending_loops.pop(0)
+            self.loops.append(FakeLoop(channels))
+
+    def _loops(self, index):
+        """
+        Indexes of the loops addressed by `index`: -1 is all, -3 the
+        selected loop
+        """
+        if index == -1:
+            return range(len(self.loops))
+        if index == -3:
+            index = int(self.globals.get("selected_loop_num", 0))
+        if 0 <= index < len(self.loops):
+            return [index]
+        self.ignored += 1
+        return []
+
+    def reply(self, url, path, typetags, args):
+        """
+        Send a reply to an osc.udp://host:port/ url
+        """
+        target = urlparse(url)
+        msg = oscbuildparse.OSCMessage(path, typetags, args)
+        self.socket.sendto(oscbuildparse.encode_packet(msg),
+                           (target.hostname, target.port))
+
+    def _send_updates(self):
+        now = time.monotonic()
+        for index, loop in enumerate(self.loops):
+            for key, subscription in loop.subscriptions.items():
+                interval, last_sent, last_value = subscription
+                if now - last_sent < interval:
+                    continue
+                control, url, path = key
+                value = loop.get(control, now)
+                if value == last_value:
+                    continue
+                self.reply(url, path, ",isf", [index, control, value])
+                subscription[1] = now
+                subscription[2] = value
+
+    def handle_ping(self, url, path):
+        self.reply(url, path, ",ssi",
+                   ["osc.udp://{}:{}/".format(self.host, self.port),
+                    self.VERSION, len(self.loops)])
+
+    def handle_loop_add(self, channels, length):
+        self.pending_loops.append(
+            (time.monotonic() + self.loop_add_delay, channels))
+
+    def handle_loop_del(self, index):
+        if not self.loops:
+            return
+        if index == -1:
+            self.loops.pop()
+        elif 0 <= index < len(self.loops):
+            self.loops.pop(index)
+
+    def handle_global_set(self, control, value):
+        self.globals[control] = value
+
+    def handle_hit(self, index, loop, command):
+        loop.hit(command, time.monotonic())
+
+    def handle_set(self, index, loop, control, value):
+        loop.controls[control] = value
+
+    def handle_get(self, index, loop, control, url, path):
+        self.reply(url, path, ",isf",
+                   [index, control, loop.get(control, time.monotonic())])
+
+    def handle_register_auto_update(self, index, loop, control, interval,
+                                    url, path):
+        loop.subscriptions[(control, url, path)] = \
+            [interval / 1000.0, 0.0, None]
+
+    def handle_unregister_auto_update(self, index, loop, control, url, path):
+        loop.subscriptions.pop((control, url, path), None)
+
+
+def cli_handler(host="127.0.0.1", port=9951, loops=0, latency=0, jitter=0,
+                loss=0):
+    """
+    Use:
+
+    > ./fakesl.py [options]
+
+    --host=<host>            - Address to listen on (default: 127.0.0.1)
+    --port=<port>            - Port to listen on (default: 9951)
+    --loops=<n>              - Loops to start with (default: 0)
+    --latency=<ms>           - Delay added to each datagram (default: 0)
+    --jitter=<ms>            - Random extra delay up to this (default: 0)
+    --loss=<fraction>        - Proportion of datagrams dropped (default: 0)
+    --help -h                - Show this help
+    """
+    server = FakeSooperLooper(host, int(port), loops=int(loops),
+                              latency=float(latency) / 1000,
+                              jitter=float(jitter) / 1000,
+                              loss=float(loss))
+    print("Fake SooperLooper on {}:{}".format(server.host, server.port))
+    server._run()
+
+
+if __name__ == '__main__':
+    optfn.run(cli_handler)
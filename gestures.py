@@ -0,0 +1,179 @@
+"""
+Gesture recognition shared by all inputs
+
+The engine turns presses and releases of keys (or switches) into events:
+tap, double tap, triple tap, long press (fired while the key is still
+held) and the release that ends a long press. Taps are never held back
+to see whether another follows: the first press of a double tap fires a
+tap at once and the second fires the double.
+
+The double's handler therefore runs after the tap's has already acted.
+A command set can declare a rollback_<action> method for a tap action
+that must be undone when the tap turns out to be the start of a double
+(or a double the start of a triple); the dispatch table runs it before
+the upgraded action. A double tap with no action mapped runs the tap's
+again, and a triple tap with none the double's, or failing that the
+tap's.
+
+All times are latency.now() style monotonic nanoseconds passed in by the
+caller, so the engine can be driven with synthetic timestamps.
+"""
+import queue
+
+import events
+import latency
+
+
+PRESS = 0
+RELEASE = 1
+# a press with no release to follow, e.g. from a switch only reporting
+# its closing
+CLICK = 2
+
+# gesture for the number of taps in quick succession
+TAPS = [None, events.TAP, events.DOUBLE, events.TRIPLE]
+# the gesture each multiple tap upgrades
+UPGRADES = [(events.DOUBLE, events.TAP), (events.TRIPLE, events.DOUBLE)]
+
+
+def _upgraded(rollback, fn):
+    def handler(self):
+        rollback(self)
+        return fn(self)
+    handler.__name__ = fn.__name__
+    return handler
+
+
+def dispatch_table(command_set_class, commands):
+    """
+    Dispatch table, keyed by event code and name, for a dict of event
+    name -> handler function. Handlers for upgraded gestures run the
+    rollback of the gesture they upgrade first.
+    """
+    mapped = commands
+    commands = dict(commands)
+    for key in events.KEYS:
+        tap = mapped.get(key)
+        for gesture, previous in UPGRADES:
+            name = events.GESTURES[gesture] + key
+            fn = mapped.get(name)
+            if fn is None:
+                fallback = mapped.get(events.GESTURES[previous] + key, tap)
+                if fallback is not None:
+                    commands[name] = fallback
+                continue
+            before = commands.get(events.GESTURES[previous] + key)
+            if before is None:
+                continue
+            rollback = getattr(command_set_class,
+                               "rollback_" + before.__name__, None)
+            if rollback is not None:
+                commands[name] = _upgraded(rollback, fn)
+    return events.by_code(commands)
+
+
+class KeyState(object):
+    __slots__ = ["down", "pressed", "taps", "held"]
+
+    def __init__(self):
+        self.down = False
+        # when the key was last pressed
+        self.pressed = None
+        # presses in the current run of taps
+        self.taps = 0
+        # a long press has fired for the current press
+        self.held = False
+
+
+class GestureEngine(object):
+    """
+    Recognise gestures per key. `emit(code, stamp)` is called with the
+    event code of each and the time of the press or release behind it.
+    Intervals are in seconds.
+    """
+    def __init__(self, emit, double_tap_interval, long_press_interval):
+        self.emit = emit
+        self.double_tap = int(double_tap_interval * 1e9)
+        self.long_press = int(long_press_interval * 1e9)
+        # key code -> KeyState
+        self.keys = {}
+
+    def press(self, key, now):
+        state = self.keys.get(key)
+        if state is None:
+            state = self.keys[key] = KeyState()
+        if state.down:
+            # auto-repeat
+            return
+        if (state.taps and state.taps < len(TAPS) - 1 and
+                now - state.pressed <= self.double_tap):
+            state.taps += 1
+        else:
+            state.taps = 1
+        state.down = True
+        state.pressed = now
+        state.held = False
+        self.emit(events.code(TAPS[state.taps], key), now)
+
+    def release(self, key, now):
+        state = self.keys.get(key)
+        if state is None or not state.down:
+            return
+        # in case poll() wasn't called in time
+        self.poll(now)
+        state.down = False
+        if state.held:
+            self.emit(events.code(events.RELEASE, key), now)
+
+    def click(self, key, now):
+        self.press(key, now)
+        self.release(key, now)
+
+    def poll(self, now):
+        """
+        Fire long presses that are due at `now`
+        """
+        for key, state in self.keys.items():
+            if (state.down and not state.held and
+                    now - state.pressed >= self.long_press):
+                state.held = True
+                # a long press ends any run of taps
+                state.taps = 0
+                self.emit(events.code(events.LONG, key), now)
+
+    def timeout(self, now):
+        """
+        Seconds until the next long press could fire, or None
+        """
+        due = [state.pressed + self.long_press
+               for state in self.keys.values()
+               if state.down and not state.held]
+        if not due:
+            return None
+        return max(0, min(due) - now) / 1e9
+
+    def run(self, q):
+        """
+        Feed (PRESS, RELEASE or CLICK, key code, stamp) items from a queue
+        into the engine. Never returns.
+        """
+        while True:
+            try:
+                action, key, stamp = q.get(
+                    timeout=self.timeout(latency.now()))
+            except queue.Empty:
+                self.poll(latency.now())
+                continue
+            self.feed(action, key, stamp)
+
+    def feed(self, action, key, stamp):
+        """
+        Feed in a PRESS, RELEASE or CLICK of a key at `stamp`
+        """
+        latency.record("queue", stamp)
+        if action == PRESS:
+            self.press(key, stamp)
+        elif action == RELEASE:
+            self.release(key, stamp)
+        else:
+            self.click(key, stamp)
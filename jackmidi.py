@@ -27,40 +27,247 @@
 #
 # https://github.com/spatialaudio/jackclient-python/issues/47
 #
-import jack
-import queue
+# The sending itself is done by midi.MidiEngine, which hands messages to
+# the JACK thread through a lock-free ring buffer.
+#
+import struct
 import time
 
+from base import BaseInputHandler
+import events
+import gestures
+import latency
+from midi import MidiEngine
+import settings
+
+
+NOTE = 0
+CC = 1
+PROGRAM = 2
+KINDS = {"note": NOTE, "cc": CC, "pc": PROGRAM}
+# table index: kind << 11 | channel << 7 | note/controller/program
+TABLE_SIZE = 3 << 11
+
+# as gestures.PRESS, RELEASE and CLICK, plus
+VALUE = 3
+
+# JACK frame, action, key code, value
+_input = struct.Struct("<IBBBx")
+INPUT_SIZE = _input.size
 
-def show_ports():
-    print("\n".join(client.get_ports()))
 
+def compile_input_map(mapping):
+    """
+    Compile settings.MIDI_INPUT_MAP into a flat table of
+    (key code, continuous) or None
+    """
+    table = [None] * TABLE_SIZE
+    for spec, key in mapping.items():
+        kind, channel, number = spec.split()
+        continuous = False
+        if isinstance(key, (tuple, list)):
+            key, mode = key
+            continuous = mode == "value"
+        code = events.KEY_CODES.get(key)
+        if code is None:
+            raise Exception("MIDI_INPUT_MAP: no key {} (for {})".format(
+                key, spec))
+        table[(KINDS[kind] << 11) | (int(channel) << 7) | int(number)] = \
+            (code, continuous)
+    return table
 
-midi_msg_q = queue.Queue()
 
-client = jack.Client("MyClient")
-midi_out = client.midi_outports.register("midi_out")
-midi_in = client.midi_inports.register("midi_in")
+class InputHandler(BaseInputHandler):
+    """
+    Input from MIDI foot controllers over JACK, mapped to keys by
+    settings.MIDI_INPUT_MAP:
 
+        "note <channel> <note>": key      note on presses, note off releases
+        "cc <channel> <controller>": key  value >= 64 presses, < 64 releases
+        "pc <channel> <program>": key     a program change taps
+        "cc <channel> <controller>": (key, "value")
+                                          a continuous controller; each new
+                                          value is a change_<key> event
 
-@client.set_process_callback
-def process(frames):
-    global midi_msg_q
-    midi_out.clear_buffer()
-    try:
+    Channels count from 0. Presses and releases go through the gesture
+    engine like any other input's. A stream of values from an expression
+    pedal is coalesced so that at most one change per
+    settings.MIDI_CC_INTERVAL reaches the command set, with the latest
+    value.
+
+    Messages are parsed in the JACK process callback, with running status
+    as some hardware sends it, and passed to the input thread as fixed
+    size records through a lock-free ring buffer, stamped with the JACK
+    frame at which they arrived.
+    """
+    def __init__(self, command_set):
+        super().__init__(command_set)
+        self.table = compile_input_map(settings.MIDI_INPUT_MAP)
+        self.interval = int(settings.MIDI_CC_INTERVAL * 1e9)
+        self.poll = settings.MIDI_INPUT_POLL
+        self.gestures = gestures.GestureEngine(self.handle,
+                                               settings.DOUBLE_TAP_INTERVAL,
+                                               settings.LONG_PRESS_INTERVAL)
+        # used by the process callback only
+        self.status = 0
+        self.scratch = bytearray(256)
+        self.record = bytearray(INPUT_SIZE)
+        self.received = 0
+        self.overflows = 0
+
+        # key code -> [value, stamp] awaiting dispatch
+        self.values = {}
+        self.last_value = {}
+
+    def start(self):
+        self.open()
         while True:
-            midi_msg = midi_msg_q.get(block=False)
-            print("Channel {}: note {}, velocity {}".format(*midi_msg))
-            midi_out.write_midi_event(0, midi_msg)
-    except queue.Empty:
-        pass
+            now = latency.now()
+            self.drain(now)
+            self.flush_values(now)
+            self.gestures.poll(now)
+            time.sleep(self.poll)
+
+    def attach(self, mux):
+        """
+        Run in a multiplexer, which picks up the MIDI from the JACK thread
+        every settings.MIDI_INPUT_POLL
+        """
+        self.mux = mux
+        self.open()
+        mux.every(self.poll, self.drain)
+        mux.every(self.poll, self.flush_values)
+        mux.add_poller(self.gestures.timeout, self.gestures.poll)
+
+    def open(self):
+        import jack
+
+        self.client = jack.Client(settings.MIDI_CLIENT_NAME + "_in")
+        self.port = self.client.midi_inports.register("midi_in")
+        self.rate = self.client.samplerate
+        self.ring = jack.RingBuffer(settings.MIDI_RINGBUFFER_SIZE)
+        self.client.set_process_callback(self._process)
+        self.client.activate()
+
+    def _process(self, frames):
+        """
+        JACK process callback, on the real-time thread
+        """
+        start = self.client.last_frame_time
+        for offset, data in self.port.incoming_midi_events():
+            size = len(data)
+            if size > len(self.scratch):
+                # sysex: not for us
+                continue
+            self.scratch[:size] = data
+            self.parse(self.scratch, size, (start + offset) & 0xFFFFFFFF)
+
+    def parse(self, data, size, frame):
+        """
+        Parse `size` bytes of MIDI from `data`, writing records for any
+        mapped messages
+        """
+        i = 0
+        while i < size:
+            byte = data[i]
+            if byte >= 0xF8:
+                # real-time messages can turn up anywhere
+                i += 1
+                continue
+            if byte & 0x80:
+                i += 1
+                if byte >= 0xF0:
+                    # system messages cancel running status
+                    self.status = 0
+                    return
+                self.status = byte
+            status = self.status
+            if not status:
+                i += 1
+                continue
+
+            kind = status & 0xF0
+            needed = 1 if kind in (0xC0, 0xD0) else 2
+            if i + needed > size:
+                return
+            number = data[i]
+            value = data[i + 1] if needed == 2 else 0
+            i += needed
+            self.received += 1
+
+            channel = (status & 0x0F) << 7
+            if kind == 0x90 or kind == 0x80:
+                entry = self.table[(NOTE << 11) | channel | number]
+                action = (gestures.PRESS if kind == 0x90 and value
+                          else gestures.RELEASE)
+            elif kind == 0xB0:
+                entry = self.table[(CC << 11) | channel | number]
+                if entry is not None and entry[1]:
+                    action = VALUE
+                else:
+                    action = (gestures.PRESS if value >= 64
+                              else gestures.RELEASE)
+            elif kind == 0xC0:
+                entry = self.table[(PROGRAM << 11) | channel | number]
+                action = gestures.CLICK
+            else:
+                continue
+            if entry is None:
+                continue
+
+            _input.pack_into(self.record, 0, frame, action, entry[0], value)
+            if self.ring.write_space >= INPUT_SIZE:
+                self.ring.write(self.record)
+            else:
+                self.overflows += 1
+
+    def drain(self, now):
+        """
+        Take the messages waiting in the ring buffer, stamping each with
+        the latency.now() time at which it arrived in JACK
+        """
+        space = self.ring.read_space
+        space -= space % INPUT_SIZE
+        if not space:
+            return
+        data = self.ring.read(space)
+        current = self.client.frame_time
+        for frame, action, key, value in _input.iter_unpack(data):
+            age = (current - frame) & 0xFFFFFFFF
+            if age & 0x80000000:
+                age = 0
+            stamp = now - int(age * 1000000000 // self.rate)
+            latency.record("input", stamp)
+
+            if action == VALUE:
+                self.values[key] = [value, stamp]
+            elif action == gestures.PRESS:
+                self.gestures.press(key, stamp)
+            elif action == gestures.RELEASE:
+                self.gestures.release(key, stamp)
+            else:
+                self.gestures.click(key, stamp)
+
+    def flush_values(self, now):
+        """
+        Dispatch the latest value of each continuous control, no more
+        often than settings.MIDI_CC_INTERVAL per control
+        """
+        for key in list(self.values):
+            if now - self.last_value.get(key, 0) < self.interval:
+                continue
+            value, stamp = self.values.pop(key)
+            self.last_value[key] = now
+            self.handle(events.code(events.CHANGE, key), stamp, value)
+
 
-client.activate()
+def show_ports(client):
+    print("\n".join(port.name for port in client.get_ports()))
 
-def midi_note_on(channel, midi_note):
-    '''Transmit a MIDI "note on" message'''
-    midi_msg_q.put((0x90 | channel, midi_note, 127))
 
-while True:
-    midi_note_on(0, 60)
-    time.sleep(2)
+if __name__ == '__main__':
+    engine = MidiEngine("MyClient").start()
+    show_ports(engine.client)
+    while True:
+        engine.send(bytes((0x90, 60, 127)))
+        time.sleep(2)
@@ -0,0 +1,281 @@
+"""
+Journal of loop state, for recovery after a crash
+
+Whatever the controller knows that SooperLooper doesn't tell it - the
+selected loop, which loops a group pause paused, each loop's layer
+counts - is lost if the process dies or the Pi browns out. So after
+each command the state that changed is appended to a journal, as fixed
+size records written straight into a memory mapped file:
+
+    sequence, kind, looper, loop, state, value a, value b
+
+Records carry state rather than commands, so replaying them sends
+nothing and can be done in any number. The journal is split into
+segments of settings.JOURNAL_SEGMENT_RECORDS records. Each segment
+starts with a snapshot of the whole state, ended by a SNAPSHOT record,
+after which earlier segments are no longer needed and are deleted, so
+at most two are ever on disk. Recovery replays the newest segment with a
+complete snapshot, up to the first record out of sequence.
+
+Looper and loop numbers are a byte each, so only the first 256 instances
+and the first 256 loops of each are journaled, and a group pause only
+remembers which of the first 31 loops it paused.
+
+Writes only reach the page cache, which survives the process crashing;
+a thread flushes them to disk every settings.JOURNAL_FLUSH_INTERVAL to
+survive losing power too.
+"""
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+import settings
+
+
+# sequence, kind, looper, loop, state, a, b
+_record = struct.Struct("<IBBBBII")
+RECORD_SIZE = _record.size
+
+# a: the loop's current layer, b: its number of layers
+LOOP = 1
+# a: the selected loop, b: the loops paused by a group pause, as a bit
+# mask, with PAUSE_CACHED set if there was one at all
+LOOPER = 2
+# a: the instance with the selected loop, in a LooperGroup
+GROUP = 3
+# the snapshot starting a segment is complete
+SNAPSHOT = 4
+
+PAUSE_CACHED = 1 << 31
+# loops a pause mask has bits for, below PAUSE_CACHED
+PAUSE_MASK_LOOPS = 31
+# instances and loops numbered in a record's one byte fields
+MAX_INDEX = 256
+
+
+def _pause_mask(looper):
+    cache = looper.group_pause_cache
+    if cache is None:
+        return 0
+    mask = PAUSE_CACHED
+    for loop in cache:
+        if loop.index < PAUSE_MASK_LOOPS:
+            mask |= 1 << loop.index
+    return mask
+
+
+def _paused(looper, mask):
+    if not mask & PAUSE_CACHED:
+        return None
+    return [loop for loop in looper.loops[:PAUSE_MASK_LOOPS]
+            if mask & (1 << loop.index)]
+
+
+class Journal(object):
+    """
+    Journal of the state of a Looper or LooperGroup, in segment files
+    named <path>.<number>
+    """
+    def __init__(self, path, segment_records=None, flush_interval=None):
+        self.path = path
+        self.segment_records = (settings.JOURNAL_SEGMENT_RECORDS
+                                if segment_records is None
+                                else segment_records)
+        self.flush_interval = (settings.JOURNAL_FLUSH_INTERVAL
+                               if flush_interval is None else flush_interval)
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.segment = None
+        self.position = 0
+        self.sequence = 0
+        self.dirty = False
+        self.rotating = False
+        self.thread = None
+
+        self.looper = None
+        self.loopers = []
+        # as last journaled, per instance
+        self.selected = []
+        self.caches = []
+        # (state, current layer, layers) as last journaled, per loop
+        self.loops = []
+        self.group_selected = None
+
+    def segments(self):
+        """
+        Segment numbers on disk, oldest first
+        """
+        numbers = []
+        for name in glob.glob(glob.escape(self.path) + ".*"):
+            suffix = name[len(self.path) + 1:]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return "{}.{}".format(self.path, number)
+
+    def replay(self, looper):
+        """
+        Restore the state of `looper` from the newest complete segment.
+        Returns the number of records replayed, or None if there was no
+        journal to replay.
+        """
+        for number in reversed(self.segments()):
+            with open(self._segment_path(number), "rb") as f:
+                data = f.read()
+            records = self._valid(data)
+            if records is None:
+                continue
+            self._apply(looper, records)
+            return len(records)
+        return None
+
+    def _valid(self, data):
+        """
+        The records in a segment, up to the first out of sequence, or None
+        if it has no complete snapshot
+        """
+        records = []
+        snapshot = False
+        expected = None
+        for record in _record.iter_unpack(
+                data[:len(data) - len(data) % RECORD_SIZE]):
+            if record[0] == 0 or (expected is not None
+                                  and record[0] != expected):
+                break
+            expected = (record[0] + 1) & 0xFFFFFFFF or 1
+            if record[1] == SNAPSHOT:
+                snapshot = True
+            records.append(record)
+        return records if snapshot else None
+
+    def _apply(self, looper, records):
+        loopers = getattr(looper, "loopers", [looper])
+        for sequence, kind, n, index, state, a, b in records:
+            if n >= len(loopers):
+                continue
+            member = loopers[n]
+            if kind == LOOP:
+                if index < len(member.loops):
+                    loop = member.loops[index]
+                    loop._state = state
+                    loop.current_layer = a
+                    loop.layers = b
+            elif kind == LOOPER:
+                if a < len(member.loops):
+                    member.selected_loop = a
+                member.group_pause_cache = _paused(member, b)
+            elif kind == GROUP:
+                if a < len(loopers):
+                    looper.selected_looper = a
+
+    def start(self, looper):
+        """
+        Start journaling `looper` in a new segment, beginning with a
+        snapshot of its state
+        """
+        self.looper = looper
+        self.loopers = getattr(looper, "loopers", [looper])
+        segments = self.segments()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._rotate(segments[-1] + 1 if segments else 0)
+
+        self.thread = threading.Thread(target=self._run,
+                                       name="JournalFlush",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def _rotate(self, number):
+        """
+        Move on to a new segment, write a snapshot to it and delete those
+        before it
+        """
+        size = self.segment_records * RECORD_SIZE
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.file.close()
+            self.file = open(self._segment_path(number), "w+b")
+            self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+            self.segment = number
+            self.position = 0
+
+            self.selected = [None] * len(self.loopers)
+            self.caches = [False] * len(self.loopers)
+            self.loops = [[None] * len(member.loops)
+                          for member in self.loopers]
+            self.group_selected = None
+            self.rotating = True
+            try:
+                self.sync()
+                self._write(SNAPSHOT, 0, 0, 0, 0, 0)
+            finally:
+                self.rotating = False
+            self.map.flush()
+            self.dirty = False
+
+        for old in self.segments():
+            if old < number:
+                try:
+                    os.remove(self._segment_path(old))
+                except OSError:
+                    pass
+
+    def _write(self, kind, n, index, state, a, b):
+        if self.position + RECORD_SIZE > len(self.map):
+            if self.rotating:
+                raise Exception("Journal segments are too small to hold "
+                                "a snapshot")
+            self._rotate(self.segment + 1)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF or 1
+        _record.pack_into(self.map, self.position, self.sequence, kind, n,
+                          index, state, a, b)
+        self.position += RECORD_SIZE
+        self.dirty = True
+
+    def sync(self):
+        """
+        Journal whatever has changed since last time. Called after each
+        command.
+        """
+        for n, member in enumerate(self.loopers[:MAX_INDEX]):
+            journaled = self.loops[n]
+            for index, loop in enumerate(member.loops[:MAX_INDEX]):
+                if index >= len(journaled):
+                    journaled.append(None)
+                current = (loop._state, loop.current_layer, loop.layers)
+                if journaled[index] != current:
+                    journaled[index] = current
+                    self._write(LOOP, n, index, loop._state,
+                                loop.current_layer, loop.layers)
+            if (member.selected_loop != self.selected[n] or
+                    member.group_pause_cache is not self.caches[n]):
+                self.selected[n] = member.selected_loop
+                self.caches[n] = member.group_pause_cache
+                self._write(LOOPER, n, 0, 0, member.selected_loop,
+                            _pause_mask(member))
+        selected = getattr(self.looper, "selected_looper", None)
+        if selected is not None and selected != self.group_selected:
+            self.group_selected = selected
+            self._write(GROUP, 0, 0, 0, selected, 0)
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.dirty = False
+                self.map.flush()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -4,20 +4,61 @@ import sys
 
 from pynput import keyboard
 
-from utils import Intervals
 from base import BaseInputHandler
+import events
+import gestures
+import latency
+import metrics
+
+
+# key names for characters and keys that aren't their own name
+CHARACTERS = {"+": "PLUS", "-": "MINUS"}
+SPECIAL_KEYS = {
+    keyboard.Key.space: "SPACE",
+    keyboard.Key.up: "UP",
+    keyboard.Key.down: "DOWN",
+    keyboard.Key.left: "LEFT",
+    keyboard.Key.right: "RIGHT",
+}
+
+
+def key_code(key):
+    """
+    Event key code for a pynput key, or None if it isn't one we handle
+    """
+    try:
+        ch = key.char
+    except AttributeError:
+        return events.KEY_CODES.get(SPECIAL_KEYS.get(key))
+    return events.KEY_CODES.get(CHARACTERS.get(ch, ch))
+
+
+def physical_key(key):
+    """
+    Identify the key itself, whatever shift state it was pressed in
+    """
+    ch = getattr(key, "char", None)
+    return key if ch is None else ch.lower()
 
 
 class InputHandler(BaseInputHandler):
 
-    DOUBLE_TAP_INTERVAL = 0.10   # seconds
+    # from press to press, so a tap's own hold counts against it
+    DOUBLE_TAP_INTERVAL = 0.25   # seconds
     LONG_PRESS_INTERVAL = 0.5    # seconds
 
 
     def __init__(self, command_set):
         super().__init__(command_set)
-        self.timer = Intervals()
         self.q = Queue()
+        # read without the queue's lock, so as never to hold up input
+        metrics.queue_depth.track(lambda: len(self.q.queue), __name__)
+        # physical key -> event key code it was pressed as, so that the
+        # release matches even if shift was let go first
+        self.pressed = {}
+        self.gestures = gestures.GestureEngine(self.handle,
+                                               self.DOUBLE_TAP_INTERVAL,
+                                               self.LONG_PRESS_INTERVAL)
 
     def start(self):
         """
@@ -30,9 +71,25 @@ class InputHandler(BaseInputHandler):
 
         self.set_echo(False)
         # enter event loop to handle keypresses as received.
-        while True:
-            ch = self.q.get()
-            self.command_set.handle(ch)
+        self.gestures.run(self.q)
+
+    def attach(self, mux):
+        """
+        Run in a multiplexer: the listener still calls back on a thread
+        of its own, which passes each key over to the multiplexer's
+        """
+        self.mux = mux
+        mux.add_poller(self.gestures.timeout, self.gestures.poll)
+        keyboard.Listener(
+            on_press=self.on_press,
+            on_release=self.on_release).start()
+        self.set_echo(False)
+
+    def put(self, action, code, stamp):
+        if self.mux is None:
+            self.q.put_nowait((action, code, stamp))
+        else:
+            self.mux.call_threadsafe(self.gestures.feed, action, code, stamp)
 
 
     def flush_keys(self):
@@ -57,80 +114,23 @@ class InputHandler(BaseInputHandler):
 
 
     def on_press(self, key):
-        ##
-        ## BUG:
-        ## This will start time, and put is in frame, when <SHIFT> (or other
-        ## modifier) pressed. That will then ensure we ignore another keypress
-        ## such as the actual character.
-
-        delta = self.timer.start()
-        if delta is None:
+        stamp = latency.now()
+        # modifiers, and keys we don't handle, are ignored entirely
+        code = key_code(key)
+        if code is None:
             return
 
-        if delta < self.DOUBLE_TAP_INTERVAL:
-            prefix = "double_"
-        else:
-            prefix = ""
-
-        try:
-            ch = key.char
-            if key.char == '+':
-                ch = "PLUS"
-            elif key.char == '-':
-                ch = "MINUS"
-
-            self.q.put_nowait("{}{}".format(prefix, ch))
-
-        except AttributeError:
-            ch = None
-
-            if key == keyboard.Key.space:
-                ch = "SPACE"
-            elif key == keyboard.Key.up:
-                ch = "UP"
-            elif key == keyboard.Key.down:
-                ch = "DOWN"
-            elif key == keyboard.Key.left:
-                ch = "LEFT"
-            elif key == keyboard.Key.right:
-                ch = "RIGHT"
-
-            elif key in [keyboard.Key.ctrl,
-                         keyboard.Key.ctrl_r,
-                         keyboard.Key.shift,
-                         keyboard.Key.shift_r,
-                         keyboard.Key.alt_gr,
-                         keyboard.Key.alt,
-                         keyboard.Key.alt_r]:
-                self.timer.ignore_next()
-                return
-
-            if ch is not None:
-                self.q.put_nowait("{}{}".format(prefix, ch))
+        self.pressed[physical_key(key)] = code
+        self.put(gestures.PRESS, code, stamp)
+        latency.record("input", stamp)
 
 
     def on_release(self, key):
-        delta = self.timer.stop()
-        ch = None
-        try:
-            ch = key.char
-            if ch == 'q':
-                # Stop listener
-                return False
-        except AttributeError:
-            if key == keyboard.Key.space:
-                ch = "SPACE"
-            elif key == keyboard.Key.up:
-                ch = "UP"
-            elif key == keyboard.Key.down:
-                ch = "DOWN"
-            elif key == keyboard.Key.left:
-                ch = "LEFT"
-            elif key == keyboard.Key.right:
-                ch = "RIGHT"
-
-        if delta is not None and delta >= self.LONG_PRESS_INTERVAL and ch is not None:
-            self.q.put_nowait("long_{}".format(ch))
-
-
-
+        stamp = latency.now()
+        if getattr(key, "char", None) == 'q':
+            # Stop listener
+            return False
+
+        code = self.pressed.pop(physical_key(key), None)
+        if code is not None:
+            self.put(gestures.RELEASE, code, stamp)
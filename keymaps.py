@@ -0,0 +1,135 @@
+"""
+Keymaps: which action each input event triggers, kept in a data file
+
+A keymap is a JSON object from event names to actions, the names of
+methods on the command set, with any arguments following in a list:
+
+    {
+        "SPACE": "play_record_or_overdub",
+        "double_1": "undo_all",
+        "0": ["note_on", 0, 60]
+    }
+
+It is compiled into a dispatch table once, when loaded. A watcher thread
+polls the file's mtime and, when it changes, compiles the new keymap off
+the input thread and swaps the command set's table in one assignment,
+leaving the looper and OSC channel alone.
+"""
+import json
+import os
+import threading
+import time
+
+import gestures
+import settings
+
+
+def path_for(keymap):
+    """
+    Keymap paths are relative to this directory unless absolute
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), keymap)
+
+
+def load(path):
+    with open(path) as f:
+        keymap = json.load(f)
+    if not isinstance(keymap, dict):
+        raise Exception("Keymap {} is not a JSON object".format(path))
+    return keymap
+
+
+def _action(fn, args):
+    if not args:
+        return fn
+
+    def action(self):
+        return fn(self, *args)
+    action.__name__ = fn.__name__
+    return action
+
+
+def compile_keymap(keymap, command_set_class):
+    """
+    Compile a keymap into a dispatch table for `command_set_class`, keyed
+    by both event code and name, laid over the class's own handle_<event>
+    methods. See gestures.dispatch_table().
+    """
+    commands = dict(command_set_class.commands)
+    for event, action in keymap.items():
+        if isinstance(action, str):
+            action = [action]
+        fn = _check(command_set_class, action, event)
+        commands[event] = _action(fn, action[1:])
+    return gestures.dispatch_table(command_set_class, commands)
+
+
+def _check(command_set_class, action, event):
+    """
+    The method for an action, having checked that it and any action
+    nested in it (as for at_cycle) exist
+    """
+    if not action:
+        raise Exception("Keymap: no action for {}".format(event))
+    name = action[0]
+    fn = getattr(command_set_class, name, None)
+    if not callable(fn):
+        raise Exception("Keymap: {} has no action {} (for {})".format(
+            command_set_class.__name__, name, event))
+    if name in command_set_class.nested_actions:
+        _check(command_set_class, action[1:], event)
+    return fn
+
+
+class KeymapWatcher(object):
+    """
+    Reload a command set's keymap whenever its file changes
+    """
+    def __init__(self, command_set, path, interval=None):
+        self.command_set = command_set
+        self.path = path
+        self.interval = (settings.KEYMAP_POLL_INTERVAL
+                         if interval is None else interval)
+        self.mtime = self._mtime()
+        self.reloads = 0
+        self.thread = None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="KeymapWatcher",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            mtime = self._mtime()
+            if mtime is not None and mtime != self.mtime:
+                self.mtime = mtime
+                self.reload()
+
+    def reload(self):
+        """
+        Compile the keymap file and swap it in. A bad file is reported and
+        the current keymap kept.
+        """
+        start = time.perf_counter()
+        try:
+            table = compile_keymap(load(self.path),
+                                   type(self.command_set))
+        except Exception as e:
+            print("Keymap {} not reloaded: {}".format(self.path, e))
+            return False
+        self.command_set.dispatch_table = table
+        self.reloads += 1
+        if settings.DEBUG:
+            print("Keymap {} reloaded in {:.3f}ms".format(
+                self.path, (time.perf_counter() - start) * 1e3))
+        return True
@@ -0,0 +1,113 @@
+"""
+Latency tracing from input event to OSC datagram
+
+Input events are stamped with a monotonic nanosecond time at the source
+and the stamp is carried through the input queue, the bridge and
+command dispatch. Each stage records its duration into a fixed-size ring
+buffer, so tracing costs a clock read and an array store and can be left
+on. Percentiles are only worked out when dumped, on SIGUSR1 or at exit.
+
+Stages:
+
+    input     - input callback to event being queued
+    queue     - event queued to being taken off the queue
+    bridge    - bridge client send to server receive (same host only)
+    dispatch  - command set handling the command, including sends
+    send      - handing a datagram to the socket (or event loop)
+    total     - source stamp to command handled
+"""
+import array
+import atexit
+import signal
+import sys
+import time
+
+from utils import percentile
+
+
+STAGES = ["input", "queue", "bridge", "dispatch", "send", "total"]
+
+now = time.monotonic_ns
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of the most recent durations, in nanoseconds
+    """
+    def __init__(self, size):
+        self.size = size
+        self.samples = array.array("q", bytes(8 * size))
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % self.size] = value
+        self.count += 1
+
+    def values(self):
+        return list(self.samples[:min(self.count, self.size)])
+
+
+class Tracer(object):
+    def __init__(self, size):
+        self.buffers = {stage: RingBuffer(size) for stage in STAGES}
+
+    def record(self, stage, start, end=None):
+        """
+        Record the time from `start` (a `now()` stamp) to `end`, or to now
+        """
+        if end is None:
+            end = now()
+        self.buffers[stage].add(end - start)
+
+    def summary(self):
+        """
+        Return {stage: (count, p50, p95, p99, max)} in microseconds
+        """
+        result = {}
+        for stage in STAGES:
+            buffer = self.buffers[stage]
+            samples = sorted(buffer.values())
+            if not samples:
+                continue
+            result[stage] = (buffer.count,
+                             percentile(samples, 50) / 1e3,
+                             percentile(samples, 95) / 1e3,
+                             percentile(samples, 99) / 1e3,
+                             samples[-1] / 1e3)
+        return result
+
+    def dump(self, out=None):
+        out = out or sys.stderr
+        out.write("Latency trace (us):\n")
+        for stage, stats in self.summary().items():
+            out.write("  {:<9} n={:<7} p50={:9.1f} p95={:9.1f} "
+                      "p99={:9.1f} max={:9.1f}\n".format(stage, *stats))
+        out.flush()
+
+
+tracer = None
+
+
+def _ignore(stage, start, end=None):
+    pass
+
+
+# replaced by the tracer's record once enabled
+record = _ignore
+
+
+def enable(size=4096):
+    """
+    Start recording, dumping on SIGUSR1 and at exit
+    """
+    global tracer, record
+    tracer = Tracer(size)
+    record = tracer.record
+
+    atexit.register(dump)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
+
+
+def dump(out=None):
+    if tracer is not None:
+        tracer.dump(out)
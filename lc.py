@@ -1,36 +1,204 @@
 #!/usr/bin/env python3
-import optfn
+"""
+Looper controller
+
+What is started depends on the role of the configured command set and
+input handler: only a command set that acts on the looper itself
+(`needs_looper`) gets an OSC channel to SooperLooper and its loops set
+up. A bridge client on a pedal board, say, loads neither the OSC
+libraries nor the looper, and sends nothing to SooperLooper.
+
+With settings.INPUT_SOURCES, several input handlers, each with its own
+command set, run at once in a mux.Multiplexer, all driving one looper.
+"""
+import os
 import sys
+import threading
+import time
 
-from looper import *
+import latency
 import settings
 from utils import get_class_from_string
 
 
-def run_controller(host, port, setup, nloops, channels_per_loop):
+def build_looper(host, port, setup, nloops, channels_per_loop,
+                 scenes=None, lock=None):
     """
-    Initialise and run the SooperLooper controller
+    Connect to SooperLooper and, if `setup`, create the loops there,
+    otherwise bind to those it has, in whatever state they are. Reported
+    state is applied holding `lock`, the command lock, if given.
     """
+    from looper import Loop
+    from looper import Looper
 
     # @todo: this is a hangover from early days when this only controlled
     # SooperLooper and only via OSC. Could refactor this elsewhere.
-    channel = Channel(host, port)
-    looper = Looper(channel)
+    channel = get_class_from_string(settings.CHANNEL)(host, port)
+    looper = Looper(channel, scenes)
 
-    # setup loops in SooperLooper
-    # don't call this if you want to bind to already setup instance
     if setup:
+        # start SooperLooper afresh with just our loops
         channel.clear_loops()
+        loops = [Loop() for i in range(nloops)]
+        looper.add_loops(loops, channels=channels_per_loop,
+                         master=loops[0] if loops else None)
+    else:
+        # take on the loops it has as they are, adding any missing
+        looper.bind(nloops, channels=channels_per_loop)
+
+    if settings.LIVE_STATE:
+        from livestate import LoopStateStore
+
+        # under a multiplexer, updates are applied on its thread
+        looper.state_store = LoopStateStore(looper, lock)
+        looper.state_store.start(thread=not settings.INPUT_SOURCES)
+    return looper
+
+
+def build_group(instances, setup, lock=None):
+    """
+    A LooperGroup of the SooperLooper instances in settings.LOOPERS,
+    each set up on its own thread so that startup takes as long as the
+    slowest rather than the sum
+    """
+    from looper import LooperGroup
+
+    loopers = [None] * len(instances)
+    errors = []
+
+    def build(i, instance):
+        try:
+            loopers[i] = build_looper(
+                instance.get("host", "localhost"),
+                int(instance.get("port", 9951)), setup,
+                int(instance.get("loops", 2)),
+                2 if instance.get("stereo") else 1,
+                instance.get("scenes"), lock)
+        except Exception as e:
+            errors.append("{}:{}: {}".format(
+                instance.get("host", "localhost"),
+                instance.get("port", 9951), e))
+
+    threads = [threading.Thread(target=build, args=(i, instance),
+                                name="LooperSetup{}".format(i))
+               for i, instance in enumerate(instances)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception("Looper setup failed: {}".format("; ".join(errors)))
+    return LooperGroup(loopers)
+
+
+def resume(journal, looper, lock=None):
+    """
+    Restore what SooperLooper can't tell us from the journal: selection,
+    group pause and layer counts. Where the state journaled for a loop is
+    not what SooperLooper reported on binding to it, SooperLooper's wins.
+    """
+    if lock is not None:
+        with lock:
+            replayed = _replay(journal, looper)
+    else:
+        replayed = _replay(journal, looper)
+    if replayed is None:
+        print("No journal to resume from at {}".format(journal.path))
+    else:
+        print("Resumed from journal: {} records in {:.1f}ms".format(
+            *replayed))
+
 
-    for i in range(nloops):
-        loop = Loop()
-        looper.add_loop(loop, channels=channels_per_loop, master=True if i == 0 else False, create=setup)
-        time.sleep(0.1)
+def _replay(journal, looper):
+    reported = [loop.state for loop in looper.loops]
+    start = time.perf_counter()
+    replayed = journal.replay(looper)
+    for loop, state in zip(looper.loops, reported):
+        loop.sync_state(state)
+    if replayed is None:
+        return None
+    return replayed, (time.perf_counter() - start) * 1e3
 
-    command_set = get_class_from_string(settings.COMMAND_SET)(looper)
-    handler = get_class_from_string(settings.INPUT_HANDLER)(command_set)
 
-    handler.start()
+def build_controller(host, port, setup, nloops, channels_per_loop,
+                     resuming=False):
+    """
+    Initialise the command set and input handler for the configured
+    role, returning the input handler ready to start: for several
+    settings.INPUT_SOURCES, a multiplexer running a command set and input
+    handler for each. If `resuming`, state is restored from the journal
+    after binding to SooperLooper.
+    """
+    if settings.TRACE:
+        latency.enable(settings.TRACE_BUFFER_SIZE)
+    if settings.METRICS_PORT:
+        import metrics
+
+        metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT)
+
+    sources = settings.INPUT_SOURCES or [
+        {"INPUT_HANDLER": settings.INPUT_HANDLER,
+         "COMMAND_SET": settings.COMMAND_SET,
+         "KEYMAP": getattr(settings, "KEYMAP", None)}]
+    command_set_classes = [get_class_from_string(source["COMMAND_SET"])
+                           for source in sources]
+    looper = None
+    lock = None
+    if any(cls.needs_looper for cls in command_set_classes):
+        if settings.LIVE_STATE:
+            # reported state, and quantized commands unless multiplexed,
+            # change loops on threads of their own; reentrant as commands
+            # not held back run inside the command that asked
+            lock = threading.RLock()
+        if settings.LOOPERS:
+            looper = build_group(settings.LOOPERS, setup, lock)
+        else:
+            looper = build_looper(host, port, setup, nloops,
+                                  channels_per_loop, lock=lock)
+        if settings.LIVE_STATE:
+            from quantize import QuantizedScheduler
+
+            looper.scheduler = QuantizedScheduler(looper)
+            if not settings.INPUT_SOURCES:
+                looper.scheduler.start()
+
+    journal = None
+    if looper is not None and settings.JOURNAL:
+        from journal import Journal
+
+        journal = Journal(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), settings.JOURNAL))
+        if resuming:
+            resume(journal, looper, lock)
+        if lock is not None:
+            # the snapshot reads loops the state store may be changing
+            with lock:
+                journal.start(looper)
+        else:
+            journal.start(looper)
+
+    handlers = []
+    for source, command_set_class in zip(sources, command_set_classes):
+        command_set = command_set_class(looper, keymap=source.get("KEYMAP"))
+        command_set.journal = journal
+        command_set.lock = lock
+        handlers.append(
+            get_class_from_string(source["INPUT_HANDLER"])(command_set))
+    if not settings.INPUT_SOURCES:
+        return handlers[0]
+
+    from mux import Multiplexer
+
+    return Multiplexer(handlers, looper=looper)
+
+
+def run_controller(host, port, setup, nloops, channels_per_loop,
+                   resuming=False):
+    """
+    Initialise and run the SooperLooper controller
+    """
+    build_controller(host, port, setup, nloops, channels_per_loop,
+                     resuming).start()
 
 
 def set_config(config):
@@ -57,7 +225,7 @@ def show_configs():
 
 def cli_handler(host="localhost", port=9951, stereo=False,
                 loops=2, nosetup=False, config="default",
-                udp_host=None, show_config=False):
+                udp_host=None, show_config=False, resume=False):
     """
     Use:
 
@@ -66,10 +234,16 @@ def cli_handler(host="localhost", port=9951, stereo=False,
     --host=<host>            - host running SooperLooper (default: localhost)
     --port=<port>            - SooperLooper port (default: 9951)
     --loops=<n>              - Number of loops to start (default: 2)
+                               (host, port, loops and stereo are ignored if
+                               settings.LOOPERS lists several instances)
     --udp_host=<host>        - UDP host address to connect/bind to (default
                                in settings)
     --stero                  - Set if stereo is to be selected
-    --nosetup                - Do not re-configure the looper
+    --nosetup                - Do not re-configure the looper: bind to its
+                               loops as they are, adding any missing
+    --resume                 - After a crash: as --nosetup, and restore
+                               what SooperLooper doesn't know from the
+                               journal (see settings.JOURNAL)
     --config=<config>        - Config set defined in settings (default: default)
     --show_config            - Show configurations available
     --help -h                - Show this help
@@ -84,10 +258,15 @@ def cli_handler(host="localhost", port=9951, stereo=False,
     loops = int(loops)
     if udp_host is not None:
         settings.UDP_HOST = udp_host
-    setup = not nosetup
+    setup = not (nosetup or resume)
     set_config(config)
-    run_controller(host, port, setup, loops, 2 if stereo else 1)
+    if resume and not settings.JOURNAL:
+        print("--resume needs a journal: set JOURNAL in settings")
+        sys.exit(1)
+    run_controller(host, port, setup, loops, 2 if stereo else 1, resume)
 
 
 if __name__ == '__main__':
+    import optfn
+
     optfn.run(cli_handler)
@@ -0,0 +1,169 @@
+"""
+Live loop state reported by SooperLooper
+
+Rather than guess at loop state from the commands we have sent, subscribe
+to SooperLooper's auto-updates for the controls we care about and feed
+them into the `Loop` objects. Replies are received off the input thread,
+coalesced per loop and applied by a separate thread no more often than
+`settings.STATE_UPDATE_INTERVAL` per loop; or, under a mux.Multiplexer,
+on the multiplexer's thread along with the input.
+"""
+import threading
+import time
+
+from looper import SL_STATES
+import settings
+
+
+REPLY_PATH = "/ctrl"
+CONTROLS = ["state", "waiting", "loop_pos", "loop_len"]
+
+
+class LoopStateStore(object):
+    """
+    Event driven store of loop state reported by SooperLooper
+    """
+    def __init__(self, looper, command_lock=None):
+        self.looper = looper
+        # held while changing loops, which commands change too
+        self.command_lock = command_lock
+        self.channel = looper.channel
+        self.interval = settings.STATE_UPDATE_INTERVAL
+        self.settle_time = settings.STATE_SETTLE_TIME
+
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        # loop index -> {control: latest value}
+        self.pending = {}
+        self.last_applied = {}
+        # monotonic time at which pending updates are next due, if any
+        self.due = None
+        self.thread = None
+        # called on each reply, to have it applied
+        self.wake = self.event.set
+
+    def start(self, thread=True):
+        """
+        Subscribe to updates for all loops and start applying them, on a
+        thread of our own unless `thread` is False, in which case they
+        are left to be applied by attach()
+        """
+        self.channel.add_reply_handler(REPLY_PATH, self.on_reply)
+        self.channel.listen()
+
+        if thread:
+            self.thread = threading.Thread(target=self._run,
+                                           name="LoopStateStore",
+                                           daemon=True)
+            self.thread.start()
+
+        for loop in self.looper.loops:
+            self.subscribe(loop)
+
+    def subscribe(self, loop):
+        interval = int(self.interval * 1000)
+        for control in CONTROLS:
+            self.channel.register_auto_update(control, interval,
+                                              loop.index, REPLY_PATH)
+            self.channel.get(control, loop.index, REPLY_PATH)
+
+    def unsubscribe(self, loop):
+        for control in CONTROLS:
+            self.channel.unregister_auto_update(control, loop.index,
+                                                REPLY_PATH)
+
+    def on_reply(self, index, control, value):
+        """
+        Called on the channel's receiving thread. Only records the latest
+        value; applying it is left to our own thread.
+        """
+        received = time.time()
+        with self.lock:
+            updates = self.pending.get(index)
+            if updates is None:
+                updates = self.pending[index] = {}
+            updates[control] = value
+            if control == "loop_pos":
+                updates["received"] = received
+        self.wake()
+
+    def attach(self, mux):
+        """
+        Apply updates on the thread of a mux.Multiplexer, having been
+        started with thread=False
+        """
+        self.wake = mux.wake
+        mux.add_poller(lambda now: self.timeout(),
+                       lambda now: self.poll())
+
+    def _run(self):
+        while True:
+            self.event.wait(self.timeout())
+            self.event.clear()
+            self.poll()
+
+    def timeout(self):
+        """
+        Seconds until pending updates are due, or None
+        """
+        if self.due is None:
+            return None
+        return max(0, self.due - time.monotonic())
+
+    def poll(self):
+        """
+        Apply the updates that are due
+        """
+        now = time.monotonic()
+        timeout = None
+        due = []
+        with self.lock:
+            for index in list(self.pending):
+                remaining = \
+                    self.last_applied.get(index, 0) + self.interval - now
+                if remaining <= 0:
+                    due.append((index, self.pending.pop(index)))
+                elif timeout is None or remaining < timeout:
+                    timeout = remaining
+        self.due = None if timeout is None else now + timeout
+
+        if not due:
+            return
+        if self.command_lock is None:
+            self._apply_all(due, now)
+        else:
+            with self.command_lock:
+                self._apply_all(due, now)
+
+    def _apply_all(self, due, now):
+        for index, updates in due:
+            self.last_applied[index] = now
+            self.apply(index, updates, now)
+
+    def apply(self, index, updates, now):
+        """
+        Apply a set of control values to the loop at `index`
+        """
+        if not 0 <= index < len(self.looper.loops):
+            return
+        loop = self.looper.loops[index]
+
+        if "loop_pos" in updates:
+            loop.position = updates["loop_pos"]
+            loop.position_time = updates["received"]
+        if "loop_len" in updates:
+            loop.length = updates["loop_len"]
+        if "waiting" in updates:
+            loop.waiting = updates["waiting"] > 0
+
+        if "state" not in updates:
+            return
+        state = SL_STATES.get(int(updates["state"]))
+        # don't let an update that was in flight when we sent a command
+        # undo the state change that command made
+        if state is None or now - loop.changed < self.settle_time:
+            return
+        if state != loop.state and settings.DEBUG:
+            print("Loop {}: state {} -> {} (reported)".format(
+                index, loop.state, state))
+        loop.sync_state(state)
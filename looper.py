@@ -1,18 +1,51 @@
 """
 SooperLooper library
 """
+import contextlib
+import itertools
+import queue
+import socket
+import threading
 import time
 
 from osc4py3 import oscbuildparse
-from osc4py3.as_eventloop import *
-#from osc4py3.as_allthreads import *
 
+from osctemplates import TemplateCache
+import latency
+import metrics
+from scenes import Scene
+from scenes import bundle
+from scenes import compile_scenes
+from scenes import timetag_at
 import settings
 
 
 MINIMUM_LOOP_DURATION = 60 # seconds
 MONO, STEREO = (1, 2)
 
+PING_TIMEOUT = 1.0 # seconds
+# first wait before pinging again while waiting for loops; doubles each
+# time up to PING_TIMEOUT
+PING_BACKOFF = 0.05 # seconds
+SETUP_TIMEOUT = 5.0 # seconds
+# most 'get' messages in one bundle, keeping datagrams well within limits
+GET_BATCH = 32
+# what is asked of each loop SooperLooper already has when binding to it
+BIND_CONTROLS = ["state", "loop_len", "loop_pos"]
+
+
+def _local_address_for(address):
+    """
+    Return the local interface address used to reach `address`, which is
+    the address SooperLooper needs to send replies back to us.
+    """
+    probe = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    try:
+        probe.connect(address)
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
+
 
 class Channel(object):
     """
@@ -21,16 +54,137 @@ class Channel(object):
     def __init__(self, looper_addr, looper_port):
         self.looper_addr = looper_addr
         self.looper_port = looper_port
+        # per thread, so that scheduling on one doesn't timetag what
+        # another sends
+        self.local = threading.local()
         self.start()
 
+    @property
+    def send_time(self):
+        """
+        Unix time at which SooperLooper is to act on what is sent from
+        this thread, if not immediately. See `scheduled`.
+        """
+        return getattr(self.local, "send_time", None)
+
+    @send_time.setter
+    def send_time(self, unixtime):
+        self.local.send_time = unixtime
+
     def start(self):
-        osc_startup()
-        osc_udp_client(self.looper_addr, self.looper_port, "SooperLooper")
+        # resolve once so that each send is a plain sendto
+        self.address = socket.getaddrinfo(self.looper_addr, self.looper_port,
+                                          socket.AF_INET,
+                                          socket.SOCK_DGRAM)[0][4]
+        self.socket = socket.socket(family=socket.AF_INET,
+                                    type=socket.SOCK_DGRAM)
+        # bound so that SooperLooper can reply to the same socket
+        self.socket.bind(("", 0))
+        self.reply_address = (_local_address_for(self.address),
+                              self.socket.getsockname()[1])
+        self.reply_handlers = {}
+        self.listener = None
+        self.templates = TemplateCache()
+        self._init_ping()
+
+    def _init_ping(self):
+        # each ping asks for its pong on a path of its own, so that a late
+        # reply to an earlier one is never taken for the answer
+        self.pings = itertools.count()
+
+    def listen(self):
+        """
+        Start a thread to receive replies from SooperLooper and pass them
+        on to the registered reply handlers.
+        """
+        if self.listener is not None:
+            return
+        self.listener = threading.Thread(target=self._receive,
+                                         name="ChannelReplies",
+                                         daemon=True)
+        self.listener.start()
+
+    def _receive(self):
+        while True:
+            data = self.socket.recv(65536)
+            self._dispatch_reply(data)
+
+    def _dispatch_reply(self, data):
+        """
+        Decode a reply datagram and call the handler registered for each
+        message's address
+        """
+        try:
+            packet = oscbuildparse.decode_packet(data)
+        except oscbuildparse.OSCError as e:
+            if settings.DEBUG:
+                print("Bad reply from SooperLooper: {}".format(e))
+            return
+
+        if isinstance(packet, oscbuildparse.OSCBundle):
+            messages = packet.elements
+        else:
+            messages = [packet]
+
+        for msg in messages:
+            handler = self.reply_handlers.get(msg.addrpattern)
+            if handler is not None:
+                handler(*msg.arguments)
+
+    def add_reply_handler(self, path, handler):
+        """
+        Call `handler` with the arguments of every reply sent to `path`
+        """
+        self.reply_handlers[path] = handler
+
+    @property
+    def return_url(self):
+        return "osc.udp://{}:{}/".format(*self.reply_address)
+
+    @contextlib.contextmanager
+    def scheduled(self, unixtime):
+        """
+        Within this block, send everything as bundles timetagged for
+        SooperLooper to act on at `unixtime`
+        """
+        self.send_time = unixtime
+        try:
+            yield
+        finally:
+            self.send_time = None
+
+    def _timetagged(self, data):
+        """
+        Return `data` as a bundle timetagged with the send time
+        """
+        if data[:8] == b"#bundle\x00":
+            data = bytearray(data)
+        else:
+            data = bundle([data])
+        timetag_at(self.send_time, data, 8)
+        return data
+
+    def _send_datagram(self, data):
+        """
+        Transmit encoded OSC bytes to SooperLooper
+        """
+        if self.send_time is not None:
+            data = self._timetagged(data)
+        start = latency.now()
+        self.socket.sendto(data, self.address)
+        latency.record("send", start)
+        metrics.osc_sent.inc("bundle" if data[:8] == b"#bundle\x00"
+                             else "message")
+
+    def _send_packet(self, packet):
+        """
+        Transmit an OSC message or bundle to SooperLooper
+        """
+        self._send_datagram(oscbuildparse.encode_packet(packet))
 
     def _send(self, address, formatter, args):
         msg = oscbuildparse.OSCMessage(address, formatter, args)
-        osc_send(msg, "SooperLooper")
-        osc_process()
+        self._send_packet(msg)
         if settings.DEBUG:
             print("{} {} {}".format(address, formatter, args))
 
@@ -38,19 +192,25 @@ class Channel(object):
         """
         Send a 'hit' to some command on a specific loop (defaults to selected)
         """
-        self._send("/sl/{}/hit".format(loop), ",s", [command])
+        self._send_datagram(self.templates.hit(command, loop))
+        if settings.DEBUG:
+            print("/sl/{}/hit ,s ['{}']".format(loop, command))
 
     def _send_set(self, control, value, loop=-3):
         """
         Set a property on a given loop
         """
-        self._send("/sl/{}/set".format(loop), ",sf", [control, value])
+        self._send_datagram(self.templates.set(control, value, loop))
+        if settings.DEBUG:
+            print("/sl/{}/set ,sf ['{}', {}]".format(loop, control, value))
 
     def _send_global_set(self, param, arg):
         """
         Set a global property
         """
-        self._send("/set", ",sf", [param, arg])
+        self._send_datagram(self.templates.global_set(param, arg))
+        if settings.DEBUG:
+            print("/set ,sf ['{}', {}]".format(param, arg))
 
     def record(self, loop=-3):
         self._send_hit("record", loop)
@@ -71,48 +231,131 @@ class Channel(object):
         """
         Pause a number of loops simultaneously.
         """
-        msgs = []
-        for loop in loops:
-            msgs.append(
-                oscbuildparse.OSCMessage("/sl/{}/hit".format(loop.index),
-                                         ",s", ["pause"]
-                                         )
-                )
-            if settings.DEBUG:
-                print(">> {} {} {}".format("/sl/{}/hit".format(loop.index), ",s", ["pause"]))
-
-        bundle = oscbuildparse.OSCBundle(oscbuildparse.OSC_IMMEDIATELY, msgs)
-        osc_send(bundle, "SooperLooper")
-        osc_process()
+        self.fire(Scene("pause_multi",
+                        [("pause", [loop.index for loop in loops])],
+                        self.templates))
 
     def unpause_multi(self, loops=[]):
         """
         Unpause a number of loops, assuming synced to loop 0.
 
         We therefore hit trigger on all bar loop 0 and then unpause 0 (unless
-        has already been unpaused).
+        has already been unpaused). All in the one bundle, so they start
+        together.
         """
-        master = None
-        msgs = []
+        actions = [("trigger", [loop.index for loop in loops
+                                if loop.index != 0])]
         for loop in loops:
-            if loop.index == 0:
-                master = loop
-                continue
-            msgs.append(
-                oscbuildparse.OSCMessage("/sl/{}/hit".format(loop.index),
-                                         ",s", ["trigger"]
-                                         )
-                )
-        bundle = oscbuildparse.OSCBundle(oscbuildparse.OSC_IMMEDIATELY, msgs)
-        osc_send(bundle, "SooperLooper")
-        osc_process()
-
-        if master.state == Loop.PAUSED:
-            self.pause(master.index)
+            if loop.index == 0 and loop.state == Loop.PAUSED:
+                actions.append(("pause", [0]))
+        self.fire(Scene("unpause_multi", actions, self.templates))
+
+    def fire(self, scene):
+        """
+        Send a compiled scene
+        """
+        scene.fire(self)
 
     def undo_all(self, loop=-3):
         self._send_hit("undo_all", loop)
 
+    def ping(self, timeout=PING_TIMEOUT):
+        """
+        Ping SooperLooper and return the number of loops it reports, or
+        None if there is no reply within `timeout` seconds.
+        """
+        self.listen()
+        path = "/pong/{}".format(next(self.pings))
+        pongs = queue.Queue()
+        self.add_reply_handler(
+            path,
+            lambda hosturl, version, loop_count: pongs.put_nowait(loop_count))
+        try:
+            self._send("/ping", ",ss", [self.return_url, path])
+            return pongs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        finally:
+            self.reply_handlers.pop(path, None)
+
+    def wait_for_loops(self, count, timeout=SETUP_TIMEOUT):
+        """
+        Wait until SooperLooper reports having `count` loops. Returns
+        False if that does not happen within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        backoff = PING_BACKOFF
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            reply = self.ping(min(remaining, PING_TIMEOUT))
+            if reply == count:
+                return True
+            if reply is not None:
+                # answered, but not there yet: give it time before asking
+                # again rather than flooding it with pings
+                time.sleep(max(0, min(backoff,
+                                      deadline - time.monotonic())))
+                backoff = min(backoff * 2, PING_TIMEOUT)
+
+    def get(self, control, loop=-3, path="/ctrl"):
+        """
+        Ask for the value of `control` on a loop to be sent to `path`
+        """
+        self._send("/sl/{}/get".format(loop), ",sss",
+                   [control, self.return_url, path])
+
+    def get_many(self, requests, timeout=PING_TIMEOUT, path="/bind"):
+        """
+        Ask for the values of a list of (loop, control) pairs, all in one
+        burst of bundles, and collect the replies. Returns a dict of
+        (loop, control) -> value. Those not answered within `timeout`
+        seconds are asked for once more, and missing if still not
+        answered.
+        """
+        wanted = set(requests)
+        values = {}
+        done = threading.Event()
+
+        def on_reply(loop, control, value):
+            key = (loop, control)
+            if key in wanted and key not in values:
+                values[key] = value
+                if len(values) == len(wanted):
+                    done.set()
+
+        self.add_reply_handler(path, on_reply)
+        self.listen()
+        try:
+            for attempt in range(2):
+                missing = [key for key in requests if key not in values]
+                if not missing:
+                    break
+                for i in range(0, len(missing), GET_BATCH):
+                    msgs = [oscbuildparse.OSCMessage(
+                                "/sl/{}/get".format(loop), ",sss",
+                                [control, self.return_url, path])
+                            for loop, control in missing[i:i + GET_BATCH]]
+                    self._send_packet(oscbuildparse.OSCBundle(
+                        oscbuildparse.OSC_IMMEDIATELY, msgs))
+                done.wait(timeout)
+        finally:
+            self.reply_handlers.pop(path, None)
+        return dict(values)
+
+    def register_auto_update(self, control, interval, loop=-3, path="/ctrl"):
+        """
+        Have SooperLooper send `control` to `path` whenever it changes,
+        at most every `interval` milliseconds.
+        """
+        self._send("/sl/{}/register_auto_update".format(loop), ",siss",
+                   [control, interval, self.return_url, path])
+
+    def unregister_auto_update(self, control, loop=-3, path="/ctrl"):
+        self._send("/sl/{}/unregister_auto_update".format(loop), ",sss",
+                   [control, self.return_url, path])
+
     def trigger(self, loop=-3):
         self._send_hit("trigger", loop)
 
@@ -130,6 +373,18 @@ class Channel(object):
             raise Exception("Can only have 1 or 2 channels on a loop")
         self._send("/loop_add", ",if", [channels, MINIMUM_LOOP_DURATION])
 
+    def add_loops(self, count, channels=MONO):
+        """
+        Add `count` loops to SooperLooper in a single bundle
+        """
+        if channels not in [MONO, STEREO]:
+            raise Exception("Can only have 1 or 2 channels on a loop")
+        msgs = [oscbuildparse.OSCMessage("/loop_add", ",if",
+                                         [channels, MINIMUM_LOOP_DURATION])
+                for i in range(count)]
+        self._send_packet(
+            oscbuildparse.OSCBundle(oscbuildparse.OSC_IMMEDIATELY, msgs))
+
     def set_sync_source(self, loop=0):
         """
         Set sync source globally to the given (zero indexed) loop. Defaults
@@ -156,28 +411,59 @@ class Channel(object):
         if messages:
             bundle = \
                 oscbuildparse.OSCBundle(oscbuildparse.OSC_IMMEDIATELY, messages)
-            osc_send(bundle, "SooperLooper")
-            osc_process()
+            self._send_packet(bundle)
 
-    def clear_loops(self):
+    def set_properties_multi(self, loop_properties=[]):
         """
-        Crude way to clear out loops from the looper. Works so long as
-        you don't have more than 10 in there!
+        Take a list of (properties, loop) pairs and set them all in a
+        single bundle.
         """
-        for i in range(10):
-            msg = oscbuildparse.OSCMessage("/loop_del", ",i", [-1])
-            osc_send(msg, "SooperLooper")
-            osc_process()
-            time.sleep(0.1)
+        messages = []
+        for properties, loop in loop_properties:
+            for command, value in properties.items():
+                messages.append(
+                    oscbuildparse.OSCMessage("/sl/{}/set".format(loop),
+                                             ",sf",
+                                             [command, value]))
+                if settings.DEBUG:
+                    print(">> {} {} {}".format("/sl/{}/set".format(loop), ",sf", [command, value]))
+
+        if messages:
+            bundle = \
+                oscbuildparse.OSCBundle(oscbuildparse.OSC_IMMEDIATELY, messages)
+            self._send_packet(bundle)
+
+    def clear_loops(self, timeout=SETUP_TIMEOUT):
+        """
+        Delete all loops in the looper. Asks SooperLooper how many there
+        are, deletes them all in one bundle and waits until it reports
+        none left.
+        """
+        count = self.ping()
+        if count is None:
+            raise Exception("No reply from SooperLooper at {}:{}".format(
+                self.looper_addr, self.looper_port))
+        if count == 0:
+            return
+
+        msgs = [oscbuildparse.OSCMessage("/loop_del", ",i", [-1])
+                for i in range(count)]
+        self._send_packet(
+            oscbuildparse.OSCBundle(oscbuildparse.OSC_IMMEDIATELY, msgs))
+        if not self.wait_for_loops(0, timeout):
+            raise Exception("SooperLooper did not delete its loops")
 
 
 class Looper(object):
     """
     Represents a SooperLooper instance. Can contain many loops
     """
-    def __init__(self, channel):
+    def __init__(self, channel, scenes=None):
         self.loops = []
         self.channel = channel
+        # tells instances apart in metrics
+        self.instance = "{}:{}".format(channel.looper_addr,
+                                       channel.looper_port)
 
         # @todo decide whether the Loop class should not have an index,
         # and whether we should just work on a 'selected loop' basis.
@@ -185,6 +471,15 @@ class Looper(object):
 
         # used to store loops that have been group paused
         self.group_pause_cache = None
+        # the sync source, if any
+        self.master = None
+        # quantize.QuantizedScheduler, if loop position is tracked
+        self.scheduler = None
+        # livestate.LoopStateStore, if SooperLooper reports loop state
+        self.state_store = None
+
+        self.scenes = compile_scenes(
+            settings.SCENES if scenes is None else scenes, channel.templates)
 
     def add_loop(self, loop, channels=MONO, master=False, create=True):
         """
@@ -194,31 +489,80 @@ class Looper(object):
         the loop, otherwise just create entry here (for use if binding
         to existing looper setup)
         """
-        loop.looper = self
-        loop.index = len(self.loops)
-        self.loops.append(loop)
-
-        if loop.index == self.selected_loop:
-            self.select_loop(loop)
-
-        if create:
-            self.channel.add_loop(channels)
-            # without out this tiny pause the Looper will not have setup the loop
-            # and so the setting of properties will fail as there's no loop on
-            # which to set them...
-            # It could be shorter, but we'll try and play safe.
-            time.sleep(0.05)
-
-            if master:
-                self.channel.set_properties(
-                    dict(sync=0, playback_sync=0, quantize=3),
-                    loop.index)
-                self.channel.set_sync_source(loop.index)
+        self.add_loops([loop], channels, loop if master else None, create)
+
+    def add_loops(self, loops, channels=MONO, master=None, create=True):
+        """
+        Add a number of loops. `master` is the loop, if any, which will be
+        considered the sync source.
+
+        If `create` == True, the loops are all requested from SooperLooper
+        at once and, as soon as it reports having them, their properties
+        are set in a single bundle.
+        """
+        if master is not None:
+            self.master = master
+        for loop in loops:
+            loop.looper = self
+            loop.index = len(self.loops)
+            self.loops.append(loop)
+
+            if loop.index == self.selected_loop:
+                self.select_loop(loop)
+
+        if not create:
+            return
+
+        self.channel.add_loops(len(loops), channels)
+        # properties can't be set on loops that don't exist yet
+        if not self.channel.wait_for_loops(len(self.loops)):
+            raise Exception("SooperLooper did not create the loops")
+
+        properties = []
+        for loop in loops:
+            if loop is master:
+                properties.append(
+                    (dict(sync=0, playback_sync=0, quantize=3), loop.index))
             else:
-                self.channel.set_properties(
-                    dict(sync=1, playback_sync=1, quantize=3),
-                    loop.index
-                    )
+                properties.append(
+                    (dict(sync=1, playback_sync=1, quantize=3), loop.index))
+        self.channel.set_properties_multi(properties)
+
+        if master is not None:
+            self.channel.set_sync_source(master.index)
+
+    def bind(self, nloops, channels=MONO):
+        """
+        Bind to the loops SooperLooper already has, taking their state
+        from it rather than assuming them empty, and create as many more
+        as are needed to make up `nloops`. Loops that exist are left just
+        as they are, playing or recording.
+        """
+        count = self.channel.ping()
+        if count is None:
+            raise Exception("No reply from SooperLooper at {}:{}".format(
+                self.channel.looper_addr, self.channel.looper_port))
+
+        values = self.channel.get_many([(index, control)
+                                        for index in range(count)
+                                        for control in BIND_CONTROLS])
+        loops = []
+        for index in range(count):
+            loop = Loop(loop_index=index)
+            loop.bind({control: values[(index, control)]
+                       for control in BIND_CONTROLS
+                       if (index, control) in values})
+            loops.append(loop)
+        if loops:
+            self.add_loops(loops, channels, master=loops[0], create=False)
+
+        if nloops > count:
+            new = [Loop() for i in range(nloops - count)]
+            self.add_loops(new, channels, master=None if loops else new[0])
+        if settings.DEBUG:
+            print("Bound to {} loops, created {}: {}".format(
+                count, max(0, nloops - count),
+                [loop.state for loop in self.loops]))
 
     @property
     def selected(self):
@@ -268,6 +612,25 @@ class Looper(object):
 
         self.group_pause_cache = None
 
+    def fire_scene(self, name):
+        """
+        Fire a scene defined in settings.SCENES
+        """
+        try:
+            scene = self.scenes[name]
+        except KeyError:
+            if settings.DEBUG:
+                print("Could not find scene: {}".format(name))
+            return
+        self.channel.fire(scene)
+
+    def scheduled(self, unixtime):
+        """
+        Within this block, send everything for SooperLooper to act on at
+        `unixtime`
+        """
+        return self.channel.scheduled(unixtime)
+
     def select_loop(self, loop):
         self.selected_loop = loop.index
         self.channel.select_loop(loop.index)
@@ -281,11 +644,120 @@ class Looper(object):
         self.select_loop(self.selected)
 
 
+class LooperGroup(object):
+    """
+    Several SooperLooper instances, e.g. one per performer or JACK host,
+    controlled as one with the same surface as a Looper. Loops are
+    selected across the instances in turn, and the selected loop's
+    instance takes commands for the selected loop.
+
+    Actions on everything, such as pausing all loops or firing a scene,
+    go to every instance back to back, and if settings.SCENE_LATENCY is
+    set, timetagged alike so that they all act on the same tick.
+    """
+    def __init__(self, loopers):
+        self.loopers = loopers
+        self.selected_looper = 0
+        # quantize.QuantizedScheduler, if loop position is tracked
+        self.scheduler = None
+
+    @property
+    def current(self):
+        """
+        The instance with the selected loop
+        """
+        return self.loopers[self.selected_looper]
+
+    @property
+    def channel(self):
+        return self.current.channel
+
+    @property
+    def loops(self):
+        return [loop for looper in self.loopers for loop in looper.loops]
+
+    @property
+    def master(self):
+        """
+        The sync source of the first instance, which cross-instance
+        quantizing follows
+        """
+        return self.loopers[0].master
+
+    @property
+    def selected(self):
+        return self.current.selected
+
+    @contextlib.contextmanager
+    def scheduled(self, unixtime):
+        with contextlib.ExitStack() as stack:
+            for looper in self.loopers:
+                stack.enter_context(looper.scheduled(unixtime))
+            yield
+
+    @contextlib.contextmanager
+    def together(self):
+        """
+        Within this block, have every instance act on what is sent at the
+        same time. Sends already scheduled keep their time.
+        """
+        latency = settings.SCENE_LATENCY
+        if latency <= 0 or self.channel.send_time is not None:
+            yield
+            return
+        with self.scheduled(time.time() + latency):
+            yield
+
+    def toggle_pause_all(self):
+        """
+        Pause all the instances unless they are all group paused, in which
+        case unpause them all, so that they never end up diverged
+        """
+        paused = all(looper.group_pause_cache is not None
+                     for looper in self.loopers)
+        with self.together():
+            for looper in self.loopers:
+                if paused:
+                    looper._unpause_all()
+                elif looper.group_pause_cache is None:
+                    looper._pause_all()
+
+    def fire_scene(self, name):
+        """
+        Fire a scene on every instance that has it
+        """
+        scenes = [(looper, looper.scenes[name]) for looper in self.loopers
+                  if name in looper.scenes]
+        if not scenes:
+            if settings.DEBUG:
+                print("Could not find scene: {}".format(name))
+            return
+        with self.together():
+            for looper, scene in scenes:
+                looper.channel.fire(scene)
+
+    def select_loop(self, loop):
+        self.selected_looper = self.loopers.index(loop.looper)
+        loop.looper.select_loop(loop)
+
+    def _select_by(self, step):
+        loops = self.loops
+        index = loops.index(self.selected)
+        self.select_loop(loops[(index + step) % len(loops)])
+
+    def select_next(self):
+        self._select_by(1)
+
+    def select_previous(self):
+        self._select_by(-1)
+
+
 class Loop(object):
     """
     Represents a single loop in the looper.
     """
     WAIT, RECORDING, OVERDUBBING, PLAYBACK, PAUSED = range(5)
+    STATES = ["WAIT", "RECORDING", "OVERDUBBING", "PLAYBACK", "PAUSED"]
 
     def __init__(self, looper=None, loop_index=0):
         self.index = loop_index
@@ -299,7 +771,68 @@ class Loop(object):
         self.layers = 0
 
         # this assumes a brand new Loop...
-        self.state = self.WAIT
+        self._state = self.WAIT
+        # when the state was last changed locally, rather than reported
+        # by SooperLooper
+        self.changed = 0
+
+        # reported by SooperLooper when live state is enabled
+        self.waiting = False
+        self.position = 0.0
+        self.length = 0.0
+        # unix time at which the position was reported
+        self.position_time = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        if state != self._state:
+            self._count_transition(state)
+        self._state = state
+        self.changed = time.monotonic()
+
+    def _count_transition(self, state):
+        metrics.transitions.inc(
+            "" if self.looper is None else self.looper.instance,
+            self.index, self.STATES[state])
+
+    def sync_state(self, state):
+        """
+        Reconcile with the state reported by SooperLooper. Layers are not
+        reported, so count those that were started from elsewhere (e.g. the
+        GUI) from the transitions we see.
+        """
+        if state == self._state:
+            return
+        self._count_transition(state)
+        if state == self.RECORDING:
+            self.current_layer = self.layers = 1
+        elif state == self.OVERDUBBING:
+            self.current_layer += 1
+            self.layers = self.current_layer
+        elif state == self.WAIT:
+            self.current_layer = 0
+        self._state = state
+
+    def bind(self, values):
+        """
+        Take the state of a loop SooperLooper already has from the values
+        of BIND_CONTROLS it reported
+        """
+        if "state" in values:
+            self._state = SL_STATES.get(int(values["state"]), self.WAIT)
+        elif settings.DEBUG:
+            print("Loop {}: state unknown, assumed empty".format(self.index))
+        if self._state != self.WAIT:
+            # earlier layers can't be known; count what it has as one
+            self.current_layer = self.layers = 1
+        self.length = values.get("loop_len", 0.0)
+        if "loop_pos" in values:
+            self.position = values["loop_pos"]
+            self.position_time = time.time()
 
     def select(self):
         """
@@ -368,7 +901,7 @@ class Loop(object):
 
     def toggle_pause(self):
         self.looper.channel.pause(self.index)
-        relf.state = \
+        self.state = \
             self.PLAYBACK if self.state == self.PAUSED else self.PAUSED
 
     def stop_record_and_discard(self):
@@ -379,3 +912,25 @@ class Loop(object):
         if self.state in [self.RECORDING, self.OVERDUBBING]:
            self.play_record_or_overdub()  # will toggle to playback
            self.undo()                    # discard last layer
+
+
+# SooperLooper state codes mapped to our simpler model. Pending
+# (quantized) transitions map to the state being moved into.
+SL_STATES = {
+    0: Loop.WAIT,           # Off
+    1: Loop.RECORDING,      # WaitStart
+    2: Loop.RECORDING,      # Recording
+    3: Loop.PLAYBACK,       # WaitStop
+    4: Loop.PLAYBACK,       # Playing
+    5: Loop.OVERDUBBING,    # Overdubbing
+    6: Loop.OVERDUBBING,    # Multiplying
+    7: Loop.OVERDUBBING,    # Inserting
+    8: Loop.OVERDUBBING,    # Replacing
+    9: Loop.PLAYBACK,       # Delay
+    10: Loop.PLAYBACK,      # Muted
+    11: Loop.PLAYBACK,      # Scratching
+    12: Loop.PLAYBACK,      # OneShot
+    13: Loop.OVERDUBBING,   # Substitute
+    14: Loop.PAUSED,        # Paused
+    20: Loop.WAIT,          # OffMuted
+}
@@ -0,0 +1,211 @@
+"""
+Counters and histograms of the controller's internals
+
+Counting must cost the input and send paths next to nothing and never
+wait on a lock, so each metric keeps a shard per thread that only that
+thread writes to: a dict of label values -> count, or for histograms a
+list of bucket counts. A scrape sums the shards, copying each dict or
+list in one step under the GIL; it never takes a lock the counting side
+takes, so scraping can't hold up input or sends. Gauges such as queue
+depths are read only when scraped.
+
+If settings.METRICS_PORT is set, lc.py serves everything in the
+Prometheus text format on http://<settings.METRICS_HOST>:<port>/metrics
+from a daemon thread. Until then nothing is counted, so that metrics
+cost the dispatch path nothing unless they are wanted.
+"""
+import bisect
+import threading
+
+
+get_ident = threading.get_ident
+
+# set once the metrics are served
+enabled = False
+
+
+def _by_label(item):
+    return [str(value) for value in item[0]]
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+    def _label_string(self, values):
+        pairs = ['{}="{}"'.format(label, value)
+                 for label, value in zip(self.labels, values)]
+        return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    """
+    Counts by label values, e.g. osc_sent.inc("bundle") for a counter
+    with labels ("kind",)
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # thread id -> {label values: count}
+        self.shards = {}
+
+    def inc(self, *values):
+        if not enabled:
+            return
+        shard = self.shards.get(get_ident())
+        if shard is None:
+            shard = self.shards[get_ident()] = {}
+        shard[values] = shard.get(values, 0) + 1
+
+    def values(self):
+        totals = {}
+        for shard in list(self.shards.values()):
+            for values, count in dict(shard).items():
+                totals[values] = totals.get(values, 0) + count
+        return totals
+
+    def samples(self):
+        totals = self.values()
+        if not totals and not self.labels:
+            totals[()] = 0
+        return ["{}{} {}".format(self.name, self._label_string(values), count)
+                for values, count in sorted(totals.items(), key=_by_label)]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values over fixed bucket upper bounds
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help)
+        self.buckets = list(buckets)
+        # thread id -> [count per bucket..., count above, sum]
+        self.shards = {}
+
+    def observe(self, value):
+        if not enabled:
+            return
+        shard = self.shards.get(get_ident())
+        if shard is None:
+            shard = self.shards[get_ident()] = \
+                [0] * (len(self.buckets) + 1) + [0.0]
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def samples(self):
+        size = len(self.buckets) + 2
+        totals = [0] * size
+        for shard in list(self.shards.values()):
+            shard = list(shard)
+            for i in range(size):
+                totals[i] += shard[i]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], totals):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                self.name, bound, cumulative))
+        lines.append("{}_sum {}".format(self.name, totals[-1]))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    """
+    Values read when scraped, from a function per label value
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # label values -> function
+        self.functions = {}
+
+    def track(self, fn, *values):
+        self.functions[values] = fn
+
+    def samples(self):
+        return ["{}{} {}".format(self.name, self._label_string(values), fn())
+                for values, fn in sorted(self.functions.items(),
+                                         key=_by_label)]
+
+
+registry = []
+
+
+def render():
+    """
+    All metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def serve(host, port):
+    """
+    Serve the metrics over HTTP from a daemon thread, and start counting.
+    Returns the server.
+    """
+    global enabled
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    enabled = True
+    threading.Thread(target=server.serve_forever,
+                     name="Metrics",
+                     daemon=True).start()
+    return server
+
+
+events = Counter("lc_input_events_total",
+                 "Input events dispatched, by input handler", ("handler",))
+dispatch_misses = Counter("lc_dispatch_misses_total",
+                          "Input events with no command mapped",
+                          ("handler",))
+dispatch_seconds = Histogram(
+    "lc_dispatch_seconds", "Time to handle an input event",
+    [0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03])
+queue_depth = Gauge("lc_input_queue_depth",
+                    "Input events waiting to be handled", ("handler",))
+osc_sent = Counter("lc_osc_sent_total",
+                   "OSC datagrams sent to SooperLooper, messages or bundles",
+                   ("kind",))
+bridge_datagrams = Counter("lc_bridge_datagrams_total",
+                           "Datagrams received by the bridge server, by "
+                           "what became of them", ("kind",))
+transitions = Counter("lc_loop_transitions_total",
+                      "Loop state changes, made here or reported by "
+                      "SooperLooper", ("instance", "loop", "state"))
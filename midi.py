@@ -1,62 +1,377 @@
 """
 Command set for interfacing with MIDI controlled systems
-"""
-import queue
 
-import jack
+MIDI goes out through a JACK port, written by the JACK process callback
+on the real-time audio thread. Nothing that can block may happen there,
+so messages are handed over pre-encoded, as fixed size records in a
+lock-free jack.RingBuffer, and the callback takes no locks and does no
+I/O: what it wrote is passed back through a second ring buffer to be
+logged and measured on an ordinary thread.
+
+Each message is stamped with the JACK frame at which it should go out:
+the frame at which its input was captured plus a constant delay of one
+period (settings.MIDI_OUTPUT_DELAY), so that it lands at the same sample
+offset relative to the press however the process cycles fall. Messages
+can also be scheduled further ahead, such as the note off ending each
+note, so the process callback moves them from the ring buffer into a
+heap ordered by frame, and writes out those due in each cycle.
+"""
+import array
+import atexit
+import collections
+import struct
+import threading
+import time
 
 from base import BaseCommandSet
+import latency
+import settings
+
+
+# target frame, length, up to 3 bytes of message
+_event = struct.Struct("<IB3s")
+EVENT_SIZE = _event.size
+# as _event plus the frame actually written at
+_written = struct.Struct("<IB3sI")
+WRITTEN_SIZE = _written.size
+
+# timing errors remembered for reporting
+ERROR_WINDOW = 4096
+
+# heap keys are frame << SEQUENCE_BITS | sequence, so that messages for
+# the same frame go out in the order they were sent
+SEQUENCE_BITS = 20
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+
+class FrameHeap(object):
+    """
+    Binary min-heap of (key, message) pairs held in preallocated arrays,
+    so that the heap never grows or reallocates in the process callback,
+    however many messages are pending. Messages are packed into an int as
+    length << 24 | byte 0 << 16 | byte 1 << 8 | byte 2.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.keys = array.array("q", bytes(8 * capacity))
+        self.messages = array.array("q", bytes(8 * capacity))
+        self.size = 0
+
+    def push(self, key, message):
+        """
+        Returns False if the heap is full
+        """
+        if self.size == self.capacity:
+            return False
+        keys = self.keys
+        messages = self.messages
+        i = self.size
+        self.size += 1
+        while i:
+            parent = (i - 1) >> 1
+            if keys[parent] <= key:
+                break
+            keys[i] = keys[parent]
+            messages[i] = messages[parent]
+            i = parent
+        keys[i] = key
+        messages[i] = message
+        return True
+
+    def pop(self):
+        """
+        Remove the smallest key, returning its message
+        """
+        keys = self.keys
+        messages = self.messages
+        message = messages[0]
+        self.size -= 1
+        size = self.size
+        if not size:
+            return message
+        key = keys[size]
+        last = messages[size]
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size and keys[child + 1] < keys[child]:
+                child += 1
+            if key <= keys[child]:
+                break
+            keys[i] = keys[child]
+            messages[i] = messages[child]
+            i = child
+        keys[i] = key
+        messages[i] = last
+        return message
+
+
+class MidiEngine(object):
+    """
+    Real-time safe MIDI output on a JACK port. The JACK client is only
+    created by start().
+
+    send() must only ever be called from one thread: the ring buffer is
+    safe for a single reader and a single writer.
+    """
+    def __init__(self, name=None, port="midi_out", size=None, delay=None):
+        self.name = settings.MIDI_CLIENT_NAME if name is None else name
+        self.port_name = port
+        self.size = settings.MIDI_RINGBUFFER_SIZE if size is None else size
+        self.delay = settings.MIDI_OUTPUT_DELAY if delay is None else delay
+        self.client = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.xruns = 0
+        # updated by the process callback only
+        self.written = 0
+        self.late = 0
+        self.log_overflows = 0
+        # frames late of each message written, from the log
+        self.errors = collections.deque(maxlen=ERROR_WINDOW)
+        self.full = 0
+        self.record = bytearray(EVENT_SIZE)
+        self.log_record = bytearray(WRITTEN_SIZE)
 
+        # used by the process callback only
+        self.heap = FrameHeap(settings.MIDI_SCHEDULE_SIZE)
+        self.sequence = 0
+        # frame at the start of this cycle, and the same as a count that
+        # doesn't wrap at 32 bits
+        self.cycle_start = None
+        self.frame = 0
+        # a buffer for each length of message written
+        self.out = [bytearray(length) for length in range(4)]
 
-# MIDI system setup
-midi_msg_q = queue.Queue()
+    def start(self):
+        import jack
 
-client = jack.Client("PedalBoard")
-midi_out = client.midi_outports.register("midi_out")
+        self.client = jack.Client(self.name)
+        self.port = self.client.midi_outports.register(self.port_name)
+        self.rate = self.client.samplerate
+        if self.delay is None:
+            self.delay = self.client.blocksize
+        # EVENT_SIZE divides the ring buffer's power of two size, so an
+        # event is never split across the end of the buffer
+        self.events = jack.RingBuffer(self.size)
+        self.log = jack.RingBuffer(self.size * 2)
+        for ring in [self.events, self.log]:
+            try:
+                ring.mlock()
+            except jack.JackError:
+                pass
 
-@client.set_process_callback
-def process(frames):
-    midi_out.clear_buffer()
-    try:
+        self.client.set_process_callback(self._process)
+        self.client.set_xrun_callback(self._xrun)
+        self.client.activate()
+
+        threading.Thread(target=self._run_log,
+                         name="MidiLog",
+                         daemon=True).start()
+        atexit.register(self.report)
+        return self
+
+    def frame_for(self, stamp=None):
+        """
+        JACK frame at which to send a message for input captured at
+        `stamp` (latency.now() time), or now if None
+        """
+        frame = self.client.frame_time + self.delay
+        if stamp is not None:
+            frame -= int((latency.now() - stamp) * self.rate // 1000000000)
+        return frame & 0xFFFFFFFF
+
+    def send(self, message, stamp=None, frame=None):
+        """
+        Queue a MIDI message of up to 3 bytes to go out at `frame`, by
+        default that for input captured at `stamp`. Returns False if the
+        ring buffer is full and the message was dropped.
+        """
+        if frame is None:
+            frame = self.frame_for(stamp)
+        _event.pack_into(self.record, 0, frame, len(message), bytes(message))
+        if self.events.write_space < EVENT_SIZE:
+            self.dropped += 1
+            return False
+        self.events.write(self.record)
+        self.sent += 1
+        return True
+
+    def note(self, channel, note, velocity=127, length=None, stamp=None):
+        """
+        Note on, and a note off `length` seconds later (by default
+        settings.MIDI_NOTE_LENGTH; 0 for no note off). Returns False if
+        the ring buffer has no room for both, in which case neither is
+        queued, rather than leave a note on stuck without its note off.
+        """
+        if length is None:
+            length = settings.MIDI_NOTE_LENGTH
+        count = 2 if length else 1
+        if self.events.write_space < count * EVENT_SIZE:
+            self.dropped += count
+            return False
+        frame = self.frame_for(stamp)
+        self.send((0x90 | channel, note, velocity), frame=frame)
+        if length:
+            self.send((0x80 | channel, note, 0),
+                      frame=(frame + int(length * self.rate)) & 0xFFFFFFFF)
+        return True
+
+    def control_change(self, channel, controller, value, stamp=None):
+        self.send((0xB0 | channel, controller, value), stamp)
+
+    def program_change(self, channel, program, stamp=None):
+        self.send((0xC0 | channel, program), stamp)
+
+    def _process(self, frames):
+        """
+        JACK process callback, on the real-time thread
+        """
+        self.port.clear_buffer()
+        start = self.client.last_frame_time
+        if self.cycle_start is None:
+            self.frame = start
+        else:
+            self.frame += (start - self.cycle_start) & 0xFFFFFFFF
+        self.cycle_start = start
+
+        first, second = self.events.read_buffers
+        used = self._schedule(first)
+        if used == len(first):
+            used += self._schedule(second)
+        if used:
+            self.events.read_advance(used)
+
+        heap = self.heap
+        keys = heap.keys
+        end = (self.frame + frames) << SEQUENCE_BITS
+        while heap.size and keys[0] < end:
+            target = keys[0] >> SEQUENCE_BITS
+            message = heap.pop()
+            offset = target - self.frame
+            if offset < 0:
+                # due in a cycle already gone
+                offset = 0
+                self.late += 1
+            length = message >> 24
+            out = self.out[length]
+            for i in range(length):
+                out[i] = (message >> (16 - 8 * i)) & 0xFF
+            self.port.write_midi_event(offset, out)
+            self.written += 1
+
+            _written.pack_into(self.log_record, 0, target & 0xFFFFFFFF,
+                               length, out, (start + offset) & 0xFFFFFFFF)
+            if self.log.write_space >= WRITTEN_SIZE:
+                self.log.write(self.log_record)
+            else:
+                self.log_overflows += 1
+
+    def _schedule(self, buffer):
+        """
+        Move the messages in `buffer` into the heap. Returns the bytes
+        used; messages left when the heap is full stay in the ring buffer.
+        """
+        used = 0
+        while used + EVENT_SIZE <= len(buffer):
+            frame, length, data = _event.unpack_from(buffer, used)
+            delta = (frame - self.cycle_start) & 0xFFFFFFFF
+            if delta & 0x80000000:
+                delta -= 0x100000000
+            message = (length << 24) | (data[0] << 16) | (data[1] << 8) | data[2]
+            key = ((self.frame + delta) << SEQUENCE_BITS) | self.sequence
+            if not self.heap.push(key, message):
+                self.full += 1
+                break
+            self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+            used += EVENT_SIZE
+        return used
+
+    def _xrun(self, delayed_usecs):
+        self.xruns += 1
+
+    def _run_log(self):
         while True:
-            midi_msg = midi_msg_q.get(block=False)
-            print("Channel {}: note {}, velocity {}".format(*midi_msg))
-            midi_out.write_midi_event(0, midi_msg)
-    except queue.Empty:
-        pass
+            time.sleep(0.05)
+            space = self.log.read_space
+            space -= space % WRITTEN_SIZE
+            if not space:
+                continue
+            data = self.log.read(space)
+            for target, length, message, written in \
+                    _written.iter_unpack(data):
+                error = (written - target) & 0xFFFFFFFF
+                if error & 0x80000000:
+                    error -= 0x100000000
+                self.errors.append(error)
+                if settings.DEBUG:
+                    print("MIDI {} at frame {} ({} late)".format(
+                        message[:length].hex(), written, error))
+
+    def report(self):
+        errors = sorted(self.errors)
+        print("MIDI: sent {}, written {}, dropped {}, late {}, xruns {}, "
+              "schedule full {}, frames late p50 {} max {}".format(
+                  self.sent, self.written, self.dropped, self.late,
+                  self.xruns, self.full,
+                  errors[len(errors) // 2] if errors else 0,
+                  errors[-1] if errors else 0))
+
 
-client.activate()
+engine = None
 
-def midi_note_on(channel, midi_note):
-    '''Transmit a MIDI "note on" message'''
-    midi_msg_q.put((0x90 | channel, midi_note, 127))
 
-# End MIDI system setup
+def get_engine():
+    """
+    The shared MIDI output engine, started on first use
+    """
+    global engine
+    if engine is None:
+        engine = MidiEngine().start()
+    return engine
+
+
+def midi_note_on(channel, midi_note, stamp=None):
+    '''Transmit a MIDI "note on" message, and its "note off" in due course'''
+    get_engine().note(channel, midi_note, stamp=stamp)
 
 
 class MidiCommandSet(BaseCommandSet):
     """
     Handle commands from *both* stomp box and keyboard for MIDI.
 
-    Handler functions combining handlers for keyboard and stomp nbox
-    input which output MIDI notes to JACK and can thus, through the JACK
-    patch panel, be wired to any MIDI controllable client such as
-    looper, drum machine or synth.
+    Actions for keyboard and stomp box input which output MIDI notes,
+    control and program changes to JACK and can thus, through the JACK
+    patch panel, be wired to any MIDI controllable client such as looper,
+    drum machine or synth. Which key sends what is set by the keymap.
     """
-    def handle_0(self):
-        midi_note_on(0, 60)
-
-    def handle_double_0(self):
-        midi_note_on(0, 61)
+    keymap = "keymaps/midi.json"
+    needs_looper = False
 
-    def handle_1(self):
-        midi_note_on(0, 62)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = get_engine()
 
-    def handle_double_1(self):
-        midi_note_on(0, 63)
+    def note_on(self, channel, note, velocity=127, length=None):
+        """
+        Play a note for `length` seconds (settings.MIDI_NOTE_LENGTH if not
+        given)
+        """
+        self.engine.note(channel, note, velocity, length, self.stamp)
 
-    def handle_2(self):
-        midi_note_on(0, 64)
+    def control_change(self, channel, controller, value=None):
+        """
+        Send a control change, of the input's value (e.g. from a pedal)
+        if no value is given
+        """
+        if value is None:
+            value = self.value
+        if value is not None:
+            self.engine.control_change(channel, controller, value,
+                                       self.stamp)
 
-    def handle_double_2(self):
-        midi_note_on(0, 65)
+    def program_change(self, channel, program):
+        self.engine.program_change(channel, program, self.stamp)
@@ -0,0 +1,202 @@
+"""
+Several input sources in one process
+
+Each input handler's start() blocks in a loop of its own, so a config
+set has only one. On stage, the stomp box, a keyboard and bridged
+remote pedals all want to drive the same looper at once. Rather than
+run each on a thread, with the looper's state shared between them, the
+Multiplexer hosts them all on a single event loop: sources register
+the sockets they read (add_reader) and the work they do on a timer,
+such as sampling switches or firing long presses (add_poller, every),
+and hand the events they recognise to post().
+
+Posted events are merged into one stream ordered by their input stamps
+and handled on the multiplexer's thread. So are loop state reported by
+SooperLooper (livestate.py) and quantized commands (quantize.py), so
+that command sets and the looper's loops are only ever changed from
+there. Events are held back for settings.MUX_REORDER_WINDOW before being
+handled, to be put in order with any from other sources that took longer
+to arrive; with no window, those recognised in the same wake-up are
+handled in order, at once.
+
+Inputs that can only call back on a thread of their own, such as the
+keyboard listener or the JACK process callback, pass what they get over
+with call_threadsafe(), which wakes the loop.
+"""
+import atexit
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+
+import latency
+import metrics
+import settings
+
+
+class Interval(object):
+    """
+    Call `fn(now)` every `interval` seconds, not catching up on calls
+    missed
+    """
+    def __init__(self, interval, fn):
+        self.interval = int(interval * 1e9)
+        self.fn = fn
+        self.due = latency.now()
+
+    def timeout(self, now):
+        return max(0, self.due - now) / 1e9
+
+    def poll(self, now):
+        if now >= self.due:
+            self.fn(now)
+            self.due = max(self.due + self.interval, now)
+
+
+class Multiplexer(object):
+    """
+    Run several input handlers at once, handling all their events on one
+    thread in the order of their input stamps. Handlers take part through
+    their attach() method. Given the `looper`, its reported state is
+    applied and its quantized commands fired on the same thread.
+    """
+    def __init__(self, handlers, window=None, looper=None):
+        self.handlers = handlers
+        self.looper = looper
+        if window is None:
+            window = settings.MUX_REORDER_WINDOW
+        self.window = int(window * 1e9)
+        self.selector = selectors.DefaultSelector()
+        # (timeout, poll) functions of the time now
+        self.pollers = []
+        # [stamp, sequence, fn, args] waiting to be handled
+        self.pending = []
+        self.sequence = itertools.count()
+        self.calls = collections.deque()
+        self.last_stamp = None
+
+        self.dispatched = 0
+        self.out_of_order = 0
+        metrics.queue_depth.track(lambda: len(self.pending), __name__)
+
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.add_reader(self.wake_reader, self._woken)
+
+    def add_reader(self, fileobj, callback):
+        """
+        Call `callback()` whenever `fileobj` is readable
+        """
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def add_poller(self, timeout, poll):
+        """
+        Call `poll(now)` on every wake-up, waking up no later than
+        `timeout(now)` seconds from now, unless it is None
+        """
+        self.pollers.append((timeout, poll))
+
+    def every(self, interval, fn):
+        interval = Interval(interval, fn)
+        self.add_poller(interval.timeout, interval.poll)
+        return interval
+
+    def post(self, stamp, fn, *args):
+        """
+        Call `fn(*args)` in turn with the events of all sources, ordered
+        by `stamp` (latency.now() time). Only for the multiplexer's
+        thread.
+        """
+        if stamp is None:
+            stamp = latency.now()
+        heapq.heappush(self.pending, [stamp, next(self.sequence), fn, args])
+
+    def call_threadsafe(self, fn, *args):
+        """
+        Call `fn(*args)` on the multiplexer's thread, from any thread
+        """
+        self.calls.append((fn, args))
+        self.wake()
+
+    def wake(self):
+        """
+        Have the loop go round, from any thread
+        """
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            # already plenty of wake-ups waiting
+            pass
+
+    def _woken(self):
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def timeout(self, now):
+        """
+        Seconds until something is due, or None
+        """
+        timeouts = [timeout(now) for timeout, poll in self.pollers]
+        if self.pending:
+            timeouts.append(max(0, self.pending[0][0] + self.window - now)
+                            / 1e9)
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def run_once(self):
+        """
+        Wait for input or for something to fall due, and handle whatever
+        is ready
+        """
+        for key, mask in self.selector.select(self.timeout(latency.now())):
+            key.data()
+        calls = self.calls
+        while calls:
+            fn, args = calls.popleft()
+            fn(*args)
+        now = latency.now()
+        for timeout, poll in self.pollers:
+            poll(now)
+        self.dispatch(latency.now())
+
+    def dispatch(self, now):
+        """
+        Handle the events posted up to the reorder window before `now`,
+        in stamp order
+        """
+        pending = self.pending
+        due = now - self.window
+        while pending and pending[0][0] <= due:
+            stamp, sequence, fn, args = heapq.heappop(pending)
+            if self.last_stamp is not None and stamp < self.last_stamp:
+                # arrived after a later event was already handled
+                self.out_of_order += 1
+            else:
+                self.last_stamp = stamp
+            self.dispatched += 1
+            fn(*args)
+
+    def start(self):
+        """
+        Attach the input handlers and run them. This will block for ever.
+        """
+        for handler in self.handlers:
+            handler.attach(self)
+        if self.looper is not None:
+            for member in getattr(self.looper, "loopers", [self.looper]):
+                if member.state_store is not None:
+                    member.state_store.attach(self)
+            if self.looper.scheduler is not None:
+                self.looper.scheduler.attach(self)
+        atexit.register(self.report)
+        while True:
+            self.run_once()
+
+    def report(self):
+        print("Input mux: {} sources, handled {}, out of order {}".format(
+            len(self.handlers), self.dispatched, self.out_of_order))
@@ -0,0 +1,94 @@
+"""
+Pre-encoded OSC datagrams for the messages we send to SooperLooper
+
+The set of messages sent while playing is small and fixed, so rather than
+build and encode an OSC message for every pedal press we encode each
+(command, loop) combination once and send the stored bytes. `set`
+messages keep a buffer per (control, loop) into which only the float
+payload is patched.
+"""
+import struct
+
+from osc4py3 import oscbuildparse
+
+
+HIT_COMMANDS = ["record", "overdub", "undo", "redo", "pause", "trigger",
+                "undo_all"]
+GLOBAL_CONTROLS = ["selected_loop_num"]
+
+# loop indexes for which templates are built up front. -3 is the
+# selected loop and -1 all loops. Others are encoded on first use.
+TEMPLATE_LOOPS = [-3, -1] + list(range(16))
+
+_float = struct.Struct(">f")
+
+
+def encode(address, formatter, args):
+    """
+    Encode a single OSC message to bytes
+    """
+    return bytes(oscbuildparse.encode_packet(
+        oscbuildparse.OSCMessage(address, formatter, args)))
+
+
+class TemplateCache(object):
+    """
+    Cache of encoded OSC datagrams keyed by (command, loop)
+    """
+    def __init__(self, loops=TEMPLATE_LOOPS):
+        self.hits = {}
+        self.sets = {}
+        self.global_sets = {}
+
+        for loop in loops:
+            for command in HIT_COMMANDS:
+                self._build_hit(command, loop)
+        for control in GLOBAL_CONTROLS:
+            self._build_global_set(control)
+
+    def _build_hit(self, command, loop):
+        data = encode("/sl/{}/hit".format(loop), ",s", [command])
+        self.hits[(command, loop)] = data
+        return data
+
+    def _build_set(self, control, loop):
+        # float payload is always the last four bytes
+        data = bytearray(
+            encode("/sl/{}/set".format(loop), ",sf", [control, 0.0]))
+        self.sets[(control, loop)] = data
+        return data
+
+    def _build_global_set(self, control):
+        data = bytearray(encode("/set", ",sf", [control, 0.0]))
+        self.global_sets[control] = data
+        return data
+
+    def hit(self, command, loop=-3):
+        """
+        Return the datagram for a 'hit' of `command` on `loop`
+        """
+        data = self.hits.get((command, loop))
+        if data is None:
+            data = self._build_hit(command, loop)
+        return data
+
+    def set(self, control, value, loop=-3):
+        """
+        Return the datagram setting `control` to `value` on `loop`. The
+        buffer is re-used, so send it before asking for the same one again.
+        """
+        data = self.sets.get((control, loop))
+        if data is None:
+            data = self._build_set(control, loop)
+        _float.pack_into(data, len(data) - 4, value)
+        return data
+
+    def global_set(self, control, value):
+        """
+        Return the datagram setting global `control` to `value`
+        """
+        data = self.global_sets.get(control)
+        if data is None:
+            data = self._build_global_set(control)
+        _float.pack_into(data, len(data) - 4, value)
+        return data
@@ -0,0 +1,186 @@
+"""
+Commands quantized to the loop
+
+SooperLooper quantizes what it is sent to the cycle of its own accord,
+but only the loop commands it knows how to quantize, and only to the
+cycle. Here any command or scene can be held back to the next cycle or
+bar boundary of the sync loop instead.
+
+Where the loop is comes from SooperLooper's auto-updates of loop_pos
+and loop_len (see livestate.py), extrapolated from when they were
+received. Rather than send on the boundary and have the command
+arrive late by however long the network takes, it is sent
+settings.QUANTIZE_LEAD seconds ahead, as a bundle timetagged for the
+boundary itself.
+
+Times are unix times in seconds, as for OSC timetags, read from a clock
+function given to the scheduler, so that it can be run against a
+simulated clock by calling poll() rather than start(). Under a
+mux.Multiplexer, attach() has the multiplexer's thread poll it instead.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+from looper import Loop
+import settings
+
+
+class Timers(object):
+    """
+    Actions pending at given times, in a heap. Adding costs O(log n)
+    however many are pending; cancelling just marks the action, which is
+    discarded when it comes to the top.
+    """
+    def __init__(self):
+        # [when, sequence, fn, args]
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, when, fn, *args):
+        """
+        Call `fn(*args)` at `when`. Returns a handle for cancel().
+        """
+        entry = [when, next(self.sequence), fn, args]
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def next_due(self):
+        """
+        When the next action is due, or None if there are none
+        """
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now):
+        """
+        Remove and return the (fn, args) of actions due at `now`, in
+        order
+        """
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= now:
+            when, sequence, fn, args = heapq.heappop(heap)
+            if fn is not None:
+                due.append((fn, args))
+        return due
+
+
+class QuantizedScheduler(object):
+    """
+    Fire actions on the cycle or bar boundaries of the looper's sync loop
+    """
+    def __init__(self, looper, lead=None, clock=time.time):
+        self.looper = looper
+        self.lead = settings.QUANTIZE_LEAD if lead is None else lead
+        self.bars = max(1, settings.QUANTIZE_EIGHTHS_PER_CYCLE //
+                        settings.QUANTIZE_EIGHTHS_PER_BAR)
+        self.clock = clock
+        self.timers = Timers()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="QuantizedScheduler",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def loop(self):
+        if self.looper.master is not None:
+            return self.looper.master
+        return self.looper.loops[0] if self.looper.loops else None
+
+    def boundary(self, now, divisions=1):
+        """
+        Time of the next of `divisions` equal points in the sync loop's
+        cycle after `now`, or None if it isn't playing
+        """
+        loop = self.loop
+        if (loop is None or loop.length <= 0 or loop.position_time is None
+                or loop.state not in [Loop.PLAYBACK, Loop.OVERDUBBING]):
+            return None
+        position = (loop.position + now - loop.position_time) % loop.length
+        step = loop.length / divisions
+        return now + step - position % step
+
+    def at_cycle(self, fn, *args):
+        return self.at(1, fn, *args)
+
+    def at_bar(self, fn, *args):
+        return self.at(self.bars, fn, *args)
+
+    def at(self, divisions, fn, *args):
+        """
+        Call `fn(*args)` to take effect on the next of `divisions` points
+        in the cycle, or now if the loop isn't playing. Returns a handle
+        for cancel(), or None if `fn` was called now.
+        """
+        now = self.clock()
+        boundary = self.boundary(now, divisions)
+        if boundary is None:
+            fn(*args)
+            return None
+        with self.condition:
+            entry = self.timers.add(boundary - self.lead, self._fire,
+                                    boundary, fn, args)
+            self.condition.notify()
+        if settings.DEBUG:
+            print("Quantized {} to {:.3f}s from now".format(
+                getattr(fn, "__name__", fn), boundary - now))
+        return entry
+
+    def cancel(self, entry):
+        with self.condition:
+            self.timers.cancel(entry)
+
+    def attach(self, mux):
+        """
+        Fire actions on the thread of a mux.Multiplexer, instead of
+        start()
+        """
+        mux.add_poller(lambda now: self.timeout(),
+                       lambda now: self.poll(self.clock()))
+
+    def timeout(self):
+        """
+        Seconds until the next action is due, or None
+        """
+        with self.condition:
+            due = self.timers.next_due()
+        if due is None:
+            return None
+        return max(0, due - self.clock())
+
+    def _fire(self, boundary, fn, args):
+        with self.looper.scheduled(boundary):
+            fn(*args)
+
+    def poll(self, now):
+        """
+        Send the actions due at `now`
+        """
+        with self.condition:
+            due = self.timers.pop_due(now)
+        for fn, args in due:
+            fn(*args)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                due = self.timers.next_due()
+                if due is None or due > self.clock():
+                    self.condition.wait(
+                        None if due is None else due - self.clock())
+            self.poll(self.clock())
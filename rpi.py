@@ -2,79 +2,91 @@
 Input handler for Raspberry Pi with external switches (stomp box foot
 switches)
 
+Switches are sampled and debounced in software (see debounce.py), so
+both the press and the release are seen and the gesture engine can
+recognise long presses as well as double and triple taps.
+
 Issues and features to consider:
 
-    * de-bouncing is a problem. On my test momentary switch, the release
-    * generates GPIO.FALLING events even with a 0.1uF capacitor. Maybe
-      try bigger capacitor? Different mix of capacitor and software
-      debounce?
-    * implement timer, as per keyboard input handler, for:
-      - [x] double tap
-      - [ ] long press - see if trap FALLING and RISING with soft debounce
-        is reliable. If so, can implement long-press options.
     * may need to implement handler for latching switches, but not until
       the need arises
 """
 from queue import Queue
-
-import RPi.GPIO as GPIO
+import threading
 
 from base import BaseInputHandler
-from utils import Intervals
+from debounce import Debouncer
+import events
+import gestures
+import latency
+import metrics
 import settings
-
-
-GPIO.setmode(GPIO.BOARD)
+from utils import get_class_from_string
 
 
 class InputHandler(BaseInputHandler):
     def __init__(self, command_set):
         super().__init__(command_set)
         self.q = Queue()
+        # read without the queue's lock, so as never to hold up input
+        metrics.queue_depth.track(lambda: len(self.q.queue), __name__)
         self.channel_map = {}
-        self.timer = Intervals()
+        # channel -> event key code
+        self.key_map = {}
+        self.gestures = gestures.GestureEngine(self.handle,
+                                               settings.DOUBLE_TAP_INTERVAL,
+                                               settings.LONG_PRESS_INTERVAL)
 
     def start(self):
         """
-        Setup event handlers for switch input.
+        Start sampling the switches and act on their presses.
 
         Currently only coded for momentary switches; latching switches
         to come.
 
-        Can't yet do double taps.
-
         Configured with pull-up on the pin keeping it high. When switch closes,
         it should go to ground.
         """
-        idx = 0
-        for channel in settings.SWITCH_CHANNELS:
-            GPIO.setup(channel, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.add_event_detect(channel,
-                                  GPIO.FALLING,
-                                  callback=self.handle_press,
-                                  bouncetime=settings.GPIO_DEBOUNCE_DELAY)
-            self.channel_map[channel] = idx
-            idx += 1
+        debouncer = self._debouncer()
+        threading.Thread(target=debouncer.run,
+                         name="Debouncer",
+                         daemon=True).start()
 
-        # process requests in the main thread, not on the event thread
-        while True:
-            ch = self.q.get()
-            self.command_set.handle(ch)
+        # process requests in the main thread, not on the sampling thread
+        self.gestures.run(self.q)
 
-    def handle_press(self, channel):
+    def attach(self, mux):
         """
-        Handle button press events.
+        Run in a multiplexer, which samples the switches itself every
+        settings.SWITCH_SAMPLE_INTERVAL
         """
-        # convert channel to logical switch number (zero indexed)
-        switch = self.channel_map[channel]
+        self.mux = mux
+        debouncer = self._debouncer()
+        debouncer.backend.setup(debouncer.channels)
+        mux.every(settings.SWITCH_SAMPLE_INTERVAL, debouncer.sample)
+        mux.add_poller(self.gestures.timeout, self.gestures.poll)
+
+    def _debouncer(self):
+        for idx, channel in enumerate(settings.SWITCH_CHANNELS):
+            self.channel_map[channel] = idx
+            self.key_map[channel] = events.KEY_CODES[str(idx)]
 
-        if self.timer.lap() <= settings.DOUBLE_TAP_INTERVAL:
-            prefix = "double_"
-        else:
-            prefix = ""
+        backend = get_class_from_string(settings.SWITCH_BACKEND)()
+        return Debouncer(settings.SWITCH_CHANNELS, self.handle_switch,
+                         backend)
 
+    def handle_switch(self, action, channel, stamp):
+        """
+        Handle debounced switch presses and releases
+        """
         if settings.DEBUG:
-            print("Callback for channel/switch {}/{}".format(channel, switch))
+            print("Switch {} on channel/switch {}/{}".format(
+                "press" if action == gestures.PRESS else "release",
+                channel, self.channel_map[channel]))
 
-        # call appropriate command
-        self.q.put_nowait("{}{}".format(prefix, switch))
+        latency.record("input", stamp)
+        if self.mux is None:
+            self.q.put_nowait((action, self.key_map[channel], stamp))
+        else:
+            # already on the multiplexer's thread
+            self.gestures.feed(action, self.key_map[channel], stamp)
@@ -0,0 +1,99 @@
+"""
+Scenes: named multi-loop actions sent as a single OSC bundle
+
+A scene such as "mute loops 1-3 and trigger loop 4" is compiled once
+from the pre-encoded message templates, both as its messages and as one
+encoded bundle of them. With `settings.SCENE_LATENCY` set, firing it
+patches in a timetag shared by every message and sends one datagram, so
+the changes land together however many loops are involved. Otherwise
+the messages are sent plainly, one after another, as before scenes.
+
+SooperLooper schedules a bundle with a future timetag against its own
+clock, so timetagging is opt-in: it assumes the clocks of the two hosts
+agree (trivially so when they are the same host).
+"""
+import struct
+import time
+
+import settings
+
+
+# seconds between 1900 (OSC/NTP) and 1970 (unix) epochs
+NTP_EPOCH_OFFSET = 2208988800
+# timetag meaning "immediately"
+IMMEDIATELY = b"\x00\x00\x00\x00\x00\x00\x00\x01"
+
+_timetag = struct.Struct(">II")
+_size = struct.Struct(">i")
+
+
+def timetag_at(unixtime, buffer=None, offset=0):
+    """
+    OSC timetag for `unixtime`. Packed into `buffer` at `offset` if given.
+    """
+    seconds = int(unixtime)
+    fraction = int((unixtime - seconds) * 4294967296) & 0xFFFFFFFF
+    if buffer is None:
+        return _timetag.pack(seconds + NTP_EPOCH_OFFSET, fraction)
+    _timetag.pack_into(buffer, offset, seconds + NTP_EPOCH_OFFSET, fraction)
+
+
+def bundle(elements):
+    """
+    Encode a bundle of already encoded OSC packets. The timetag is left
+    as 'immediately' for the caller to patch.
+    """
+    data = bytearray(b"#bundle\x00")
+    data += IMMEDIATELY
+    for element in elements:
+        data += _size.pack(len(element))
+        data += element
+    return data
+
+
+class Scene(object):
+    """
+    A named list of (command, loops) actions, e.g.
+
+        [("mute", [1, 2, 3]), ("trigger", [4])]
+
+    compiled into a single bundle of 'hit' messages.
+    """
+    def __init__(self, name, actions, templates):
+        self.name = name
+        self.actions = actions
+        self.messages = [templates.hit(command, loop)
+                         for command, loops in actions
+                         for loop in loops]
+        self.datagram = bundle(self.messages)
+
+    def __repr__(self):
+        return "Scene({}, {})".format(self.name, self.actions)
+
+    def fire(self, channel, latency=None):
+        """
+        Send the scene to take effect `latency` seconds from now (defaults
+        to settings.SCENE_LATENCY). Zero sends its messages untimed, unless
+        the channel is scheduling sends, which then timetags the bundle.
+        """
+        if latency is None:
+            latency = settings.SCENE_LATENCY
+        if latency > 0:
+            timetag_at(time.time() + latency, self.datagram, 8)
+            channel._send_datagram(self.datagram)
+        elif channel.send_time is not None:
+            self.datagram[8:16] = IMMEDIATELY
+            channel._send_datagram(self.datagram)
+        else:
+            for message in self.messages:
+                channel._send_datagram(message)
+        if settings.DEBUG:
+            print("Scene {}: {}".format(self.name, self.actions))
+
+
+def compile_scenes(scenes, templates):
+    """
+    Compile a dict of name -> actions (as in settings.SCENES)
+    """
+    return {name: Scene(name, actions, templates)
+            for name, actions in scenes.items()}
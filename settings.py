@@ -4,22 +4,32 @@ CONFIG_SETS = {
     "default": {
         "doc": "Keyboard and OSC looper controller",
         "COMMAND_SET": "commands.KeyCommandSet",
-        "INPUT_HANDLER": "kbd.InputHandler"
+        "INPUT_HANDLER": "kbd.InputHandler",
+        "KEYMAP": "keymaps/keys.json",
         },
     "stomp_midi_server": {
         "doc": "JACK-side bridge with MIDI command emitter",
         "COMMAND_SET": "midi.MidiCommandSet",
-        "INPUT_HANDLER": "bridge.BridgeInputHandler"
+        "INPUT_HANDLER": "bridge.BridgeInputHandler",
+        "KEYMAP": "keymaps/midi.json",
+        "BRIDGE_DEADLINES": {"*": 0.15},
         },
     "stomp_server": {
         "doc": "JACK-side bridge with stomp box OSC looper controller",
         "COMMAND_SET": "commands.StompCommandSet",
-        "INPUT_HANDLER": "bridge.BridgeInputHandler"
+        "INPUT_HANDLER": "bridge.BridgeInputHandler",
+        "KEYMAP": "keymaps/stomp.json",
+        # punches in/out are worse late than not at all, undo/redo less so
+        "BRIDGE_DEADLINES": {"*": 0.15, "1": 1.0, "double_1": 1.0,
+                             "2": 1.0},
         },
     "key_server": {
         "doc": "JACK-side bridge with keyboard OSC looper controller",
         "COMMAND_SET": "commands.KeyCommandSet",
-        "INPUT_HANDLER": "bridge.BridgeInputHandler"
+        "INPUT_HANDLER": "bridge.BridgeInputHandler",
+        "KEYMAP": "keymaps/keys.json",
+        "BRIDGE_DEADLINES": {"*": 0.15, "UP": None, "DOWN": None,
+                             "u": 1.0, "r": 1.0, "U": 1.0, "z": 1.0},
         },
     "stomp_pedal_client": {
         "doc": "Stomp box input bridged to server",
@@ -31,24 +41,191 @@ CONFIG_SETS = {
         "COMMAND_SET": "bridge.BridgeCommandSet",
         "INPUT_HANDLER": "kbd.InputHandler"
         },
+    "midi_pedal": {
+        "doc": "MIDI foot controller over JACK with OSC looper controller",
+        "COMMAND_SET": "commands.StompCommandSet",
+        "INPUT_HANDLER": "jackmidi.InputHandler",
+        "KEYMAP": "keymaps/stomp.json",
+        "MIDI_INPUT_MAP": {"note 0 60": "0", "note 0 62": "1",
+                           "note 0 64": "2"},
+        },
     "stomp": {
         "doc": "Stomp box input with OSC looper controller",
         "COMMAND_SET": "commands.StompCommandSet",
-        "INPUT_HANDLER": "rpi.InputHandler"
+        "INPUT_HANDLER": "rpi.InputHandler",
+        "KEYMAP": "keymaps/stomp.json",
+        },
+    "stage": {
+        "doc": "Stomp box, keyboard and bridged pedals together with OSC "
+               "looper controller",
+        "INPUT_SOURCES": [
+            {"INPUT_HANDLER": "rpi.InputHandler",
+             "COMMAND_SET": "commands.StompCommandSet",
+             "KEYMAP": "keymaps/stomp.json"},
+            {"INPUT_HANDLER": "kbd.InputHandler",
+             "COMMAND_SET": "commands.KeyCommandSet",
+             "KEYMAP": "keymaps/keys.json"},
+            {"INPUT_HANDLER": "bridge.BridgeInputHandler",
+             "COMMAND_SET": "commands.StompCommandSet",
+             "KEYMAP": "keymaps/stomp.json"},
+            ],
+        "BRIDGE_DEADLINES": {"*": 0.15, "1": 1.0, "double_1": 1.0,
+                             "2": 1.0},
         },
 }
 
+# Several input sources to run at once in one process (see mux.py), all
+# driving the same looper, instead of the config set's INPUT_HANDLER.
+# Each is a dict with "INPUT_HANDLER", "COMMAND_SET" and optionally its
+# own "KEYMAP", e.g.
+# [{"INPUT_HANDLER": "rpi.InputHandler",
+#   "COMMAND_SET": "commands.StompCommandSet"},
+#  {"INPUT_HANDLER": "kbd.InputHandler",
+#   "COMMAND_SET": "commands.KeyCommandSet"}]
+INPUT_SOURCES = []
+# Events from several sources are held this long before being handled,
+# to be put in the order of their input stamps with any from sources
+# slower to report them (debounced switches are stamped from when they
+# started to settle). 0 handles them at once, in order only with those
+# that arrive together.
+MUX_REORDER_WINDOW = 0 # seconds
+
+# Keymap file mapping input events to command set actions, relative to
+# this directory. None uses the command set's own default. With
+# INPUT_SOURCES, each source's "KEYMAP" is used instead, and this only for
+# command sets with no keymap of their own.
+KEYMAP = None
+# reload the keymap when the file changes, checking this often
+KEYMAP_RELOAD = True
+KEYMAP_POLL_INTERVAL = 1.0 # seconds
+
 # RPi switch settings
 # list of GPIO inputs to map to switches 0..n
 SWITCH_CHANNELS = [36]
-GPIO_DEBOUNCE_DELAY = 200 # ms
+# where switch levels are read from
+SWITCH_BACKEND = "debounce.GPIOBackend"
+# switches are sampled this often, and must read steady for the settle
+# time to register a press or release
+SWITCH_SAMPLE_INTERVAL = 0.001 # seconds
+SWITCH_SETTLE_TIME = 0.005 # seconds
 # maximum time between taps to count as a double tap
-# lower bound is effectively determined by GPIO_DEBOUNCE_DELAY
 DOUBLE_TAP_INTERVAL = 0.500 # seconds
+# held this long to count as a long press
+LONG_PRESS_INTERVAL = 0.5 # seconds
+
+# Transport used to talk to SooperLooper. "aio.AsyncChannel" hands
+# sends to an asyncio event loop thread so input is never blocked on
+# the network.
+CHANNEL = "looper.Channel"
+
+# Journal of loop state that SooperLooper doesn't keep for us, such as
+# layer counts and the selected loop, for lc.py --resume to restore after
+# a crash. A path relative to this directory, e.g. "journal/lc", or None
+# for no journal.
+JOURNAL = None
+# records per journal segment; at most two segments are kept
+JOURNAL_SEGMENT_RECORDS = 4096
+# how often the journal is flushed to disk, against losing power
+JOURNAL_FLUSH_INTERVAL = 0.1 # seconds
+
+# Several SooperLooper instances to control as one, e.g. one per
+# performer or JACK host, instead of that given on the command line.
+# Each is a dict with any of "host", "port", "loops", "stereo" and
+# "scenes" (defaulting to SCENES), e.g.
+# [{"host": "localhost", "port": 9951},
+#  {"host": "jackhost2", "port": 9951, "loops": 4}]
+LOOPERS = []
+
+# Subscribe to loop state reported by SooperLooper rather than relying
+# only on the state we infer from the commands we send.
+LIVE_STATE = False
+# minimum time between state updates applied to a loop
+STATE_UPDATE_INTERVAL = 0.05 # seconds
+# ignore reported state this soon after we changed it ourselves
+STATE_SETTLE_TIME = 0.2 # seconds
+
+# Named multi-loop actions, each sent as a single OSC bundle. e.g.
+# "breakdown": [("mute", [1, 2, 3]), ("trigger", [4])]
+SCENES = {}
+# how far ahead scenes, and actions on every instance of a group, are
+# timetagged so that all the loops involved change on the same tick,
+# e.g. 0.01. Needs SooperLooper to share our clock. 0 sends plain
+# messages to be actioned on arrival.
+SCENE_LATENCY = 0 # seconds
+
+# Commands quantized with at_cycle or at_bar (needs LIVE_STATE, else
+# they are sent at once) are sent this long before the boundary,
+# timetagged to take effect on it, to absorb the network's latency.
+# Needs SooperLooper to share our clock.
+QUANTIZE_LEAD = 0.03 # seconds
+# how cycles divide into bars, as SooperLooper's eighth_per_cycle
+QUANTIZE_EIGHTHS_PER_CYCLE = 16
+QUANTIZE_EIGHTHS_PER_BAR = 8
+
+# JACK MIDI output
+MIDI_CLIENT_NAME = "PedalBoard"
+# bytes of lock-free buffer between the input and JACK threads
+MIDI_RINGBUFFER_SIZE = 4096
+# frames between input capture and the MIDI going out. None is one
+# JACK period, enough for any input to reach the process callback.
+MIDI_OUTPUT_DELAY = None
+# most MIDI messages scheduled ahead at once
+MIDI_SCHEDULE_SIZE = 1024
+# how long notes play before their note off
+MIDI_NOTE_LENGTH = 0.25 # seconds
+
+# JACK MIDI input from foot controllers (jackmidi.InputHandler). Keys
+# are "note <channel> <note>", "cc <channel> <controller>" or
+# "pc <channel> <program>", channels from 0, mapped to the key they
+# press; (key, "value") makes a controller continuous. e.g.
+# {"note 0 60": "0", "cc 0 80": "1", "cc 0 11": ("PEDAL0", "value")}
+MIDI_INPUT_MAP = {}
+# at most one value per continuous controller this often
+MIDI_CC_INTERVAL = 0.02 # seconds
+# how often the input thread picks up MIDI from the JACK thread
+MIDI_INPUT_POLL = 0.001 # seconds
+
+# Record per-stage latency from input to OSC send. Percentiles are
+# written to stderr on SIGUSR1 and at exit.
+TRACE = False
+TRACE_BUFFER_SIZE = 4096 # samples kept per stage
+
+# Serve counters and histograms of the controller's internals in the
+# Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics.
+# None serves nothing, and nothing is counted.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
 
 # Network bridge mode
 UDP_HOST = "127.0.0.1"
 UDP_PORT = 21974
+# resend commands the server hasn't acked after this long
+BRIDGE_RETRANSMIT_TIMEOUT = 0.03 # seconds
+BRIDGE_MAX_RETRIES = 5
+# Bridged commands arriving more than this many seconds late are
+# dropped. Keyed by command, "*" for any other; None never expires.
+# Usually set per config set, below is the default.
+BRIDGE_DEADLINES = {}
+# late commands to run as another command rather than drop, e.g.
+# {"double_0": "1"}
+BRIDGE_STALE_REWRITES = {}
+# pairs of commands that cancel out when backlogged together
+BRIDGE_COALESCE = {"UP": "DOWN", "DOWN": "UP"}
+# If set, OSC for bridged commands is timetagged to take effect this
+# long after the press on the client, turning network jitter into a
+# constant delay. e.g. 0.03. Needs SooperLooper to share our clock.
+BRIDGE_TARGET_LATENCY = None # seconds
+# most datagrams taken from the socket per wake-up, and from any one
+# client; a client sending more has the excess dropped
+BRIDGE_MAX_BATCH = 64
+BRIDGE_CLIENT_BUDGET = 16
+# how often remote clients are pinged to estimate their clock offset
+BRIDGE_PING_INTERVAL = 1.0 # seconds
+# clients not heard from for this long are forgotten and no longer
+# pinged; None keeps them for ever
+BRIDGE_SESSION_TIMEOUT = 30.0 # seconds
+# clock estimates with a longer best round trip are too poor to use
+BRIDGE_MAX_RTT = 0.05 # seconds
 
 # import local settings from the (gitignored) local.py
 # If it doesn't exist, that's fine.
@@ -0,0 +1,48 @@
+"""
+Bridge clients driven by input handlers as they are in the
+stomp_pedal_client and key_client config sets
+"""
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bridge
+import bridgeproto
+import events
+import latency
+import rpi
+import settings
+
+
+class BridgeClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(family=socket.AF_INET,
+                                    type=socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(1.0)
+        self.saved = settings.UDP_HOST, settings.UDP_PORT
+        settings.UDP_HOST, settings.UDP_PORT = self.server.getsockname()
+
+    def tearDown(self):
+        settings.UDP_HOST, settings.UDP_PORT = self.saved
+        self.server.close()
+
+    def test_gestures_reach_server(self):
+        handler = rpi.InputHandler(bridge.BridgeCommandSet(None))
+        key = events.KEY_CODES["0"]
+        stamp = latency.now()
+        handler.gestures.press(key, stamp)
+        handler.gestures.release(key, stamp)
+
+        frame_type, sequence, sent_stamp, command = bridgeproto.decode(
+            self.server.recv(bridge.BUFFER_SIZE))
+        self.assertEqual(frame_type, bridgeproto.FRAME_COMMAND)
+        self.assertEqual(command, events.code(events.TAP, key))
+        self.assertEqual(sent_stamp, stamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
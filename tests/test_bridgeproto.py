@@ -0,0 +1,88 @@
+"""
+Bridge frames and sequence tracking
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bridgeproto
+import events
+
+
+class FrameTest(unittest.TestCase):
+    def test_command_round_trip(self):
+        code = events.encode("double_1")
+        self.assertEqual(
+            bridgeproto.decode(bridgeproto.encode_command(7, 123, code)),
+            (bridgeproto.FRAME_COMMAND, 7, 123, code))
+        self.assertEqual(
+            bridgeproto.decode(
+                bridgeproto.encode_command(7, 123, "double_1")),
+            (bridgeproto.FRAME_COMMAND, 7, 123, code))
+
+    def test_command_without_code_as_text(self):
+        self.assertEqual(
+            bridgeproto.decode(bridgeproto.encode_command(1, 2, "custom")),
+            (bridgeproto.FRAME_COMMAND, 1, 2, "custom"))
+
+    def test_ack_ping_and_pong(self):
+        self.assertEqual(bridgeproto.decode(bridgeproto.encode_ack(3, 4)),
+                         (bridgeproto.FRAME_ACK, 3, 4, None))
+        self.assertEqual(bridgeproto.decode(bridgeproto.encode_ping(5, 6)),
+                         (bridgeproto.FRAME_PING, 5, 6, None))
+        self.assertEqual(
+            bridgeproto.decode(bridgeproto.encode_pong(5, 6, 2 ** 40)),
+            (bridgeproto.FRAME_PONG, 5, 6, 2 ** 40))
+
+    def test_plain_text(self):
+        code = events.encode("SPACE")
+        self.assertEqual(bridgeproto.decode(b"SPACE"),
+                         (bridgeproto.FRAME_COMMAND, None, None, code))
+        self.assertEqual(bridgeproto.decode(b"SPACE@99"),
+                         (bridgeproto.FRAME_COMMAND, None, 99, code))
+        self.assertIsNone(bridgeproto.decode(b"SPACE@soon"))
+
+    def test_bad_frames(self):
+        frame = bridgeproto.encode_command(1, 2, "SPACE")
+        self.assertIsNone(bridgeproto.decode(frame[:-1]))
+        self.assertIsNone(bridgeproto.decode(frame[:1] + b"\x09" +
+                                             frame[2:]))
+        pong = bridgeproto.encode_pong(1, 2, 3)
+        self.assertIsNone(bridgeproto.decode(pong[:-1]))
+
+
+class SequenceTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = bridgeproto.SequenceTracker()
+
+    def accept(self, *sequences):
+        return [self.tracker.accept(sequence) for sequence in sequences]
+
+    def test_duplicates(self):
+        self.assertEqual(self.accept(1, 2, 2, 1), [True, True, False, False])
+        self.assertEqual(self.tracker.received, 2)
+        self.assertEqual(self.tracker.duplicates, 2)
+
+    def test_gap_counted_lost_until_filled(self):
+        self.accept(1, 4)
+        self.assertEqual(self.tracker.lost, 2)
+        self.accept(2)
+        self.assertEqual(self.tracker.lost, 1)
+        self.accept(3)
+        self.assertEqual(self.tracker.lost, 0)
+
+    def test_wraps(self):
+        self.assertEqual(self.accept(0xFFFFFFFF, 0, 1), [True] * 3)
+        self.assertEqual(self.tracker.lost, 0)
+        self.assertEqual(self.tracker.highest, 1)
+
+    def test_forgets_beyond_window(self):
+        self.accept(*range(bridgeproto.SEQUENCE_WINDOW + 1))
+        self.assertTrue(self.tracker.accept(0))
+        self.assertFalse(self.tracker.accept(2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Client clock estimates from synthetic ping round trips
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clocksync import ClockEstimator
+
+MS = 1000000
+# the remote clock reads this much ahead of ours
+OFFSET = 5000 * MS
+
+
+def ping(estimator, sent, out, back):
+    """
+    A ping sent at `sent` taking `out` to arrive and `back` to return
+    """
+    estimator.add(sent, sent + out + OFFSET, sent + out + back)
+
+
+class ClockEstimatorTest(unittest.TestCase):
+    def test_symmetric_round_trip(self):
+        estimator = ClockEstimator()
+        ping(estimator, 0, 2 * MS, 2 * MS)
+        self.assertEqual(estimator.offset, OFFSET)
+        self.assertEqual(estimator.rtt, 4 * MS)
+        self.assertEqual(estimator.to_local(OFFSET + 123), 123)
+
+    def test_shortest_round_trip_trusted(self):
+        estimator = ClockEstimator()
+        ping(estimator, 0, 2 * MS, 20 * MS)
+        ping(estimator, 100 * MS, 1 * MS, 1 * MS)
+        ping(estimator, 200 * MS, 15 * MS, 3 * MS)
+        self.assertEqual(estimator.rtt, 2 * MS)
+        self.assertEqual(estimator.offset, OFFSET)
+
+    def test_good_needs_samples_and_short_rtt(self):
+        estimator = ClockEstimator(min_samples=3, max_rtt=0.01)
+        ping(estimator, 0, 1 * MS, 1 * MS)
+        ping(estimator, 100 * MS, 1 * MS, 1 * MS)
+        self.assertFalse(estimator.good())
+        ping(estimator, 200 * MS, 1 * MS, 1 * MS)
+        self.assertTrue(estimator.good())
+
+        slow = ClockEstimator(min_samples=1, max_rtt=0.01)
+        ping(slow, 0, 10 * MS, 10 * MS)
+        self.assertFalse(slow.good())
+
+    def test_window_forgets_old_samples(self):
+        estimator = ClockEstimator(window=2)
+        ping(estimator, 0, 1 * MS, 1 * MS)
+        ping(estimator, 100 * MS, 5 * MS, 5 * MS)
+        ping(estimator, 200 * MS, 4 * MS, 4 * MS)
+        self.assertEqual(estimator.rtt, 8 * MS)
+
+    def test_negative_round_trip_ignored(self):
+        estimator = ClockEstimator()
+        estimator.add(10 * MS, OFFSET, 5 * MS)
+        self.assertIsNone(estimator.offset)
+        self.assertEqual(str(estimator), "no clock estimate")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Debouncing switches replayed from traces of edges
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from debounce import Debouncer
+from debounce import TraceBackend
+import gestures
+
+MS = 1000000
+
+
+class DebouncerTest(unittest.TestCase):
+    def run_trace(self, traces):
+        emitted = []
+        debouncer = Debouncer(
+            list(traces),
+            lambda action, channel, stamp:
+                emitted.append((action, channel, stamp)),
+            TraceBackend(traces, tail=0.05),
+            sample_interval=0.001, settle_time=0.005)
+        debouncer.run()
+        return emitted
+
+    def test_bouncy_press_and_release(self):
+        trace = [(10 * MS, True), (int(11.5 * MS), False),
+                 (int(12.5 * MS), True),
+                 (100 * MS, False), (int(101.5 * MS), True),
+                 (int(102.5 * MS), False)]
+        self.assertEqual(self.run_trace({7: trace}),
+                         [(gestures.PRESS, 7, 10 * MS),
+                          (gestures.RELEASE, 7, 100 * MS)])
+
+    def test_glitch_ignored(self):
+        trace = [(10 * MS, True), (int(12.5 * MS), False)]
+        self.assertEqual(self.run_trace({7: trace}), [])
+
+    def test_channels_independent(self):
+        emitted = self.run_trace({
+            7: [(10 * MS, True), (50 * MS, False)],
+            8: [(20 * MS, True)]})
+        self.assertEqual(emitted, [(gestures.PRESS, 7, 10 * MS),
+                                   (gestures.PRESS, 8, 20 * MS),
+                                   (gestures.RELEASE, 7, 50 * MS)])
+
+    def test_press_reported_after_settling(self):
+        emitted = []
+        backend = TraceBackend({7: [(0, True)]})
+        debouncer = Debouncer([7], lambda *event: emitted.append(event),
+                              backend, sample_interval=0.001,
+                              settle_time=0.005)
+        for sample in range(4):
+            debouncer.sample(sample * MS)
+        self.assertEqual(emitted, [])
+        debouncer.sample(4 * MS)
+        self.assertEqual(emitted, [(gestures.PRESS, 7, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
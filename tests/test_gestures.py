@@ -0,0 +1,152 @@
+"""
+Gesture recognition and the dispatch tables built over it, driven with
+synthetic timestamps
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from base import BaseCommandSet
+import events
+import gestures
+
+MS = 1000000
+KEY = events.KEY_CODES["0"]
+
+
+def code(gesture):
+    return events.code(gesture, KEY)
+
+
+class GestureEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.emitted = []
+        self.engine = gestures.GestureEngine(
+            lambda code, stamp: self.emitted.append((code, stamp)),
+            double_tap_interval=0.25, long_press_interval=0.5)
+
+    def tap(self, at):
+        self.engine.press(KEY, at * MS)
+        self.engine.release(KEY, at * MS + 50 * MS)
+
+    def codes(self):
+        return [code for code, stamp in self.emitted]
+
+    def test_tap_fires_at_once(self):
+        self.engine.press(KEY, 0)
+        self.assertEqual(self.emitted, [(code(events.TAP), 0)])
+
+    def test_double_and_triple(self):
+        for at in [0, 200, 400]:
+            self.tap(at)
+        self.assertEqual(self.codes(), [code(events.TAP),
+                                        code(events.DOUBLE),
+                                        code(events.TRIPLE)])
+
+    def test_fourth_tap_starts_again(self):
+        for at in [0, 200, 400, 600]:
+            self.tap(at)
+        self.assertEqual(self.codes()[3], code(events.TAP))
+
+    def test_slow_taps_are_separate(self):
+        self.tap(0)
+        self.tap(300)
+        self.assertEqual(self.codes(), [code(events.TAP)] * 2)
+
+    def test_auto_repeat_ignored(self):
+        self.engine.press(KEY, 0)
+        self.engine.press(KEY, 30 * MS)
+        self.assertEqual(self.codes(), [code(events.TAP)])
+
+    def test_long_press_and_release(self):
+        self.engine.press(KEY, 0)
+        self.assertEqual(self.engine.timeout(100 * MS), 0.4)
+        self.engine.poll(499 * MS)
+        self.engine.poll(500 * MS)
+        self.engine.poll(600 * MS)
+        self.assertIsNone(self.engine.timeout(600 * MS))
+        self.engine.release(KEY, 700 * MS)
+        self.assertEqual(self.emitted, [(code(events.TAP), 0),
+                                        (code(events.LONG), 500 * MS),
+                                        (code(events.RELEASE), 700 * MS)])
+
+    def test_late_release_fires_long_press(self):
+        self.engine.press(KEY, 0)
+        self.engine.release(KEY, 800 * MS)
+        self.assertEqual(self.codes(), [code(events.TAP),
+                                        code(events.LONG),
+                                        code(events.RELEASE)])
+
+    def test_long_press_ends_run_of_taps(self):
+        self.engine.press(KEY, 0)
+        self.engine.release(KEY, 600 * MS)
+        self.tap(700)
+        self.assertEqual(self.codes()[-1], code(events.TAP))
+
+    def test_click(self):
+        self.engine.feed(gestures.CLICK, KEY, 0)
+        self.engine.feed(gestures.CLICK, KEY, 100 * MS)
+        self.assertEqual(self.codes(), [code(events.TAP),
+                                        code(events.DOUBLE)])
+
+
+class DispatchTableTest(unittest.TestCase):
+    def run_event(self, command_set_class, gesture):
+        command_set = command_set_class.__new__(command_set_class)
+        command_set.calls = []
+        command_set_class.dispatch_table[code(gesture)](command_set)
+        return command_set.calls
+
+    def test_upgrade_rolls_back_tap(self):
+        class Commands(BaseCommandSet):
+            def handle_0(self):
+                self.calls.append("tap")
+
+            def rollback_handle_0(self):
+                self.calls.append("rollback")
+
+            def handle_double_0(self):
+                self.calls.append("double")
+
+        self.assertEqual(self.run_event(Commands, events.TAP), ["tap"])
+        self.assertEqual(self.run_event(Commands, events.DOUBLE),
+                         ["rollback", "double"])
+
+    def test_upgrade_without_rollback(self):
+        class Commands(BaseCommandSet):
+            def handle_0(self):
+                self.calls.append("tap")
+
+            def handle_double_0(self):
+                self.calls.append("double")
+
+        self.assertEqual(self.run_event(Commands, events.DOUBLE),
+                         ["double"])
+
+    def test_unmapped_upgrades_fall_back(self):
+        class TapOnly(BaseCommandSet):
+            def handle_0(self):
+                self.calls.append("tap")
+
+        class TapAndDouble(TapOnly):
+            def handle_double_0(self):
+                self.calls.append("double")
+
+        self.assertEqual(self.run_event(TapOnly, events.DOUBLE), ["tap"])
+        self.assertEqual(self.run_event(TapOnly, events.TRIPLE), ["tap"])
+        self.assertEqual(self.run_event(TapAndDouble, events.TRIPLE),
+                         ["double"])
+
+    def test_unmapped_key_has_no_entry(self):
+        class Commands(BaseCommandSet):
+            def handle_1(self):
+                pass
+
+        self.assertNotIn(code(events.TAP), Commands.dispatch_table)
+        self.assertNotIn(code(events.DOUBLE), Commands.dispatch_table)
+
+
+if __name__ == "__main__":
+    unittest.main()
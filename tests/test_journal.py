@@ -0,0 +1,116 @@
+"""
+Journaling loop state and replaying it after a crash
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from looper import Loop
+import journal
+
+
+class FakeLooper(object):
+    """
+    Just the state of a looper that is journaled
+    """
+    def __init__(self, nloops):
+        self.loops = [Loop(loop_index=i) for i in range(nloops)]
+        self.selected_loop = 0
+        self.group_pause_cache = None
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def journal(self, segment_records=64):
+        return journal.Journal(self.path, segment_records=segment_records,
+                               flush_interval=60)
+
+    def play(self, looper):
+        looper.loops[0].state = Loop.PLAYBACK
+        looper.loops[0].current_layer = looper.loops[0].layers = 3
+        looper.loops[1].state = Loop.PAUSED
+        looper.selected_loop = 1
+        looper.group_pause_cache = [looper.loops[0]]
+
+    def assertRestored(self, restored):
+        self.assertEqual([loop.state for loop in restored.loops],
+                         [Loop.PLAYBACK, Loop.PAUSED, Loop.WAIT])
+        self.assertEqual(restored.loops[0].layers, 3)
+        self.assertEqual(restored.selected_loop, 1)
+        self.assertEqual(restored.group_pause_cache, [restored.loops[0]])
+
+    def test_replay(self):
+        looper = FakeLooper(3)
+        writer = self.journal().start(looper)
+        self.play(looper)
+        writer.sync()
+
+        restored = FakeLooper(3)
+        self.assertIsNotNone(self.journal().replay(restored))
+        self.assertRestored(restored)
+
+    def test_no_journal(self):
+        self.assertIsNone(self.journal().replay(FakeLooper(1)))
+
+    def test_rotates_keeping_latest_state(self):
+        looper = FakeLooper(3)
+        writer = self.journal(segment_records=8).start(looper)
+        for i in range(20):
+            looper.selected_loop = i % 3
+            writer.sync()
+        self.play(looper)
+        writer.sync()
+        self.assertLessEqual(len(writer.segments()), 2)
+
+        restored = FakeLooper(3)
+        self.journal().replay(restored)
+        self.assertRestored(restored)
+
+    def test_replay_stops_at_record_out_of_sequence(self):
+        looper = FakeLooper(3)
+        writer = self.journal().start(looper)
+        looper.selected_loop = 1
+        writer.sync()
+        looper.selected_loop = 2
+        writer.sync()
+        # as if the last write was torn
+        position = writer.position - journal.RECORD_SIZE
+        writer.map[position:position + 4] = b"\x99\x99\x99\x99"
+
+        restored = FakeLooper(3)
+        self.journal().replay(restored)
+        self.assertEqual(restored.selected_loop, 1)
+
+    def test_valid_needs_snapshot(self):
+        records = b"".join(
+            journal._record.pack(sequence, journal.LOOPER, 0, 0, 0, 1, 0)
+            for sequence in [1, 2])
+        reader = self.journal()
+        self.assertIsNone(reader._valid(records))
+        snapshot = journal._record.pack(3, journal.SNAPSHOT, 0, 0, 0, 0, 0)
+        self.assertEqual(len(reader._valid(records + snapshot + b"\0")), 3)
+
+    def test_pause_mask_limited(self):
+        looper = FakeLooper(journal.PAUSE_MASK_LOOPS + 2)
+        looper.group_pause_cache = [looper.loops[1], looper.loops[-1]]
+        mask = journal._pause_mask(looper)
+        self.assertEqual(journal._paused(looper, mask), [looper.loops[1]])
+        looper.group_pause_cache = []
+        self.assertEqual(journal._paused(looper, journal._pause_mask(looper)),
+                         [])
+        looper.group_pause_cache = None
+        self.assertIsNone(journal._paused(looper,
+                                          journal._pause_mask(looper)))
+
+
+if __name__ == "__main__":
+    unittest.main()
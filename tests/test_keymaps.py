@@ -0,0 +1,122 @@
+"""
+Compiling keymaps into dispatch tables, and reloading them
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from base import BaseCommandSet
+import events
+import keymaps
+
+
+class Commands(BaseCommandSet):
+    nested_actions = ("later",)
+
+    def handle_0(self):
+        self.calls.append("handle_0")
+
+    def first(self):
+        self.calls.append("first")
+
+    def rollback_first(self):
+        self.calls.append("rollback")
+
+    def second(self):
+        self.calls.append("second")
+
+    def note(self, channel, number):
+        self.calls.append(("note", channel, number))
+
+    def later(self, action, *args):
+        self.calls.append(("later", action) + args)
+
+
+def run(table, event):
+    command_set = Commands.__new__(Commands)
+    command_set.calls = []
+    table[events.encode(event)](command_set)
+    return command_set.calls
+
+
+class CompileKeymapTest(unittest.TestCase):
+    def test_actions_and_arguments(self):
+        table = keymaps.compile_keymap(
+            {"1": "first", "2": ["note", 0, 60],
+             "3": ["later", "note", 1, 61]}, Commands)
+        self.assertEqual(run(table, "1"), ["first"])
+        self.assertEqual(run(table, "2"), [("note", 0, 60)])
+        self.assertEqual(run(table, "3"), [("later", "note", 1, 61)])
+        # by name too
+        self.assertIs(table["1"], table[events.encode("1")])
+
+    def test_over_class_handlers(self):
+        table = keymaps.compile_keymap({"1": "first"}, Commands)
+        self.assertEqual(run(table, "0"), ["handle_0"])
+        table = keymaps.compile_keymap({"0": "first"}, Commands)
+        self.assertEqual(run(table, "0"), ["first"])
+
+    def test_rollback_by_action_name(self):
+        table = keymaps.compile_keymap(
+            {"1": "first", "double_1": "second"}, Commands)
+        self.assertEqual(run(table, "double_1"), ["rollback", "second"])
+        self.assertEqual(run(table, "triple_1"), ["second"])
+
+    def test_bad_actions(self):
+        for action in ["frist", [], ["later", "frist"], ["later"]]:
+            with self.assertRaises(Exception):
+                keymaps.compile_keymap({"1": action}, Commands)
+
+    def test_shipped_keymaps(self):
+        import commands
+        import midi
+
+        for path, command_set_class in [
+                ("keymaps/keys.json", commands.KeyCommandSet),
+                ("keymaps/stomp.json", commands.StompCommandSet),
+                ("keymaps/midi.json", midi.MidiCommandSet)]:
+            keymaps.compile_keymap(keymaps.load(keymaps.path_for(path)),
+                                   command_set_class)
+
+
+class KeymapWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile("w", suffix=".json",
+                                                delete=False)
+        self.file.close()
+        self.write({"1": "first"})
+        self.command_set = Commands.__new__(Commands)
+        self.command_set.dispatch_table = keymaps.compile_keymap(
+            keymaps.load(self.file.name), Commands)
+        self.watcher = keymaps.KeymapWatcher(self.command_set,
+                                             self.file.name)
+
+    def tearDown(self):
+        os.unlink(self.file.name)
+
+    def write(self, keymap):
+        with open(self.file.name, "w") as f:
+            f.write(keymap if isinstance(keymap, str)
+                    else json.dumps(keymap))
+
+    def test_reload(self):
+        self.write({"1": "second"})
+        self.assertTrue(self.watcher.reload())
+        self.assertEqual(run(self.command_set.dispatch_table, "1"),
+                         ["second"])
+
+    def test_bad_file_keeps_keymap(self):
+        table = self.command_set.dispatch_table
+        for keymap in ["{", "[]", {"1": "frist"}]:
+            self.write(keymap)
+            self.assertFalse(self.watcher.reload())
+        self.assertIs(self.command_set.dispatch_table, table)
+        self.assertEqual(self.watcher.reloads, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+MIDI scheduling, without JACK
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import midi
+
+
+class FakeRingBuffer(object):
+    def __init__(self, space):
+        self.write_space = space
+        self.written = []
+
+    def write(self, data):
+        self.written.append(midi._event.unpack(bytes(data)))
+        self.write_space -= len(data)
+
+
+class FrameHeapTest(unittest.TestCase):
+    def test_pops_in_key_order(self):
+        heap = midi.FrameHeap(100)
+        keys = random.Random(1).sample(range(1000), 100)
+        for key in keys:
+            self.assertTrue(heap.push(key, key * 2))
+        popped = [heap.pop() for key in keys]
+        self.assertEqual(popped, sorted(key * 2 for key in keys))
+        self.assertEqual(heap.size, 0)
+
+    def test_same_frame_in_send_order(self):
+        heap = midi.FrameHeap(8)
+        for sequence, message in enumerate([30, 10, 20]):
+            heap.push((5 << midi.SEQUENCE_BITS) | sequence, message)
+        heap.push((4 << midi.SEQUENCE_BITS) | 3, 40)
+        self.assertEqual([heap.pop() for i in range(4)], [40, 30, 10, 20])
+
+    def test_full(self):
+        heap = midi.FrameHeap(2)
+        self.assertTrue(heap.push(2, 2))
+        self.assertTrue(heap.push(1, 1))
+        self.assertFalse(heap.push(0, 0))
+        self.assertEqual(heap.pop(), 1)
+        self.assertTrue(heap.push(0, 0))
+        self.assertEqual([heap.pop(), heap.pop()], [0, 2])
+
+
+class MidiEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = midi.MidiEngine(delay=0)
+        self.engine.rate = 48000
+        self.engine.frame_for = lambda stamp=None: 1000
+
+    def test_note_on_and_off(self):
+        self.engine.events = FakeRingBuffer(midi.EVENT_SIZE * 4)
+        self.assertTrue(self.engine.note(1, 60, 100, length=0.5))
+        self.assertEqual(self.engine.events.written,
+                         [(1000, 3, bytes([0x91, 60, 100])),
+                          (25000, 3, bytes([0x81, 60, 0]))])
+
+    def test_note_queued_whole_or_not_at_all(self):
+        self.engine.events = FakeRingBuffer(midi.EVENT_SIZE * 3)
+        self.assertTrue(self.engine.note(0, 60, length=0.1))
+        self.assertFalse(self.engine.note(0, 61, length=0.1))
+        self.assertEqual(len(self.engine.events.written), 2)
+        self.assertEqual(self.engine.dropped, 2)
+        # with no note off, one event fits
+        self.assertTrue(self.engine.note(0, 62, length=0))
+        self.assertEqual(len(self.engine.events.written), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
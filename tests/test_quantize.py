@@ -0,0 +1,122 @@
+"""
+Quantized scheduling against a simulated clock
+"""
+import contextlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from looper import Loop
+import quantize
+
+
+class FakeLooper(object):
+    """
+    Just what the scheduler reads of a looper, recording when what it
+    fires is scheduled for
+    """
+    def __init__(self):
+        self.master = Loop()
+        self.loops = [self.master]
+        self.send_time = None
+
+    @contextlib.contextmanager
+    def scheduled(self, unixtime):
+        self.send_time = unixtime
+        try:
+            yield
+        finally:
+            self.send_time = None
+
+
+class TimersTest(unittest.TestCase):
+    def test_due_in_order(self):
+        timers = quantize.Timers()
+        timers.add(2.0, "b")
+        timers.add(1.0, "a")
+        timers.add(2.0, "c")
+        self.assertEqual(timers.next_due(), 1.0)
+        self.assertEqual(timers.pop_due(2.0), [("a", ()), ("b", ()),
+                                               ("c", ())])
+        self.assertIsNone(timers.next_due())
+
+    def test_cancel_is_lazy(self):
+        timers = quantize.Timers()
+        first = timers.add(1.0, "a")
+        timers.add(2.0, "b")
+        timers.cancel(first)
+        # still held until it comes to the top
+        self.assertEqual(len(timers), 2)
+        self.assertEqual(timers.next_due(), 2.0)
+        self.assertEqual(len(timers), 1)
+        self.assertEqual(timers.pop_due(3.0), [("b", ())])
+
+
+class QuantizedSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.looper = FakeLooper()
+        loop = self.looper.master
+        loop.state = Loop.PLAYBACK
+        loop.length = 8.0
+        loop.position = 3.0
+        loop.position_time = self.now
+        self.scheduler = quantize.QuantizedScheduler(
+            self.looper, lead=0.05, clock=lambda: self.now)
+        self.scheduler.bars = 2
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.looper.send_time))
+
+    def test_boundary(self):
+        scheduler = self.scheduler
+        self.assertAlmostEqual(scheduler.boundary(self.now), 1005.0)
+        self.assertAlmostEqual(scheduler.boundary(self.now, 2), 1001.0)
+        self.assertAlmostEqual(scheduler.boundary(self.now, 4), 1001.0)
+        # extrapolated from when the position was reported
+        self.assertAlmostEqual(scheduler.boundary(self.now + 2.5),
+                               1005.0)
+        self.assertAlmostEqual(scheduler.boundary(self.now + 6.0),
+                               1013.0)
+
+    def test_no_boundary_unless_playing(self):
+        self.looper.master.state = Loop.PAUSED
+        self.assertIsNone(self.scheduler.boundary(self.now))
+        self.looper.master.state = Loop.PLAYBACK
+        self.looper.master.length = 0.0
+        self.assertIsNone(self.scheduler.boundary(self.now))
+
+    def test_at_cycle_fires_ahead_timetagged(self):
+        self.scheduler.at_cycle(self.fire, "cycle")
+        self.assertAlmostEqual(self.scheduler.timeout(), 4.95)
+        self.now = 1004.9
+        self.scheduler.poll(self.now)
+        self.assertEqual(self.fired, [])
+        self.now = 1004.96
+        self.scheduler.poll(self.now)
+        self.assertEqual(self.fired, [("cycle", 1005.0)])
+        self.assertIsNone(self.scheduler.timeout())
+
+    def test_at_bar(self):
+        self.scheduler.at_bar(self.fire, "bar")
+        self.scheduler.poll(1001.0)
+        self.assertEqual(self.fired, [("bar", 1001.0)])
+
+    def test_runs_now_when_not_playing(self):
+        self.looper.master.state = Loop.WAIT
+        self.assertIsNone(self.scheduler.at_cycle(self.fire, "now"))
+        self.assertEqual(self.fired, [("now", None)])
+
+    def test_cancel(self):
+        entry = self.scheduler.at_cycle(self.fire, "cancelled")
+        self.scheduler.at_bar(self.fire, "bar")
+        self.scheduler.cancel(entry)
+        self.scheduler.poll(1010.0)
+        self.assertEqual(self.fired, [("bar", 1001.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()